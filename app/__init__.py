@@ -1,3 +1,3 @@
-from flask.ext.sqlalchemy import SQLAlchemy
+from .replica import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
@@ -1,24 +1,28 @@
 import os
 from datetime import date, timedelta
 from flask import Flask, request, render_template, make_response, Response
+from flask import abort, send_from_directory
+from jinja2 import Markup
 from lib.git_parse import GitHub
-import lib.ga as ga
+from lib import metrics
+from lib.utils import valid_signature
 from functools import wraps
-from waitress import serve
-import calendar
 import json
-import requests
-import yaml
+import re
+import threading
+import time
 from sassutils.wsgi import SassMiddleware
 from .models import GithubQueryLog, Author, Issue, Milestone, Month, Event, db
-from .models import update_db_from_github
+from .models import ReviewStage
+from .models import update_db_from_github, sync_is_ready, sync_state
+from . import export, jobs, profiling, webhooks
+from .streaming import flush, streamed_page
 
 app = Flask(__name__)
 scss_manifest = {app.name: ('static/_scss', 'static/css')}
 # Middleware
 app.wsgi_app = SassMiddleware(app.wsgi_app, scss_manifest)
-
-servers = {"production": os.environ.get('PROD'), "staging": os.environ.get('STAGING')}
+app.add_template_global(flush)
 
 
 # htpasswd configuration c/o http://flask.pocoo.org/snippets/8/
@@ -43,39 +47,109 @@ def requires_auth(f):
         auth = request.authorization
         if not auth or not check_auth(auth.username, auth.password):
             return authenticate()
+        if request.args.get('profile'):
+            return profiling.profiled(f, *args, **kwargs)
         return f(*args, **kwargs)
 
     return decorated
 
 
-def load_issue_data():
-    update_db_from_github(refresh_timedelta=app.config['REFRESH_TIMEDELTA'])
-    data = {
-        'months': Month.query.filter(Month.authors),
-        'current': Author.query.all(),
-        'issues': Issue.query.all(),
-        'formatted': date.today().strftime('%Y-%-m-%d'),
-    }
-    for i in Issue.query:
-        data['issue-{0}-milestones'.format(i.number)] = i.milestones
-    return dict(data=data)
+def refresh_timedelta():
+    """How stale stored data may get before a page view or the background
+    sync refreshes it.  With webhooks configured, updates arrive as they
+    happen and polling is only a rare reconciliation pass."""
+    if app.config.get('GITHUB_WEBHOOK_SECRET'):
+        return app.config['RECONCILE_TIMEDELTA']
+    return app.config['REFRESH_TIMEDELTA']
+
+
+@app.before_request
+def route_reads_to_replica():
+    "GET and HEAD requests read from the replica, when one is configured."
+    if request.method in ('GET', 'HEAD'):
+        db.read_from_replica()
+
+
+def sync_on_view():
+    "Without a background sync, a page view refreshes stale data first."
+    if not app.config.get('BACKGROUND_SYNC'):
+        with db.primary():
+            update_db_from_github(refresh_timedelta=refresh_timedelta())
+
+
+def sync_in_background(retry_seconds=30):
+    """Starts a daemon thread that keeps the database in sync with upstream.
+
+    The first sync is retried every `retry_seconds` until every source has
+    loaded once; after that the thread refreshes every REFRESH_TIMEDELTA.
+    Page views stop triggering syncs of their own."""
+    app.config['BACKGROUND_SYNC'] = True
+
+    def run():
+        while True:
+            with app.app_context():
+                try:
+                    update_db_from_github(
+                        refresh_timedelta=refresh_timedelta())
+                except Exception:
+                    app.logger.exception('Background sync failed')
+            if sync_is_ready():
+                time.sleep(refresh_timedelta().total_seconds())
+            else:
+                time.sleep(retry_seconds)
+
+    thread = threading.Thread(target=run, name='background-sync')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def warming_up():
+    "Page shown in place of data views until the first sync completes."
+    return render_template("warming.html", sources=sync_state)
 
 
 def analytics_data(start_date):
+    # The Google API client stack is slow to import and only this view
+    # needs it, so it is loaded on first use.
+    import lib.ga as ga
     start_date = start_date.strftime("%Y-%m-%d")
     service = ga.main()
     results = ga.get_sessions_by_month(service[0], service[1], start_date, date.today().strftime("%Y-%m-%d"))
     return results
 
+def _month_arg(name):
+    "A `YYYY-MM` query string argument as the first day of that month."
+    value = request.args.get(name)
+    if value:
+        try:
+            (year, month) = value.split('-')
+            return date(int(year), int(month), 1)
+        except ValueError:
+            abort(Response('{0} must be YYYY-MM\n'.format(name), 400))
+
 @app.route("/")
 @requires_auth
 def index():
-    return render_template("index.html")
+    matrix = Month.author_matrix()
+    data = {
+        'current': Author.query.count(),
+        'months': list(zip(matrix['months'], matrix['author_counts'])),
+    }
+    return render_template("index.html", data=data)
+
+@app.route("/api/author-months/")
+@requires_auth
+def author_months():
+    "Author-by-month membership; ?start=YYYY-MM&end=YYYY-MM slices it."
+    matrix = Month.author_matrix(start=_month_arg('start'),
+                                 end=_month_arg('end'))
+    return Response(json.dumps(matrix), mimetype='application/json')
 
 @app.route("/analytics/", methods=['GET'])
 @requires_auth
 def analytics(start_date=None):
-    if request.args != {}:
+    if request.args.get('start_date_1'):
         day = int(request.args.get('start_date_1'))
         month = int(request.args.get('start_date_2'))
         year = int(request.args.get('start_date_3'))
@@ -88,19 +162,169 @@ def analytics(start_date=None):
 @app.route("/issues/")
 @requires_auth
 def issues():
-    results = load_issue_data()
-    return render_template("issues.html", data=results)
+    if not sync_is_ready() and app.config.get('BACKGROUND_SYNC'):
+        return warming_up()
+    sync_on_view()
+    return streamed_page("issues.html", issues=Issue.listing())
+
+@app.route("/review-times/")
+@requires_auth
+def review_times():
+    stage = request.args.get('stage', 'ready to approve')
+    results = {
+        'stage': stage,
+        'by_label': ReviewStage.median_days_by_label(stage),
+        'by_team': ReviewStage.median_days_by_team(stage),
+        'weekly': ReviewStage.weekly_throughput(stage),
+        'activity': Event.weekly_activity(),
+    }
+    return render_template("review_times.html", data=results)
+
+@app.template_filter('highlight')
+def highlight(snippet):
+    "Escapes a search snippet, keeping the <mark> tags around matches."
+    parts = re.split(r'</?mark>', snippet or '')
+    return Markup('').join(Markup('<mark>%s</mark>') % part if n % 2 else part
+                           for (n, part) in enumerate(parts))
+
+def search_issues():
+    "Runs the issue search described by the request's query string."
+    labels = [l for l in request.args.get('labels', '').split(',') if l]
+    limit = request.args.get('limit', 50, type=int)
+    return Issue.search(request.args.get('q', ''), labels=labels,
+                        state=request.args.get('state'),
+                        limit=max(1, min(limit, 200)))
+
+@app.route("/search/")
+@requires_auth
+def search():
+    results = {'query': request.args.get('q', ''),
+               'labels': request.args.get('labels', ''),
+               'state': request.args.get('state', ''),
+               'issues': search_issues()}
+    return render_template("search.html", data=results)
+
+@app.route("/api/search/")
+@requires_auth
+def search_json():
+    body = json.dumps({'issues': search_issues()}, default=str)
+    return Response(body, mimetype='application/json')
+
+@app.route("/jobs/")
+@requires_auth
+def job_status():
+    "Depth and throughput of the ingestion job queue."
+    return render_template("jobs.html", data=jobs.status())
+
+@app.route("/api/jobs/")
+@requires_auth
+def job_status_json():
+    body = json.dumps(jobs.status(), default=str, sort_keys=True)
+    return Response(body, mimetype='application/json')
+
+@app.route("/api/export/<table>.parquet")
+@requires_auth
+def export_table(table):
+    """`table` as a Parquet file, read from the replica if there is one.
+    With `since`, the X-Export-Watermark of an earlier export, only rows
+    written after it."""
+    if table not in export.TABLES:
+        return Response('No such table\n', 404)
+    (watermark, pieces) = export.stream_table(
+        table, request.args.get('since', type=int))
+    return Response(pieces, mimetype='application/vnd.apache.parquet',
+                    headers={
+                        'X-Export-Watermark': str(watermark),
+                        'Content-Disposition':
+                            'attachment; filename={0}.parquet'.format(table)})
+
+@app.route("/profiles/")
+@requires_auth
+def profiles():
+    "Profiles saved by requests made with ?profile=1."
+    return render_template("profiles.html",
+                           profiles=profiling.saved_profiles())
+
+@app.route("/profiles/<path:filename>")
+@requires_auth
+def profile_file(filename):
+    return send_from_directory(profiling.profile_dir(), filename)
+
+@app.route("/healthz")
+def healthz():
+    "Liveness: the process is up and serving requests."
+    return Response('ok\n', mimetype='text/plain')
+
+@app.route("/readyz")
+def readyz():
+    "Readiness: 200 once every data source has synced, 503 until then."
+    ready = sync_is_ready()
+    body = json.dumps({'ready': ready, 'sources': sync_state},
+                      default=str, sort_keys=True)
+    return Response(body, status=200 if ready else 503,
+                    mimetype='application/json')
+
+@app.route("/metrics")
+@requires_auth
+def prometheus_metrics():
+    "GitHub client, SQL and sync phase metrics in Prometheus text format."
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+@app.route("/webhooks/github", methods=['POST'])
+def github_webhook():
+    "Applies a signed GitHub webhook delivery to the stored data."
+    body = request.get_data()
+    signature = request.headers.get('X-Hub-Signature-256') or \
+        request.headers.get('X-Hub-Signature')
+    if not valid_signature(app.config.get('GITHUB_WEBHOOK_SECRET'), body,
+                           signature):
+        return Response('Invalid signature\n', 403)
+    event = request.headers.get('X-GitHub-Event')
+    if event == 'ping':
+        return Response('pong\n', 200)
+    try:
+        payload = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return Response('Malformed JSON payload\n', 400)
+    if not webhooks.apply(event, payload):
+        return Response('Ignored {0} event\n'.format(event), 202)
+    return Response(status=204)
 
 @app.route("/manage/")
 @requires_auth
 def manage():
+    """Queues a rebuild of the server given as `rebuild`, merged with any
+    other requested within REBUILD_COALESCE_SECONDS; returns at once."""
     error = None
-    if request.args.get('rebuild'):
-        server = request.args.get('rebuild')
-        url = servers[server]
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        payload = {"ref": "refs/heads/%s" % server}
-        requests.post(url, data=json.dumps(payload), headers=headers)
-    else:
+    job_id = None
+    server = request.args.get('rebuild')
+    if not server:
         error = "No server to rebuild"
-    return render_template("manage.html", error=error)
+    elif not app.config.get('REBUILD_HOOKS', {}).get(server):
+        error = "No build hook for {0}".format(server)
+    else:
+        job_id = jobs.request_rebuild(
+            server, app.config.get('REBUILD_COALESCE_SECONDS', 30))
+        db.session.commit()
+    return render_template("manage.html", error=error, server=server,
+                           job_id=job_id, rebuilds=jobs.rebuilds()), \
+        202 if job_id else 200
+
+@app.route("/api/rebuilds/")
+@requires_auth
+def rebuilds_json():
+    "The latest site rebuild dispatches and their latency."
+    body = json.dumps(jobs.rebuilds(), default=str, sort_keys=True)
+    return Response(body, mimetype='application/json')
+
+@app.route("/api/rebuilds/<int:job_id>")
+@requires_auth
+def rebuild_json(job_id):
+    "One site rebuild dispatch, by the job id /manage/ returned."
+    found = jobs.rebuilds(job_id)
+    if not found:
+        return Response('{"error": "No such rebuild"}', status=404,
+                        mimetype='application/json')
+    body = json.dumps(found[0], default=str, sort_keys=True)
+    return Response(body, mimetype='application/json')
@@ -0,0 +1,159 @@
+"""`update_db_from_github`, with all network I/O overlapped on one event loop.
+
+Requires Python 3.6+ and aiohttp (see `lib.async_git_parse`).  Authors and
+the issues of every repo sync concurrently; within each, every independent
+request (each month's authors.yml, each team file) is in flight at once,
+bounded per host by the shared `ConnectionPool`.  Issues and their events
+come a page at a time from each repo's issue and issue event feeds.  Database
+writes stay on the calling thread, batched per step (per page, for issues),
+and never interleave with each other since none of them awaits.  Each batch
+is committed before the next await, so rolling back a repo whose page failed
+takes nothing of the other syncs with it.
+"""
+import asyncio
+from datetime import datetime
+
+import yaml
+
+from lib.async_git_parse import AsyncGitHub, ConnectionPool
+from lib.git_parse import site_api
+from . import models
+from .models import Author, DutyStation, GithubQueryLog, Issue, Month, db
+
+
+async def _month_authors(site, month):
+    "authors.yml as of `month`, as a dict ({} if there is no such commit)."
+    commits = await site.fetch_commits(month._date_range())
+    if not commits:
+        return {}
+    content = await site.file_at_commit(commits[0]['sha'], '_data/authors.yml')
+    return yaml.load(content) or {}
+
+
+async def _enrich(pool):
+    "Async `Author.enrich`: both trees, then all changed files, at once."
+    sources = Author.team_file_sources()
+    clients = [AsyncGitHub.like(api, pool) for (api, _, _, _) in sources]
+    trees = await asyncio.gather(*[
+        client.tree_shas(path.split('{')[0])
+        for (client, (_, _, path, _)) in zip(clients, sources)])
+    authors = Author.query.all()
+    for (client, source, shas) in zip(clients, sources, trees):
+        if shas is False:
+            continue
+        (_, _, path, _) = source
+        changed = list(Author.changed_team_files(authors, source, shas))
+        files = await asyncio.gather(*[
+            client.yaml(path.format(author.username), 1, None)
+            for (author, sha) in changed if sha is not None])
+        files = iter(files)
+        for (author, sha) in changed:
+            data = next(files) if sha is not None else {}
+            if data is not None:
+                author.apply_team_file(source, sha, data)
+        db.session.commit()
+
+
+async def sync_authors(pool):
+    "Async `Author.fetch`."
+    site = AsyncGitHub.like(site_api, pool)
+    current = asyncio.ensure_future(pool.get(models.SITE_AUTHORS_URL,
+                                              'site-api'))
+    months = Month.needing_authors()
+    downloads = [asyncio.ensure_future(_month_authors(site, month))
+                 for month in months]
+    try:
+        # In order, each committed once it and those before it are in
+        for (month, download) in zip(months, downloads):
+            month.store_authors(await download)
+    finally:
+        for download in downloads:
+            download.cancel()
+    for (username, author_data) in (await current).json().items():
+        db.session.add(Author.from_api_data(username, author_data))
+    db.session.commit()
+    await _enrich(pool)
+    GithubQueryLog.log('authors')
+    GithubQueryLog.log('author_months')
+    db.session.commit()
+
+
+async def sync_issues(pool, api, since):
+    "Async `Issue.fetch`; each page is stored while the next downloads."
+    client = AsyncGitHub.like(api, pool)
+    (since, seen) = Issue.resume_point(api.full_name, since)
+    newest = Issue.last_event_id(api.full_name)
+    async for page in client.iter_issue_pages(since=since, seen=seen):
+        Issue.store_page(api.full_name, page)
+    async for page in client.iter_repo_events(newest):
+        Issue.store_events(api.full_name, page)
+        newest = max(newest, max(e['id'] for e in page))
+    Issue._log_watermarks(api.full_name, newest)
+
+
+async def _sync_repo(pool, api, since):
+    "`sync_issues`, rolling back and returning the exception if it fails."
+    try:
+        await sync_issues(pool, api, since)
+    except Exception as e:
+        db.session.rollback()
+        models.ISSUE_REPO_FAILURES.inc(repo=api.full_name)
+        return e
+
+
+async def sync_issue_repos(pool, stale):
+    "Async `Issue.fetch_repos`: every stale repo at once."
+    results = await asyncio.gather(*[_sync_repo(pool, api, since)
+                                     for (api, since) in stale])
+    models._record_repo_failures(
+        dict((api.full_name, e) for ((api, _), e) in zip(stale, results)
+             if e is not None), len(stale))
+
+
+async def _phase(source, coroutine):
+    with models._sync_phase(source):
+        await coroutine
+
+
+async def _update(refresh_timedelta, per_host):
+    phases = []
+    async with ConnectionPool(per_host=per_host) as pool:
+        last_query = GithubQueryLog.last_query_datetime('authors')
+        if (datetime.now() - last_query) > refresh_timedelta:
+            phases.append(_phase('authors', sync_authors(pool)))
+        else:
+            models._mark_fresh('authors')
+        stale = models.stale_issue_repos(refresh_timedelta)
+        if stale:
+            phases.append(_phase('issues', sync_issue_repos(pool, stale)))
+        else:
+            models._mark_fresh('issues')
+        results = await asyncio.gather(*phases, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def update_db_from_github(refresh_timedelta, per_host=32):
+    """Refresh author and issue data from Github / 18f API concurrently.
+
+    Same contract as `models.update_db_from_github`.
+
+    Args:
+        refresh_timedelta: Pull from each data source only if the last pull
+            was at least this long ago.
+        per_host: requests allowed in flight to any one host
+    """
+    if not models._sync_lock.acquire(False):
+        return
+    try:
+        models._partition_housekeeping()
+        with models._sync_phase('duty_stations'):
+            DutyStation.fill()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(_update(refresh_timedelta, per_host))
+        finally:
+            loop.close()
+    finally:
+        models._sync_lock.release()
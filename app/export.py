@@ -0,0 +1,222 @@
+"""Exports the tables analysts use to compressed Parquet files.
+
+    counts = export.export_all('export', incremental=True)
+
+Each table is read through a server-side cursor `batch_rows` rows at a
+time and each batch written as one Parquet row group, so memory use stays
+the same however large the table.  Reads go to the read replica when one is
+configured (see app/replica.py), in one REPEATABLE READ transaction, so
+every table comes from the same snapshot.
+
+An export records the transaction ID horizon of its snapshot as a
+watermark.  An incremental export holds only the rows inserted or updated
+since: those whose xmin is at or past the previous export's watermark
+(a few rows near the boundary may be exported twice).  Rows deleted since
+don't appear in incremental exports; a full export has the whole table.
+
+Needs pyarrow, which is imported on first use.
+"""
+import os
+from datetime import datetime
+from flask import current_app
+from . import db, replica
+from .models import GithubQueryLog
+
+TABLES = ('issue', 'event', 'milestone', 'author_months')
+# Columns left out of exports, by table
+EXCLUDED_COLUMNS = {'issue': ('search_vector', )}
+BATCH_ROWS = 10000
+COMPRESSION = 'zstd'
+
+
+def watermark_query_type(table):
+    "`GithubQueryLog` entry holding `table`'s last export watermark."
+    return 'export:{0}'.format(table)
+
+
+def analytics_engine():
+    "The read replica's engine if one is configured, else the primary's."
+    if replica.REPLICA in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        return db.get_engine(current_app, bind=replica.REPLICA)
+    return db.engine
+
+
+def columns(table):
+    "The exported columns of `table`."
+    excluded = EXCLUDED_COLUMNS.get(table, ())
+    return [c for c in db.metadata.tables[table].columns
+            if c.name not in excluded]
+
+
+def arrow_schema(table):
+    "The pyarrow schema of `table`'s exported columns."
+    import pyarrow as pa
+    arrow_types = {
+        'int': pa.int64(),
+        'str': pa.string(),
+        'unicode': pa.string(),
+        'bool': pa.bool_(),
+        'date': pa.date32(),
+        'datetime': pa.timestamp('us'),
+    }
+    return pa.schema([pa.field(c.name,
+                               arrow_types[c.type.python_type.__name__])
+                      for c in columns(table)])
+
+
+def snapshot_horizon(engine):
+    """The watermark a snapshot taken now would have, from a connection
+    that is closed again at once."""
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        horizon = cursor.fetchone()[0]
+        cursor.close()
+        connection.rollback()
+    finally:
+        connection.close()
+    return horizon
+
+
+def open_snapshot(engine):
+    """A raw connection in a read-only REPEATABLE READ transaction, and the
+    watermark of its snapshot."""
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ '
+                   'READ ONLY')
+    cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+    horizon = cursor.fetchone()[0]
+    cursor.close()
+    return (connection, horizon)
+
+
+def write_table(connection, table, sink, since=None, batch_rows=BATCH_ROWS):
+    """Writes `table`, or only its rows written since the watermark `since`,
+    as Parquet to `sink` (a path or a writable file).
+
+    A generator: yields the number of rows written so far after each batch,
+    and once more when the file is complete."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = arrow_schema(table)
+    sql = 'SELECT {0} FROM {1}'.format(
+        ', '.join('"{0}"'.format(c.name) for c in columns(table)), table)
+    params = {}
+    if since is not None:
+        # Transaction IDs in rows are 32 bits and wrap around, so compare
+        # them modulo 2**32, as PostgreSQL does
+        sql += ' WHERE (xmin::text::bigint - %(since)s + 4294967296) ' \
+               '%% 4294967296 < 2147483648'
+        params['since'] = since % 2 ** 32
+    cursor = connection.cursor(name='export_{0}'.format(table))
+    writer = pq.ParquetWriter(sink, schema, compression=COMPRESSION)
+    rows = 0
+    try:
+        cursor.execute(sql, params)
+        while True:
+            batch = cursor.fetchmany(batch_rows)
+            if not batch:
+                break
+            values = list(zip(*batch))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(v, type=f.type) for (v, f) in zip(values, schema)],
+                schema=schema))
+            rows += len(batch)
+            yield rows
+    finally:
+        writer.close()
+        cursor.close()
+    yield rows
+
+
+def export_all(directory, incremental=False, tables=TABLES,
+               batch_rows=BATCH_ROWS, engine=None):
+    """Exports `tables` to <directory>/<table>/<timestamp>-full.parquet, or
+    with `incremental` to ...-since-<watermark>.parquet (a full export for a
+    table never exported before); returns the rows exported per table."""
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+    (connection, horizon) = open_snapshot(engine or analytics_engine())
+    counts = {}
+    try:
+        for table in tables:
+            since = None
+            if incremental:
+                since = GithubQueryLog.last_cursor(
+                    watermark_query_type(table))
+                since = since and int(since)
+            path = os.path.join(directory, table, '{0}-{1}.parquet'.format(
+                stamp, 'full' if since is None else
+                'since-{0}'.format(since)))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            rows = 0
+            for rows in write_table(connection, table, path, since,
+                                    batch_rows):
+                pass
+            counts[table] = rows
+    finally:
+        connection.rollback()
+        connection.close()
+    for table in tables:
+        GithubQueryLog.log(watermark_query_type(table), cursor=str(horizon))
+    db.session.commit()
+    return counts
+
+
+class _Pieces(object):
+    "A write-only file whose contents are taken away as they are written."
+
+    closed = False
+
+    def __init__(self):
+        self._pieces = []
+        self._position = 0
+
+    def write(self, data):
+        self._pieces.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        "Everything written since the last call."
+        (pieces, self._pieces) = (self._pieces, [])
+        return b''.join(pieces)
+
+
+def stream_table(table, since=None, batch_rows=BATCH_ROWS, engine=None):
+    """Exports `table` as `write_table` does, as it is read.
+
+    Returns the export's watermark, to pass as `since` next time, and a
+    generator of the Parquet file's bytes.  The snapshot is only opened
+    once the generator is first advanced, and closed when it finishes or is
+    closed, so a response that is never sent (a HEAD request, say) or is
+    abandoned holds no connection.  The watermark is read beforehand, so it
+    can be no later than the snapshot's; the next export may repeat a few
+    rows but misses none."""
+    engine = engine or analytics_engine()
+    horizon = snapshot_horizon(engine)
+
+    def pieces():
+        (connection, _) = open_snapshot(engine)
+        sink = _Pieces()
+        try:
+            for _ in write_table(connection, table, sink, since, batch_rows):
+                data = sink.take()
+                if data:
+                    yield data
+        finally:
+            connection.rollback()
+            connection.close()
+
+    return (horizon, pieces())
@@ -0,0 +1,463 @@
+"""Ingestion as durable jobs in PostgreSQL, run by any number of workers.
+
+`update_db_from_github` does a whole sync serially, in whichever process
+calls it.  Here the same work is split into small jobs (one page of a repo's
+issues, its new issue events, one month's authors, one author's team file)
+stored in the `job` table.  `manage.py worker` processes, on any node, claim
+jobs with SELECT ... FOR UPDATE SKIP LOCKED, so each job runs once at a time
+however many workers poll, and retry failed jobs with exponential backoff.
+Enqueueing a job identical to one already pending does nothing.
+
+    jobs.enqueue('sync', refresh_seconds=0)
+    jobs.work('worker-1', burst=True)
+
+A handler's writes commit together with its job's completion, and roll back
+with its failure.  The same queue dispatches the site rebuilds requested
+from /manage/ (`request_rebuild`).
+"""
+import json
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+from flask import current_app
+from . import models, partitions
+from .models import Author, DutyStation, GithubQueryLog, Issue, Month
+from .models import Event, Milestone, ReviewStage, db
+from lib import metrics, resilience
+from lib.git_parse import GH_DATE_FORMAT, GitHubError, github_for
+
+JOB_SECONDS = metrics.histogram(
+    'job_seconds', 'Duration of ingestion jobs', ('kind', 'outcome'))
+REBUILD_REQUESTS = metrics.counter(
+    'rebuild_requests_total', 'Site rebuild requests, queued or merged into '
+    'one already queued', ('server', 'outcome'))
+
+# Handler of each kind of job, by kind
+HANDLERS = {}
+
+
+def handler(kind):
+    "Registers the decorated function as the handler of jobs of `kind`."
+    def register(f):
+        HANDLERS[kind] = f
+        return f
+    return register
+
+
+def advisory_lock(name):
+    """Holds the transaction-scoped advisory lock `name` until the job
+    commits, so jobs that create shared rows (authors, labels, teams) don't
+    race each other into duplicates."""
+    db.session.execute('SELECT pg_advisory_xact_lock(hashtext(:name))',
+                       {'name': name})
+
+
+def _args(args):
+    return json.dumps(args, sort_keys=True, separators=(',', ':'))
+
+
+def _insert(kind, delay_seconds, args):
+    "Id of the pending job added, or None if an identical one was pending."
+    if kind not in HANDLERS:
+        raise ValueError('No handler for jobs of kind {0!r}'.format(kind))
+    return db.session.execute("""
+        INSERT INTO job (kind, args, state, attempts, run_after)
+        VALUES (:kind, :args, 'pending', 0,
+                now() + :delay * interval '1 second')
+        ON CONFLICT (kind, args) WHERE state = 'pending' DO NOTHING
+        RETURNING id""", {'kind': kind, 'args': _args(args),
+                          'delay': delay_seconds}).scalar()
+
+
+def enqueue(kind, delay_seconds=0, **args):
+    """Adds a pending job, unless an identical one is pending already.
+
+    Joins the caller's transaction; returns True if a job was added."""
+    return _insert(kind, delay_seconds, args) is not None
+
+
+def submit(kind, delay_seconds=0, **args):
+    """Like `enqueue`, but returns (id, added): the id of the pending job,
+    and False if it is an identical one that was already pending."""
+    while True:
+        job_id = _insert(kind, delay_seconds, args)
+        if job_id is not None:
+            return (job_id, True)
+        job_id = db.session.execute("""
+            SELECT id FROM job
+            WHERE kind = :kind AND args = :args AND state = 'pending'""", {
+            'kind': kind, 'args': _args(args)}).scalar()
+        # Otherwise a worker claimed it in between, so try adding it again
+        if job_id is not None:
+            return (job_id, False)
+
+
+def in_progress(kind, **args):
+    "True if a pending or running `kind` job has all the given `args`."
+    return db.session.execute("""
+        SELECT EXISTS (SELECT 1 FROM job
+                       WHERE kind = :kind
+                         AND state IN ('pending', 'running')
+                         AND args::jsonb @> CAST(:args AS jsonb))""",
+                              {'kind': kind, 'args': _args(args)}).scalar()
+
+
+def claim(worker):
+    """Marks the next runnable job as running by `worker` and returns it
+    (id, kind, args, attempts), or None if there is none.  Jobs other
+    workers hold are skipped rather than waited for."""
+    job = db.session.execute("""
+        UPDATE job
+        SET state = 'running', attempts = attempts + 1,
+            started_at = now(), worker = :worker
+        WHERE id = (SELECT id FROM job
+                    WHERE state = 'pending' AND run_after <= now()
+                    ORDER BY run_after, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED)
+        RETURNING id, kind, args, attempts""", {'worker': worker}).first()
+    db.session.commit()
+    return job
+
+
+def _finish_or_retry(job, error, max_attempts, retry_seconds):
+    """Fails `job`, to be retried after an exponentially growing delay until
+    it has been attempted `max_attempts` times.  A job that an identical
+    pending one has superseded is not retried."""
+    state = db.session.execute("""
+        UPDATE job
+        SET state = CASE WHEN :retry AND NOT EXISTS (
+                             SELECT 1 FROM job p
+                             WHERE p.kind = job.kind AND p.args = job.args
+                               AND p.state = 'pending')
+                         THEN 'pending' ELSE 'failed' END,
+            run_after = now() + :delay * interval '1 second',
+            finished_at = now(), last_error = :error
+        WHERE id = :id
+        RETURNING state""", {
+        'id': job.id,
+        'retry': job.attempts < max_attempts,
+        'delay': retry_seconds * 2 ** (job.attempts - 1),
+        'error': error,
+    }).scalar()
+    db.session.commit()
+    return 'retried' if state == 'pending' else 'failed'
+
+
+def run_one(worker, max_attempts=5, retry_seconds=30):
+    """Claims and runs one job; returns its outcome ('done', 'retried' or
+    'failed'), or None if no job was ready."""
+    job = claim(worker)
+    if job is None:
+        return None
+    start = time.time()
+    try:
+        HANDLERS[job.kind](**json.loads(job.args))
+        db.session.execute("""
+            UPDATE job SET state = 'done', finished_at = now(),
+                           last_error = NULL
+            WHERE id = :id""", {'id': job.id})
+        db.session.commit()
+        outcome = 'done'
+    except Exception:
+        db.session.rollback()
+        outcome = _finish_or_retry(job, traceback.format_exc(),
+                                   max_attempts, retry_seconds)
+    JOB_SECONDS.observe(time.time() - start, kind=job.kind, outcome=outcome)
+    return outcome
+
+
+def requeue_stalled(stalled_seconds):
+    """Returns jobs running for over `stalled_seconds`, whose worker must
+    have died, to the queue.  Of identical stalled jobs only the latest is
+    requeued, and none if one is pending already; the rest fail."""
+    db.session.execute("""
+        WITH stalled AS (
+            SELECT id, kind, args FROM job
+            WHERE state = 'running'
+              AND started_at < now() - :seconds * interval '1 second'
+            FOR UPDATE),
+        requeued AS (
+            SELECT DISTINCT ON (kind, args) id FROM stalled s
+            WHERE NOT EXISTS (SELECT 1 FROM job p
+                              WHERE p.kind = s.kind AND p.args = s.args
+                                AND p.state = 'pending')
+            ORDER BY kind, args, id DESC)
+        UPDATE job
+        SET state = CASE WHEN id IN (SELECT id FROM requeued)
+                         THEN 'pending' ELSE 'failed' END,
+            run_after = now(),
+            last_error = 'Stalled on worker ' || COALESCE(worker, '?')
+        WHERE id IN (SELECT id FROM stalled)""",
+                       {'seconds': stalled_seconds})
+    db.session.commit()
+
+
+def prune(keep_days=7):
+    "Deletes jobs that finished successfully over `keep_days` days ago."
+    db.session.execute("""
+        DELETE FROM job
+        WHERE state = 'done'
+          AND finished_at < now() - :days * interval '1 day'""",
+                       {'days': keep_days})
+    db.session.commit()
+
+
+def default_worker_name():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def work(worker=None, burst=False, poll_seconds=5, housekeeping_seconds=60):
+    """Runs jobs until stopped, or with `burst` until none is ready.
+
+    Every `housekeeping_seconds`, stalled jobs are requeued and old finished
+    ones pruned; a failure there is logged and doesn't stop the worker.
+    Returns the number of jobs run."""
+    worker = worker or default_worker_name()
+    config = current_app.config
+    run = 0
+    last_housekeeping = 0
+    while True:
+        if time.time() - last_housekeeping > housekeeping_seconds:
+            try:
+                requeue_stalled(config.get('JOB_STALLED_SECONDS', 900))
+                prune()
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('Job queue housekeeping failed')
+            last_housekeeping = time.time()
+        outcome = run_one(worker, config.get('JOB_MAX_ATTEMPTS', 5),
+                          config.get('JOB_RETRY_SECONDS', 30))
+        if outcome:
+            run += 1
+        elif burst:
+            return run
+        else:
+            time.sleep(poll_seconds)
+
+
+def status():
+    """Queue depth and throughput, overall and per kind of job."""
+    by_kind = [dict(row) for row in db.session.execute("""
+        SELECT kind,
+               count(*) FILTER (WHERE state = 'pending') AS pending,
+               count(*) FILTER (WHERE state = 'pending'
+                                  AND run_after <= now()) AS ready,
+               count(*) FILTER (WHERE state = 'running') AS running,
+               count(*) FILTER (WHERE state = 'failed') AS failed,
+               count(*) FILTER (WHERE state = 'done'
+                                  AND finished_at > now() - interval '1 minute')
+                   AS done_last_minute,
+               count(*) FILTER (WHERE state = 'done'
+                                  AND finished_at > now() - interval '1 hour')
+                   AS done_last_hour,
+               extract(epoch FROM now() - min(created_at)
+                       FILTER (WHERE state = 'pending'))::float
+                   AS oldest_pending_seconds
+        FROM job
+        GROUP BY kind
+        ORDER BY kind""")]
+    totals = dict((key, sum(row[key] for row in by_kind))
+                  for key in ('pending', 'ready', 'running', 'failed',
+                              'done_last_minute', 'done_last_hour'))
+    ages = [row['oldest_pending_seconds'] for row in by_kind
+            if row['oldest_pending_seconds'] is not None]
+    totals['oldest_pending_seconds'] = max(ages) if ages else None
+    return {'totals': totals, 'by_kind': by_kind}
+
+
+def request_rebuild(server, window_seconds):
+    """Queues a dispatch of `server`'s site rebuild hook `window_seconds`
+    from now, into which requests for the same server until then are
+    merged; returns the dispatch's job id."""
+    (job_id, added) = submit('rebuild', window_seconds, server=server)
+    REBUILD_REQUESTS.inc(server=server,
+                         outcome='queued' if added else 'merged')
+    return job_id
+
+
+def rebuilds(job_id=None, limit=20):
+    """The latest rebuild dispatches, or just the one with `job_id`: each
+    one's server, status ('queued', 'sending', 'sent' or 'failed'), attempts,
+    seconds from request to outcome and of the last POST, and error."""
+    rows = db.session.execute("""
+        SELECT id, args::json->>'server' AS server,
+               CASE state WHEN 'pending' THEN 'queued'
+                          WHEN 'running' THEN 'sending'
+                          WHEN 'done' THEN 'sent'
+                          ELSE 'failed' END AS status,
+               attempts, created_at, run_after, finished_at,
+               CASE WHEN state IN ('done', 'failed') THEN
+                   extract(epoch FROM finished_at - created_at)::float
+               END AS latency_seconds,
+               CASE WHEN state IN ('done', 'failed') THEN
+                   extract(epoch FROM finished_at - started_at)::float
+               END AS dispatch_seconds,
+               last_error
+        FROM job
+        WHERE kind = 'rebuild' AND (CAST(:id AS integer) IS NULL OR id = :id)
+        ORDER BY id DESC
+        LIMIT :limit""", {'id': job_id, 'limit': limit})
+    result = []
+    for row in rows:
+        row = dict(row)
+        if row['last_error']:
+            # Only the exception, not the whole traceback
+            row['last_error'] = row['last_error'].strip().splitlines()[-1]
+        result.append(row)
+    return result
+
+
+# Job handlers.  Each does one small step of `update_db_from_github` and
+# enqueues the steps that follow from it.
+
+@handler('sync')
+def sync(refresh_seconds=0):
+    "Enqueues the refresh of every source older than `refresh_seconds`."
+    refresh_timedelta = timedelta(seconds=refresh_seconds)
+    enqueue('partitions')
+    enqueue('duty_stations')
+    last_query = GithubQueryLog.last_query_datetime('authors')
+    if (datetime.now() - last_query) > refresh_timedelta and \
+            not in_progress('authors'):
+        enqueue('authors')
+    for (api, since) in models.stale_issue_repos(refresh_timedelta):
+        if not in_progress('issue_page', repo=api.full_name):
+            enqueue('issue_page', repo=api.full_name,
+                    since=since.strftime(GH_DATE_FORMAT))
+
+
+@handler('partitions')
+def partition_housekeeping():
+    "Adds and retires monthly partitions of `event`; commits as it goes."
+    partitions.housekeeping()
+
+
+@handler('duty_stations')
+def duty_stations():
+    DutyStation.fill()
+
+
+@handler('authors')
+def authors():
+    """Upserts the 18F site's current authors, then enqueues each month's
+    authors and the team file diffs."""
+    response = resilience.get(models.SITE_AUTHORS_URL, 'site-api')
+    response.raise_for_status()
+    advisory_lock('authors')
+    for (username, author_data) in response.json().items():
+        db.session.add(Author.from_api_data(username, author_data))
+    for month in Month.needing_authors():
+        enqueue('month_authors', month=month.begin.isoformat())
+    for (api, _, _, _) in Author.team_file_sources():
+        enqueue('team_files', repo=api.full_name)
+    GithubQueryLog.log('authors')
+
+
+@handler('month_authors')
+def month_authors(month):
+    "Stores the authors listed in authors.yml as of `month` (YYYY-MM-DD)."
+    month = Month.get_or_create(datetime.strptime(month, '%Y-%m-%d').date())
+    authors = month.fetch_authors()
+    advisory_lock('authors')
+    month.add_authors(authors)
+    db.session.add(month)
+    GithubQueryLog.log('author_months')
+
+
+def _team_file_source(repo):
+    for source in Author.team_file_sources():
+        if source[0].full_name == repo:
+            return source
+    raise ValueError('{0} holds no team files'.format(repo))
+
+
+@handler('team_files')
+def team_files(repo):
+    "Enqueues a read of each team file in `repo` that changed."
+    source = _team_file_source(repo)
+    (api, _, path, _) = source
+    shas = api.tree_shas(path.split('{')[0])
+    if shas is False:
+        raise GitHubError('Fetching the tree of {0} failed'.format(repo))
+    for (author, sha) in Author.changed_team_files(Author.query.all(), source,
+                                                   shas):
+        enqueue('author_file', repo=repo, username=author.username, sha=sha)
+
+
+@handler('author_file')
+def author_file(repo, username, sha):
+    """Reads one author's team file from `repo`; `sha` None if it was deleted.
+    Raises GitHubError, to be retried, if the file can't be fetched."""
+    source = _team_file_source(repo)
+    (api, _, path, _) = source
+    author = Author.query.filter_by(username=username).first()
+    if author is None:
+        return
+    data = {}
+    if sha is not None:
+        data = api.yaml(path.format(username), 1, None)
+        if data is None:
+            raise GitHubError('Fetching {0} from {1} failed'.format(
+                path.format(username), repo))
+    advisory_lock('teams')
+    author.apply_team_file(source, sha, data)
+
+
+@handler('issue_page')
+def issue_page(repo, since, seen=()):
+    """Upserts one page of `repo`'s issues and enqueues the next page; after
+    the last page, logs the repo's watermark and enqueues its new events."""
+    (page, next_since) = github_for(repo).issue_page(since, set(seen))
+    advisory_lock('labels')
+    for issue_data in page:
+        Issue.upsert_from_gh_data(issue_data, repo)
+    if page:
+        enqueue('issue_page', repo=repo, since=next_since,
+                seen=sorted(i.number for i in page))
+    else:
+        GithubQueryLog.log(Issue.watermark(repo))
+        enqueue('repo_events', repo=repo)
+
+
+@handler('repo_events')
+def repo_events(repo):
+    """Stores the events added to `repo`'s issues since the last run, from
+    its issue event feed.  Each page commits as it is stored; one stored
+    before a failure is skipped when the job is retried."""
+    Issue.fetch_events(github_for(repo))
+
+
+@handler('issue_events')
+def issue_events(repo, number):
+    """Replaces one issue's events, milestones and review timeline, for
+    repairing an issue the event feed has left wrong."""
+    issue = Issue.query.filter_by(repo=repo, number=number).first()
+    if issue is None:
+        return
+    events = issue.api.fetch_issue_events(number)
+    if events is False:
+        raise GitHubError('Fetching events of {0}#{1} failed'.format(
+            repo, number))
+    issue.milestones = [Milestone.from_gh_data(e) for e in events
+                        if e['event'] == 'milestoned']
+    issue.events = [Event.from_gh_data(e) for e in events]
+    db.session.flush()
+    ReviewStage.refresh([issue.id])
+
+
+# Not part of ingestion: site rebuilds requested from /manage/
+
+@handler('rebuild')
+def rebuild(server):
+    "POSTs to the build hook of `server` (a key of REBUILD_HOOKS)."
+    url = current_app.config.get('REBUILD_HOOKS', {}).get(server)
+    if not url:
+        raise ValueError('No build hook for {0!r}'.format(server))
+    response = resilience.request(
+        'POST', url, 'rebuild',
+        data=json.dumps({'ref': 'refs/heads/{0}'.format(server)}),
+        headers={'Content-type': 'application/json', 'Accept': 'text/plain'})
+    response.raise_for_status()
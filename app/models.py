@@ -1,20 +1,76 @@
 import calendar
-import requests
+import json
+import threading
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+import time
+from contextlib import contextmanager
 from functools import total_ordering
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import yaml
-from . import db
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.engine import Engine
+from . import db, partitions
+from lib import metrics, resilience
 from lib.utils import to_py_date
 from lib.git_parse import drafts_api, site_api, hub_api
+from lib.git_parse import GitHubError, github_for, _latest_update
+
+SITE_AUTHORS_URL = 'https://18f.gsa.gov/api/data/authors.json'
+
+SYNC_PHASE_SECONDS = metrics.histogram(
+    'sync_phase_seconds', 'Duration of each update_db_from_github phase',
+    ('phase', 'outcome'))
+ISSUE_REPO_FAILURES = metrics.counter(
+    'issue_repo_sync_failures_total',
+    'Issue syncs of one repository that failed', ('repo', ))
+SQL_SECONDS = metrics.histogram(
+    'sql_statement_seconds', 'Duration of SQL statements by operation',
+    ('operation', ))
+
+
+# Statement start times, by cursor; a failed statement's is dropped when it
+# fails rather than left for the next statement to pop
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement_timer(conn, cursor, statement, *args):
+    conn.info.setdefault('statement_started', {})[id(cursor)] = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement_time(conn, cursor, statement, *args):
+    started = conn.info.get('statement_started', {}).pop(id(cursor), None)
+    if started is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper()
+    SQL_SECONDS.observe(time.time() - started, operation=operation)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_statement_timer(context):
+    if context.connection is not None and \
+            context.execution_context is not None:
+        context.connection.info.get('statement_started', {}).pop(
+            id(context.execution_context.cursor), None)
 
 author_months = db.Table(
     'author_months',
     db.Column('month_begin', db.Date(), db.ForeignKey('month.begin')),
     db.Column('author_id', db.Integer, db.ForeignKey('author.id')))
 
+# Month.author_matrix results, keyed by (author_months sync time, start, end)
+_author_matrix_cache = {}
+_author_matrix_lock = threading.Lock()
+AUTHOR_MATRIX_CACHE_SIZE = 16
+
 
 @total_ordering
 class Month(db.Model):
+    FIRST_MONTH_OF_BLOG = date(2014, 3, 1)
+
     begin = db.Column(db.Date(), primary_key=True)
     authors = db.relationship('Author',
                               secondary=author_months,
@@ -41,7 +97,8 @@ class Month(db.Model):
         return date(self.begin.year, self.begin.month, last_day)
 
     def author_list_is_complete(self):
-        GithubQueryLog.last_query_datetime('authors').date() > self.end()
+        last_sync = GithubQueryLog.last_query_datetime('authors')
+        return last_sync.date() > self.end()
 
     def __eq__(self, other):
         return self.begin == other.begin
@@ -63,19 +120,107 @@ class Month(db.Model):
         return authors or {}
 
     @classmethod
-    def create_missing(cls):
-        "Populate DB with all months up to today, including their authors."
-        FIRST_MONTH_OF_BLOG = date(2014, 3, 1)
-        month = cls.get_or_create(FIRST_MONTH_OF_BLOG)
+    def needing_authors(cls):
+        """All months up to today whose author lists should be (re)fetched,
+        less those an interrupted sync already stored."""
+        stored = set(GithubQueryLog.checkpoint('author_months') or ())
+        months = []
+        month = cls.get_or_create(cls.FIRST_MONTH_OF_BLOG)
         while month.begin <= date.today():
             db.session.add(month)
-            if (not month.authors) or (not month.author_list_is_complete()):
-                for (username, author_data) in month.fetch_authors().items():
-                    month.authors.add(Author.from_api_data(username,
-                                                           author_data))
+            if month.begin.isoformat() not in stored and \
+                    not (month.authors and month.author_list_is_complete()):
+                months.append(month)
             month = month.next()
+        return months
+
+    def add_authors(self, authors):
+        "Adds authors from an authors.yml mapping of username to details."
+        for (username, author_data) in authors.items():
+            self.authors.add(Author.from_api_data(username, author_data))
+
+    def store_authors(self, authors):
+        """`add_authors`, then commits, checkpointing this month as stored
+        until 'author_months' is next logged."""
+        self.add_authors(authors)
+        db.session.add(self)
+        stored = set(GithubQueryLog.checkpoint('author_months') or ())
+        stored.add(self.begin.isoformat())
+        GithubQueryLog.save_checkpoint('author_months', sorted(stored))
         db.session.commit()
 
+    @classmethod
+    def create_missing(cls):
+        """Populate DB with all months up to today, including their authors;
+        each month is committed as its authors arrive."""
+        for month in cls.needing_authors():
+            month.store_authors(month.fetch_authors())
+
+    @classmethod
+    def author_matrix(cls, start=None, end=None):
+        """Which authors were listed in which months, from one query.
+
+        Args:
+            start, end: first days of the first and last months to include
+                (default: the blog's first month, and this month)
+
+        Returns a dict of parallel arrays: `months` (ISO dates of each
+        month's first day), `authors` (usernames), `membership` (for each
+        author, indexes into `months` of the months they were listed in),
+        `first_month` and `last_month` (each author's first and last listed
+        month over all time, not just the requested range) and
+        `author_counts` (authors listed in each month).  Results are cached
+        until the next author sync, for up to AUTHOR_MATRIX_CACHE_SIZE
+        ranges."""
+        start = start or cls.FIRST_MONTH_OF_BLOG
+        end = end or date.today().replace(day=1)
+        synced_at = GithubQueryLog.last_query_datetime('author_months')
+        key = (synced_at, start, end)
+        with _author_matrix_lock:
+            if key in _author_matrix_cache:
+                return _author_matrix_cache[key]
+        # Queried unlocked, so other ranges are served meanwhile
+        matrix = cls._query_author_matrix(start, end)
+        with _author_matrix_lock:
+            if (len(_author_matrix_cache) >= AUTHOR_MATRIX_CACHE_SIZE or
+                    any(k[0] != synced_at for k in _author_matrix_cache)):
+                _author_matrix_cache.clear()
+            _author_matrix_cache[key] = matrix
+        return matrix
+
+    @classmethod
+    def _query_author_matrix(cls, start, end):
+        months = []
+        month = start
+        while month <= end:
+            months.append(month)
+            month = date(month.year + month.month // 12,
+                         month.month % 12 + 1, 1)
+        index = dict((m, n) for (n, m) in enumerate(months))
+        rows = db.session.execute("""
+            SELECT a.username,
+                   array_agg(am.month_begin ORDER BY am.month_begin)
+                       FILTER (WHERE am.month_begin BETWEEN :start AND :end)
+                       AS months,
+                   min(am.month_begin) AS first_month,
+                   max(am.month_begin) AS last_month
+            FROM author_months am
+            JOIN author a ON a.id = am.author_id
+            GROUP BY a.username
+            ORDER BY a.username""", {'start': start, 'end': end})
+        matrix = {'months': [m.isoformat() for m in months], 'authors': [],
+                  'membership': [], 'first_month': [], 'last_month': [],
+                  'author_counts': [0] * len(months)}
+        for row in rows:
+            listed = [index[m] for m in (row.months or []) if m in index]
+            for n in listed:
+                matrix['author_counts'][n] += 1
+            matrix['authors'].append(row.username)
+            matrix['membership'].append(listed)
+            matrix['first_month'].append(row.first_month.isoformat())
+            matrix['last_month'].append(row.last_month.isoformat())
+        return matrix
+
     def __eq__(self, other):
         return self.begin == other.begin
 
@@ -104,14 +249,45 @@ class DutyStation(db.Model):
     timezone = db.Column(db.Text, nullable=False)
     authors = db.relationship('Author', collection_class=set, backref='duty_station')
 
+    LOCATIONS_PATH = '_data/locations.yml'
+
     @classmethod
     def fill(cls):
-        data = hub_api.yaml('_data/locations.yml', 1)
-        for d in data:
-            if not cls.query.get(d['code']):
-                d['airport_code'] = d.pop('code')
-                d['name'] = d.pop('label')
-                db.session.add(cls(**d))
+        """Brings stations in line with hub's locations.yml.
+
+        Does nothing if the file's blob SHA matches the one recorded by the
+        last fill.  Otherwise upserts every location in one statement and
+        deletes stations no longer listed, clearing them from authors."""
+        sha = hub_api.blob_sha(cls.LOCATIONS_PATH)
+        if sha and sha == GithubQueryLog.last_cursor('locations'):
+            return
+        data = hub_api.yaml(cls.LOCATIONS_PATH, 1)
+        if not data:
+            return
+        rows = [{'airport_code': d['code'],
+                 'name': d['label'],
+                 'latitude': d['latitude'],
+                 'longitude': d['longitude'],
+                 'timezone': d['timezone']} for d in data]
+        db.session.execute("""
+            INSERT INTO duty_station
+                (airport_code, name, latitude, longitude, timezone)
+            SELECT airport_code, name, latitude, longitude, timezone
+            FROM json_to_recordset(:rows) AS r(airport_code text, name text,
+                                               latitude float,
+                                               longitude float, timezone text)
+            ON CONFLICT (airport_code) DO UPDATE
+            SET name = EXCLUDED.name, latitude = EXCLUDED.latitude,
+                longitude = EXCLUDED.longitude, timezone = EXCLUDED.timezone
+            """, {'rows': json.dumps(rows)})
+        codes = [row['airport_code'] for row in rows]
+        db.session.execute(
+            'UPDATE author SET airport_code = NULL '
+            'WHERE airport_code <> ALL(:codes)', {'codes': codes})
+        db.session.execute(
+            'DELETE FROM duty_station WHERE airport_code <> ALL(:codes)',
+            {'codes': codes})
+        GithubQueryLog.log('locations', cursor=sha or None)
         db.session.commit()
 
 
@@ -126,25 +302,100 @@ class Author(db.Model):
     airport_code = db.Column(db.String(),
                              db.ForeignKey('duty_station.airport_code'))
     team_id = db.Column(db.Integer(), db.ForeignKey('team.id'))
+    # Blob SHAs of the hub and 18F site team files last read by `enrich`
+    hub_blob_sha = db.Column(db.String(), nullable=True)
+    site_blob_sha = db.Column(db.String(), nullable=True)
+
+    HUB_TEAM_DIR = '_data/team/'
+    SITE_TEAM_DIR = '_team/'
+    # Team file SHA given when a truncated listing left it unknown
+    UNKNOWN_SHA = ''
 
-    def __init__(self, *arg, **kwarg):
-        super(Author, self).__init__(*arg, **kwarg)
-        self.lookup_duty_station()
-        self.lookup_team()
+    def lookup_duty_station(self, data=None):
+        """Query Hub for an author's airport code
 
-    def lookup_duty_station(self):
-        "Query Hub for an author's airport code"
-        data = hub_api.yaml('_data/team/{0}.yml'.format(self.username), 1)
+        `data`, if given, is the already-parsed team file to use instead."""
+        if data is None:
+            data = hub_api.yaml('{0}{1}.yml'.format(self.HUB_TEAM_DIR,
+                                                    self.username), 1)
         self.airport_code = data.get('location')
 
-    def lookup_team(self):
-        "Query 18F website for an author's team in 18F"
-        data = site_api.yaml('_team/{0}.md'.format(self.username), 1)
+    def lookup_team(self, data=None):
+        """Query 18F website for an author's team in 18F
+
+        `data`, if given, is the already-parsed front matter to use instead."""
+        if data is None:
+            data = site_api.yaml('{0}{1}.md'.format(self.SITE_TEAM_DIR,
+                                                    self.username), 1)
         team_name = data.get('team')
         if team_name:
             team = Team.query.filter_by(name=team_name).first() or Team(name=team_name)
             db.session.add(team)
             self.team = team
+        else:
+            self.team = None
+
+    @classmethod
+    def team_file_sources(cls):
+        """(client, SHA column, path template, lookup method) for each repo
+        holding per-author team files."""
+        return (
+            (hub_api, 'hub_blob_sha', cls.HUB_TEAM_DIR + '{0}.yml',
+             cls.lookup_duty_station),
+            (site_api, 'site_blob_sha', cls.SITE_TEAM_DIR + '{0}.md',
+             cls.lookup_team),
+        )
+
+    @classmethod
+    def changed_team_files(cls, authors, source, shas):
+        """Yields (author, new SHA) for each author whose team file in
+        `source` has a blob SHA other than the stored one; the new SHA is
+        None if the file was deleted.  If `shas` is None (the listing was
+        truncated) every author is yielded, with the SHA UNKNOWN_SHA."""
+        (api, sha_field, path, lookup) = source
+        for author in authors:
+            if shas is None:
+                yield (author, cls.UNKNOWN_SHA)
+                continue
+            sha = shas.get(path.format(author.username))
+            if sha != getattr(author, sha_field):
+                yield (author, sha)
+
+    def apply_team_file(self, source, sha, data):
+        """Applies `data`, read from this author's team file in `source` at
+        blob `sha`, and records the SHA; UNKNOWN_SHA keeps the stored one.
+        A deleted file (`sha` None, `data` {}) clears what it provided."""
+        (api, sha_field, path, lookup) = source
+        lookup(self, data)
+        if sha != self.UNKNOWN_SHA:
+            setattr(self, sha_field, sha)
+        db.session.add(self)
+
+    @classmethod
+    def enrich(cls):
+        """Re-reads the hub and 18F site team files that changed.
+
+        Fetches each repo's team directory listing once and compares each
+        author's file blob SHA with the one stored at the last read; only
+        added, changed or deleted files are fetched and parsed.  A file
+        that can't be fetched keeps the author's data and stored SHA, so it
+        is read again next run.  If a listing can't be fetched, that source
+        is left as it is until the next run; if it was truncated, every
+        file is read."""
+        authors = cls.query.all()
+        for source in cls.team_file_sources():
+            (api, sha_field, path, lookup) = source
+            shas = api.tree_shas(path.split('{')[0])
+            if shas is False:
+                continue
+            for (author, sha) in cls.changed_team_files(authors, source,
+                                                        shas):
+                data = {}
+                if sha is not None:
+                    data = api.yaml(path.format(author.username), 1, None)
+                    if data is None:
+                        continue
+                author.apply_team_file(source, sha, data)
 
     @classmethod
     def from_api_data(cls, username, dct):
@@ -161,11 +412,14 @@ class Author(db.Model):
     def fetch(cls):
         "Query 18F website API, creating Author instances for each blog author"
         Month.create_missing()
-        response = requests.get('https://18f.gsa.gov/api/data/authors.json')
+        response = resilience.get(SITE_AUTHORS_URL, 'site-api')
         for (username, author_data) in response.json().items():
             author = cls.from_api_data(username, author_data)
             db.session.add(author)
+        db.session.flush()
+        cls.enrich()
         GithubQueryLog.log('authors')
+        GithubQueryLog.log('author_months')
         db.session.commit()
 
 
@@ -173,6 +427,8 @@ class GithubQueryLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     query_type = db.Column(db.String(), unique=True, nullable=False)
     queried_at = db.Column(db.DateTime(), default=datetime.now)
+    # Where the last query got to, e.g. a blob SHA; meaning is per query_type
+    cursor = db.Column(db.String(), nullable=True)
 
     @classmethod
     def last_query_datetime(cls, query_type):
@@ -183,14 +439,42 @@ class GithubQueryLog(db.Model):
             return datetime.fromtimestamp(0)
 
     @classmethod
-    def log(cls, query_type):
+    def last_cursor(cls, query_type):
+        qlog = cls.query.filter_by(query_type=query_type).first()
+        return qlog and qlog.cursor
+
+    @classmethod
+    def log(cls, query_type, cursor=None):
         qlog = cls.query.filter_by(query_type=query_type).first()
         if qlog:
             qlog.queried_at = datetime.now()
         else:
             qlog = cls(query_type=query_type, queried_at=datetime.now())
+        if cursor is not None:
+            qlog.cursor = cursor
         db.session.add(qlog)
 
+    @staticmethod
+    def _checkpoint_type(query_type):
+        return '{0}:checkpoint'.format(query_type)
+
+    @classmethod
+    def checkpoint(cls, query_type):
+        """The value last passed to `save_checkpoint` for `query_type`, or
+        None if `query_type` has been logged since: the run that saved it
+        finished."""
+        qlog = cls.query.filter_by(
+            query_type=cls._checkpoint_type(query_type)).first()
+        if qlog and qlog.cursor and \
+                qlog.queried_at > cls.last_query_datetime(query_type):
+            return json.loads(qlog.cursor)
+
+    @classmethod
+    def save_checkpoint(cls, query_type, value):
+        """Records how far a run of `query_type` has got, as JSON, so a run
+        interrupted before it logs `query_type` can resume from there."""
+        cls.log(cls._checkpoint_type(query_type), cursor=json.dumps(value))
+
 
 labels_issues = db.Table(
     'labels_issues',
@@ -207,18 +491,45 @@ class Label(db.Model):
     @classmethod
     def get_or_create(cls, label_data):
         label = cls.query.filter_by(name=label_data['name']).first() \
-                or cls(**label_data)
+                or cls(name=label_data['name'],
+                       url=label_data.get('url'),
+                       color=label_data.get('color'))
         return label
 
 
 class Event(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    # Partitioned by month of created_at (see app/partitions.py), which may
+    # be NULL, so no primary key can be declared: GitHub's event ids are
+    # indexed, and are the key only as far as the ORM is concerned
+    __table_args__ = (
+        db.Index('event_id_idx', 'id'),
+        db.Index('event_issue_id_idx', 'issue_id'),
+    )
+    id = db.Column(db.Integer, nullable=False, autoincrement=False)
     commit_id = db.Column(db.Integer)
     url = db.Column(db.String())
     actor = db.Column(db.String())
     event = db.Column(db.String())
     created_at = db.Column(db.Date())
     issue_id = db.Column(db.Integer, db.ForeignKey('issue.id'))
+    __mapper_args__ = {'primary_key': [id]}
+
+    @classmethod
+    def weekly_activity(cls, weeks=6):
+        """Events per week and kind over the last `weeks` weeks.
+
+        The start date is bound as a literal, so only the partitions of
+        those weeks' months are scanned (see app/partitions.py)."""
+        return [dict(row) for row in db.session.execute("""
+            SELECT date_trunc('week', created_at)::date AS week,
+                   event,
+                   count(*) AS events
+            FROM event
+            WHERE created_at >= :since
+            GROUP BY 1, 2
+            ORDER BY week DESC, events DESC""", {
+            'since': date.today() - timedelta(weeks=weeks),
+        })]
 
     @classmethod
     def from_gh_data(cls, event_data):
@@ -252,12 +563,14 @@ class Milestone(db.Model):
 
 
 class Issue(db.Model):
+    __table_args__ = (db.UniqueConstraint('repo', 'number'), )
     id = db.Column(db.Integer, primary_key=True)
+    repo = db.Column(db.String(), nullable=False)  # 'owner/repo'
     number = db.Column(db.Integer)
     title = db.Column(db.String())
     body = db.Column(db.String())
     state = db.Column(db.String())
-    # user = db.Column(db.String())
+    user = db.Column(db.String(), nullable=True)  # github login
     comments = db.Column(db.String())
     locked = db.Column(db.Boolean)
     # assignee
@@ -269,6 +582,8 @@ class Issue(db.Model):
     created_at = db.Column(db.Date(), default=date.today)
     updated_at = db.Column(db.Date(), default=date.today)
     closed_at = db.Column(db.Date(), nullable=True)
+    # Maintained by the issue_search_vector_update trigger; see `search`
+    search_vector = db.deferred(db.Column(TSVECTOR, nullable=True))
     labels = db.relationship('Label',
                              secondary=labels_issues,
                              backref=db.backref('issues',
@@ -276,23 +591,18 @@ class Issue(db.Model):
     milestones = db.relationship('Milestone', cascade='all, delete-orphan')
     events = db.relationship('Event', cascade='all, delete-orphan')
 
-    @classmethod
-    def from_gh_data(cls, issue_data):
-        """Given dict of issue data fetched from GitHub API, return instance.
-
-        If the issue already exists, delete it (and its milestones)
-        and replace it."""
-        issue = cls.query.filter_by(number=issue_data.get('number')).first()
-        if issue:
-            db.session.delete(issue)
-        db.session.commit()
-        insertable = {
+    @staticmethod
+    def _fields_from_gh_data(issue_data):
+        "Column values for an issue, from a dict fetched from GitHub."
+        return {
             'id': issue_data.get('id'),
             'number': issue_data.get('number'),
             'title': issue_data.get('title'),
             'state': issue_data.get('state'),
+            'user': (issue_data.get('user') or {}).get('login'),
             'body': issue_data.get('body'),
             'locked': issue_data.get('locked'),
+            'comments': issue_data.get('comments'),
             'url': issue_data.get('url'),
             'labels_url': issue_data.get('labels_url'),
             'html_url': issue_data.get('html_url'),
@@ -301,7 +611,40 @@ class Issue(db.Model):
             'created_at': to_py_date(issue_data['created_at']),
             'closed_at': to_py_date(issue_data['closed_at']),
         }
-        issue = cls(**insertable)
+
+    @staticmethod
+    def watermark(repo):
+        "`GithubQueryLog` type recording when `repo`'s issues were synced."
+        return 'issues:{0}'.format(repo)
+
+    @staticmethod
+    def events_watermark(repo):
+        """`GithubQueryLog` type whose cursor is the id of the newest event
+        of `repo`'s issue event feed stored."""
+        return 'issue-events:{0}'.format(repo)
+
+    @classmethod
+    def last_event_id(cls, repo):
+        cursor = GithubQueryLog.last_cursor(cls.events_watermark(repo))
+        return int(cursor) if cursor else 0
+
+    @property
+    def api(self):
+        "The `GitHub` client of this issue's repository."
+        return github_for(self.repo)
+
+    @classmethod
+    def from_gh_data(cls, issue_data, repo=drafts_api.full_name):
+        """Given dict of issue data fetched from GitHub API, return instance.
+
+        If the issue already exists, delete it (and its milestones)
+        and replace it."""
+        issue = cls.query.filter_by(repo=repo,
+                                    number=issue_data.get('number')).first()
+        if issue:
+            db.session.delete(issue)
+        db.session.commit()
+        issue = cls(repo=repo, **cls._fields_from_gh_data(issue_data))
         for label_data in issue_data['labels']:
             issue.labels.append(Label.get_or_create(label_data))
         db.session.add(issue)
@@ -309,31 +652,543 @@ class Issue(db.Model):
         return issue
 
     @classmethod
-    def fetch(cls, since):
-        issues = drafts_api.fetch_issues(since=since)
-        for issue_data in issues:
-            issue = cls.from_gh_data(issue_data)
-            milestones = drafts_api.fetch_milestone(issue.number)
-            for milestone_data in milestones:
-                issue.milestones.append(Milestone.from_gh_data(milestone_data))
-            events = drafts_api.fetch_issue_events(issue.number)
-            for event_data in events:
-                issue.events.append(Event.from_gh_data(event_data))
-        GithubQueryLog.log('issues')
+    def upsert_from_gh_data(cls, issue_data, repo=drafts_api.full_name):
+        """Given dict of issue data, update the stored issue in place.
+
+        Unlike `from_gh_data`, the issue's events and milestones are kept.
+        Creates the issue if it is not stored yet."""
+        fields = cls._fields_from_gh_data(issue_data)
+        issue = cls.query.filter_by(repo=repo,
+                                    number=fields['number']).first()
+        if issue:
+            for (field, value) in fields.items():
+                setattr(issue, field, value)
+        else:
+            issue = cls(repo=repo, **fields)
+        issue.labels = [Label.get_or_create(label_data)
+                        for label_data in issue_data['labels']]
+        db.session.add(issue)
+        return issue
+
+    @classmethod
+    def search(cls, query, labels=(), state=None, limit=50):
+        """Full-text search over issue titles and bodies.
+
+        Returns dicts of issue fields, best match first, each with a `rank`
+        and a `snippet` of the body with matches wrapped in <mark>.  Only
+        issues with one of `labels` (if given) and in `state` (if given)
+        are returned."""
+        if not query.strip():
+            return []
+        return [dict(row) for row in db.session.execute("""
+            SELECT id, repo, number, title, state, html_url, updated_at, rank,
+                   ts_headline('english', COALESCE(body, ''), q,
+                               'StartSel=<mark>, StopSel=</mark>, '
+                               'MaxFragments=2, MaxWords=30') AS snippet
+            FROM (SELECT i.*, ts_rank_cd(i.search_vector, q) AS rank, q
+                  FROM issue i, plainto_tsquery('english', :query) q
+                  WHERE i.search_vector @@ q
+                    AND (:state IS NULL OR i.state = :state)
+                    AND (:any_label OR EXISTS (
+                        SELECT 1 FROM labels_issues li
+                        JOIN label l ON l.id = li.label_id
+                        WHERE li.issue_id = i.id AND l.name = ANY(:labels)))
+                  ORDER BY rank DESC, i.updated_at DESC
+                  LIMIT :limit) matches
+            ORDER BY rank DESC, updated_at DESC""", {
+            'query': query,
+            'state': state or None,
+            'labels': list(labels),
+            'any_label': not labels,
+            'limit': limit,
+        })]
+
+    @classmethod
+    def listing(cls):
+        """Yields a dict per issue for the /issues/ page, latest update
+        first: its fields, `labels` (names) and `approved_at`, the date of
+        its latest milestone if that is "ready to approve".
+
+        Rows come from a server-side cursor as they are consumed, so the
+        issues are never all in memory at once."""
+        query = db.text("""
+            SELECT i.id, i.repo, i.number, i.title, i.html_url,
+                   i.created_at, i.updated_at,
+                   ARRAY(SELECT l.name
+                         FROM labels_issues li
+                         JOIN label l ON l.id = li.label_id
+                         WHERE li.issue_id = i.id
+                         ORDER BY l.id) AS labels,
+                   (SELECT CASE WHEN m.title = 'ready to approve'
+                                THEN m.created_at END
+                    FROM milestone m
+                    WHERE m.issue_id = i.id
+                    ORDER BY m.id DESC
+                    LIMIT 1) AS approved_at
+            FROM issue i
+            ORDER BY i.updated_at DESC, i.id DESC""")
+        connection = db.session.connection(clause=query)
+        for row in connection.execution_options(
+                stream_results=True).execute(query):
+            yield dict(row)
+
+    @classmethod
+    def store_page(cls, repo, page):
+        """Upserts the issues in `page` (issue dicts fetched from GitHub) in
+        one batch and one commit, keeping their events and milestones.  The
+        commit checkpoints `repo`'s sync after the page (see
+        `resume_point`)."""
+        fields = [cls._fields_from_gh_data(issue_data) for issue_data in page]
+        stored = dict((issue.number, issue) for issue in cls.query.filter(
+            cls.repo == repo, cls.number.in_([f['number'] for f in fields])))
+        issues = []
+        for (issue_data, issue_fields) in zip(page, fields):
+            issue = stored.get(issue_fields['number']) or cls(repo=repo)
+            for (field, value) in issue_fields.items():
+                setattr(issue, field, value)
+            issue.labels = [Label.get_or_create(label_data)
+                            for label_data in issue_data['labels']]
+            db.session.add(issue)
+            issues.append(issue)
+        if page:
+            GithubQueryLog.save_checkpoint(cls.watermark(repo), {
+                'since': _latest_update(page),
+                'seen': sorted(issue.number for issue in issues)})
+        db.session.commit()
+        return issues
+
+    @classmethod
+    def resume_point(cls, repo, since):
+        """Where a sync of `repo`'s issues updated since `since` starts: the
+        (since, issue numbers already seen) after the last page stored, if a
+        sync was interrupted since `repo`'s watermark was logged, else
+        (`since`, [])."""
+        checkpoint = GithubQueryLog.checkpoint(cls.watermark(repo))
+        if checkpoint:
+            return (checkpoint['since'], checkpoint['seen'])
+        return (since, [])
+
+    @classmethod
+    def remove(cls, repo, number):
+        """Deletes `repo`'s issue `number`, if stored, with its events,
+        milestones, labels and review timeline."""
+        issue = cls.query.filter_by(repo=repo, number=number).first()
+        if issue is None:
+            return
+        ReviewStage.query.filter_by(issue_id=issue.id).delete(
+            synchronize_session=False)
+        issue.labels = []
+        db.session.delete(issue)
+
+    @classmethod
+    def store_events(cls, repo, events):
+        """Adds those of `events`, dicts from `repo`'s issue event feed, that
+        are not stored yet, with a milestone for each 'milestoned' one, and
+        rebuilds the affected review timelines, in one commit.
+
+        An event's issue is matched by number; one not stored yet is stored
+        from the copy embedded in the event.  Returns the events added."""
+        if not events:
+            return []
+        known = set(row[0] for row in db.session.query(Event.id).filter(
+            Event.id.in_([e['id'] for e in events])))
+        new_events = [e for e in events
+                      if e['id'] not in known and e.get('issue')]
+        numbers = set(e['issue']['number'] for e in new_events)
+        issues = dict((issue.number, issue) for issue in cls.query.filter(
+            cls.repo == repo, cls.number.in_(numbers))) if numbers else {}
+        for e in new_events:
+            if e['issue']['number'] not in issues:
+                issues[e['issue']['number']] = cls.upsert_from_gh_data(
+                    e['issue'], repo)
+        db.session.flush()
+        for e in new_events:
+            issue_id = issues[e['issue']['number']].id
+            event = Event.from_gh_data(e)
+            event.issue_id = issue_id
+            db.session.add(event)
+            if e['event'] == 'milestoned':
+                milestone = Milestone.from_gh_data(e)
+                milestone.issue_id = issue_id
+                db.session.add(milestone)
+        db.session.flush()
+        ReviewStage.refresh(issues[number].id for number in numbers)
+        db.session.commit()
+        return new_events
+
+    @staticmethod
+    def _download_pages(api, since, seen, after_event_id):
+        """Yields ('issues', page) for each page of `api`'s issues updated
+        since `since`, less those numbered in `seen`, then ('events', page)
+        for each page of its issue event feed newer than `after_event_id`."""
+        for page in api.iter_issue_pages(since=since, seen=seen):
+            yield ('issues', page)
+        for page in api.iter_repo_events(after_event_id):
+            yield ('events', page)
+
+    @classmethod
+    def _store(cls, repo, kind, page):
+        """Stores a page from `_download_pages`; returns the newest event id
+        in it (0 for a page of issues)."""
+        if kind == 'issues':
+            cls.store_page(repo, page)
+            return 0
+        cls.store_events(repo, page)
+        return max(e['id'] for e in page)
+
+    @classmethod
+    def _log_watermarks(cls, repo, newest_event_id):
+        GithubQueryLog.log(cls.watermark(repo))
+        GithubQueryLog.log(cls.events_watermark(repo),
+                           cursor=str(newest_event_id))
+        db.session.commit()
+
+    @classmethod
+    def fetch_events(cls, api=drafts_api):
+        """Stores the events of `api`'s repo newer than the newest stored,
+        from its issue event feed, a page at a time."""
+        newest = after = cls.last_event_id(api.full_name)
+        for page in api.iter_repo_events(after):
+            newest = max(newest, cls._store(api.full_name, 'events', page))
+        GithubQueryLog.log(cls.events_watermark(api.full_name),
+                           cursor=str(newest))
         db.session.commit()
 
+    @classmethod
+    def fetch(cls, since, api=drafts_api):
+        """Stores issues of `api`'s repo updated since `since`, then the
+        events added to the repo's issues since the last fetch, a page at a
+        time; each page is committed before the next is fetched, so a fetch
+        that is interrupted resumes after the last page of issues stored."""
+        (since, seen) = cls.resume_point(api.full_name, since)
+        newest = after = cls.last_event_id(api.full_name)
+        for (kind, page) in cls._download_pages(api, since, seen, after):
+            newest = max(newest, cls._store(api.full_name, kind, page))
+        cls._log_watermarks(api.full_name, newest)
+
+    @classmethod
+    def fetch_repos(cls, repos, workers=4):
+        """Stores issues of several repositories, downloading up to
+        `workers` of them at once.
+
+        Downloads run on worker threads; pages of issues and of events are
+        stored on the calling thread as they arrive, and each repo's
+        watermarks are logged once all its pages are in.  A repo whose
+        download or storage fails is left at its old watermarks without
+        holding up the others, and resumes after its last page of issues
+        stored next time.
+
+        Args:
+            repos: (GitHub client, since) pairs
+            workers: repositories downloaded at once
+        Returns:
+            dict of the exception each failed repo raised, by 'owner/repo'
+        """
+        pending = queue.Queue()
+        newest = {}
+        for (api, since) in repos:
+            (since, seen) = cls.resume_point(api.full_name, since)
+            newest[api.full_name] = cls.last_event_id(api.full_name)
+            pending.put((api, since, seen, newest[api.full_name]))
+        # Bounded, so downloads can't run far ahead of the database
+        arrived = queue.Queue(maxsize=2 * workers)
+
+        def download():
+            while True:
+                try:
+                    (api, since, seen, after_event_id) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    for (kind, page) in cls._download_pages(
+                            api, since, seen, after_event_id):
+                        arrived.put((api, kind, page))
+                except Exception as e:
+                    arrived.put((api, None, e))
+                else:
+                    arrived.put((api, None, None))
+
+        threads = [threading.Thread(target=download, name='issue-sync')
+                   for _ in range(min(workers, len(repos)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        failures = {}
+        remaining = len(repos)
+        while remaining:
+            (api, kind, page) = arrived.get()
+            repo = api.full_name
+            if kind is None:
+                remaining -= 1
+            if repo in failures:
+                continue
+            try:
+                if isinstance(page, Exception):
+                    raise page
+                elif kind is None:
+                    cls._log_watermarks(repo, newest[repo])
+                else:
+                    newest[repo] = max(newest[repo],
+                                       cls._store(repo, kind, page))
+            except Exception as e:
+                db.session.rollback()
+                failures[repo] = e
+                ISSUE_REPO_FAILURES.inc(repo=repo)
+        for thread in threads:
+            thread.join()
+        return failures
+
+
+class ReviewStage(db.Model):
+    """One stretch of an issue's life between milestone transitions.
+
+    Rows are derived from `Milestone` with window functions by `refresh`,
+    which ingestion calls for just the issues it touched.  `left_at` is
+    NULL for the stage an issue is in now."""
+    __tablename__ = 'review_timeline'
+    id = db.Column(db.Integer, primary_key=True)
+    issue_id = db.Column(db.Integer, db.ForeignKey('issue.id'), index=True)
+    sequence = db.Column(db.Integer, nullable=False)
+    stage = db.Column(db.String(), nullable=False)
+    entered_at = db.Column(db.Date(), nullable=False)
+    left_at = db.Column(db.Date(), nullable=True)
+    issue = db.relationship('Issue', backref=db.backref(
+        'review_stages', cascade='all, delete-orphan',
+        order_by='ReviewStage.sequence'))
+
+    @classmethod
+    def refresh(cls, issue_ids):
+        "Rebuilds the timeline rows of the given issues from their milestones."
+        issue_ids = list(issue_ids)
+        if not issue_ids:
+            return
+        db.session.execute(
+            'DELETE FROM review_timeline WHERE issue_id = ANY(:ids)',
+            {'ids': issue_ids})
+        db.session.execute("""
+            INSERT INTO review_timeline
+                (issue_id, sequence, stage, entered_at, left_at)
+            SELECT issue_id,
+                   row_number() OVER w,
+                   title,
+                   created_at,
+                   lead(created_at) OVER w
+            FROM milestone
+            WHERE issue_id = ANY(:ids) AND created_at IS NOT NULL
+            WINDOW w AS (PARTITION BY issue_id ORDER BY created_at, id)""",
+                           {'ids': issue_ids})
+
+    @staticmethod
+    def _rows(sql, params):
+        return [dict(row) for row in db.session.execute(sql, params)]
+
+    # When an issue left a stage: the next milestone, else when the issue
+    # closed (never before it entered the stage), else it is in it still
+    LEFT_OR_CLOSED = ('GREATEST(COALESCE(r.left_at, i.closed_at, '
+                      'current_date), r.entered_at)')
+
+    @classmethod
+    def median_days_by_label(cls, stage='ready to approve'):
+        "Median and count of days spent in `stage`, per issue label."
+        return cls._rows("""
+            SELECT l.name AS label,
+                   count(*) AS issues,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY
+                       {0} - r.entered_at)
+                       AS median_days
+            FROM review_timeline r
+            JOIN issue i ON i.id = r.issue_id
+            JOIN labels_issues li ON li.issue_id = r.issue_id
+            JOIN label l ON l.id = li.label_id
+            WHERE r.stage = :stage
+            GROUP BY l.name
+            ORDER BY median_days DESC""".format(cls.LEFT_OR_CLOSED),
+                         {'stage': stage})
+
+    @classmethod
+    def median_days_by_team(cls, stage='ready to approve'):
+        "Median and count of days spent in `stage`, per issue author's team."
+        return cls._rows("""
+            SELECT COALESCE(t.name, 'Unknown') AS team,
+                   count(*) AS issues,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY
+                       {0} - r.entered_at)
+                       AS median_days
+            FROM review_timeline r
+            JOIN issue i ON i.id = r.issue_id
+            LEFT JOIN author a ON a.username = i.user
+            LEFT JOIN team t ON t.id = a.team_id
+            WHERE r.stage = :stage
+            GROUP BY COALESCE(t.name, 'Unknown')
+            ORDER BY median_days DESC""".format(cls.LEFT_OR_CLOSED),
+                         {'stage': stage})
+
+    @classmethod
+    def weekly_throughput(cls, stage='ready to approve', weeks=26):
+        """Issues leaving `stage` per week and label over the last `weeks`
+        weeks, with a running four-week average."""
+        return cls._rows("""
+            SELECT week, label, issues,
+                   avg(issues) OVER (PARTITION BY label ORDER BY week
+                                     ROWS BETWEEN 3 PRECEDING AND CURRENT ROW)
+                       AS four_week_average
+            FROM (SELECT date_trunc('week', r.left_at)::date AS week,
+                         COALESCE(l.name, 'unlabeled') AS label,
+                         count(DISTINCT r.issue_id) AS issues
+                  FROM review_timeline r
+                  LEFT JOIN labels_issues li ON li.issue_id = r.issue_id
+                  LEFT JOIN label l ON l.id = li.label_id
+                  WHERE r.stage = :stage
+                    AND r.left_at >= current_date - :days
+                  GROUP BY 1, 2) weekly
+            ORDER BY week DESC, label""", {'stage': stage, 'days': weeks * 7})
+
+
+class Job(db.Model):
+    """One durable unit of ingestion work; see `app.jobs`.
+
+    `args` is the job's keyword arguments as canonical JSON, so identical
+    jobs compare equal: at most one of them can be pending at a time."""
+    __table_args__ = (
+        db.Index('job_pending_kind_args', 'kind', 'args', unique=True,
+                 postgresql_where=db.text("state = 'pending'")),
+        db.Index('job_pending_run_after', 'run_after',
+                 postgresql_where=db.text("state = 'pending'")),
+        db.Index('job_finished_at', 'finished_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(), nullable=False)
+    args = db.Column(db.Text(), nullable=False)
+    # pending, running, done or failed
+    state = db.Column(db.String(), nullable=False, default='pending')
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    run_after = db.Column(db.DateTime(), nullable=False,
+                          server_default=db.func.now())
+    created_at = db.Column(db.DateTime(), nullable=False,
+                           server_default=db.func.now())
+    started_at = db.Column(db.DateTime(), nullable=True)
+    finished_at = db.Column(db.DateTime(), nullable=True)
+    worker = db.Column(db.String(), nullable=True)
+    last_error = db.Column(db.Text(), nullable=True)
+
+
+# Per-source sync state, reported by /readyz.  A source is "ready" once it
+# has synced (or been found fresh enough to skip) at least once in this
+# process; a later failed refresh leaves the data it already stored in place.
+# Issues sync repo by repo; those that failed last time are in failed_repos.
+SYNC_SOURCES = ('duty_stations', 'authors', 'issues')
+sync_state = dict((source, {'state': 'pending',
+                            'started_at': None,
+                            'finished_at': None,
+                            'ready_at': None,
+                            'error': None}) for source in SYNC_SOURCES)
+sync_state['issues']['failed_repos'] = {}
+_sync_lock = threading.Lock()
+
+
+@contextmanager
+def _sync_phase(source):
+    "Records the state of one source's sync in `sync_state`."
+    status = sync_state[source]
+    status.update(state='running', started_at=datetime.now(), error=None)
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        SYNC_PHASE_SECONDS.observe(time.time() - start, phase=source,
+                                   outcome='failed')
+        status.update(state='failed', finished_at=datetime.now(),
+                      error=str(e))
+        raise
+    SYNC_PHASE_SECONDS.observe(time.time() - start, phase=source,
+                               outcome='ok')
+    status.update(state='ready', finished_at=datetime.now())
+    status['ready_at'] = status['ready_at'] or status['finished_at']
+
+
+def _mark_fresh(source):
+    "Records that `source` was skipped because its stored data is recent."
+    status = sync_state[source]
+    if status['state'] == 'pending':
+        status['state'] = 'ready'
+    status['ready_at'] = status['ready_at'] or datetime.now()
+
+
+def sync_is_ready():
+    "True once every source has synced at least once."
+    return all(s['ready_at'] for s in sync_state.values())
+
+
+def issue_repos():
+    "GitHub clients of the repositories in the ISSUE_REPOS setting."
+    return [github_for(spec)
+            for spec in current_app.config.get('ISSUE_REPOS', ())
+            if spec.strip()]
+
+
+def stale_issue_repos(refresh_timedelta):
+    """(GitHub client, last sync) of each tracked repo last synced more than
+    `refresh_timedelta` ago."""
+    stale = []
+    for api in issue_repos():
+        last_query = GithubQueryLog.last_query_datetime(
+            Issue.watermark(api.full_name))
+        if (datetime.now() - last_query) > refresh_timedelta:
+            stale.append((api, last_query))
+    return stale
+
+
+def _partition_housekeeping():
+    """`partitions.housekeeping`, logged rather than raised if it fails, so
+    the sync goes on."""
+    try:
+        partitions.housekeeping()
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception('Partition housekeeping failed')
+
+
+def _record_repo_failures(failures, attempted):
+    """Lists repos whose issues failed to sync in `sync_state`; raises if
+    all `attempted` of them failed."""
+    sync_state['issues']['failed_repos'] = dict(
+        (repo, str(e)) for (repo, e) in failures.items())
+    if failures and len(failures) == attempted:
+        raise GitHubError('Syncing issues failed for {0}'.format(
+            ', '.join(sorted(failures))))
+
 
 def update_db_from_github(refresh_timedelta):
     """Refresh author and issue data from Github / 18f API.
 
+    Only one refresh runs at a time per process; a call made while another
+    is in progress returns immediately and leaves the stored data as it is.
+    Issues are pulled from every repo in ISSUE_REPOS, several at once, each
+    tracked by its own watermark; a failing repo doesn't stop the rest.
+
     Args:
         refresh_timedelta: Pull from each data source only if the last pull
             was at least this long ago.
     """
-    DutyStation.fill()
-    last_query = GithubQueryLog.last_query_datetime('authors')
-    if (datetime.now() - last_query) > refresh_timedelta:
-        Author.fetch()
-    last_query = GithubQueryLog.last_query_datetime('issues')
-    if (datetime.now() - last_query) > refresh_timedelta:
-        Issue.fetch(since=last_query)
+    if not _sync_lock.acquire(False):
+        return
+    try:
+        _partition_housekeeping()
+        with _sync_phase('duty_stations'):
+            DutyStation.fill()
+        last_query = GithubQueryLog.last_query_datetime('authors')
+        if (datetime.now() - last_query) > refresh_timedelta:
+            with _sync_phase('authors'):
+                Author.fetch()
+        else:
+            _mark_fresh('authors')
+        stale = stale_issue_repos(refresh_timedelta)
+        if stale:
+            with _sync_phase('issues'):
+                _record_repo_failures(Issue.fetch_repos(
+                    stale, current_app.config.get('ISSUE_SYNC_WORKERS', 4)),
+                    len(stale))
+        else:
+            _mark_fresh('issues')
+    finally:
+        _sync_lock.release()
@@ -0,0 +1,196 @@
+"""Monthly partitions of the `event` table, and its retention policy.
+
+`event` is range-partitioned on `created_at`, one partition per calendar
+month (event_y2016m03 and so on), plus event_default for rows with no date
+or a date no partition covers.  Queries bounded by `created_at` scan only
+the partitions of the months in range.
+
+`maintain` adds partitions up to AHEAD_MONTHS months ahead, and one for each
+month that has rows in the default partition, moving those rows in.
+`apply_retention` writes each partition older than the retention period to
+a gzipped CSV and drops it, all its rows at once.  `housekeeping` does both,
+as configured, and runs at the start of every sync:
+
+    EVENT_RETENTION_MONTHS   months of events kept besides the current one
+                             (unset: keep everything)
+    PARTITION_ARCHIVE_DIR    where dropped partitions are written
+                             (default: instance/archive)
+
+Tables created unpartitioned, as by `db.create_all`, are left alone.
+"""
+import errno
+import gzip
+import os
+import re
+from datetime import date
+from flask import current_app
+from . import db
+
+# Tables partitioned by month of `created_at`
+TABLES = ('event', )
+AHEAD_MONTHS = 3
+_MONTH_SUFFIX = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def add_months(day, n):
+    "The first day of the month `n` months after `day`'s."
+    month = day.month - 1 + n
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return '{0}_y{1:04d}m{2:02d}'.format(table, month.year, month.month)
+
+
+def months_to_create(existing, default_months, today, ahead=AHEAD_MONTHS):
+    """First days of the months needing a partition: this month through
+    `ahead` months on, and those with rows in the default partition, less
+    the `existing` ones."""
+    this_month = today.replace(day=1)
+    wanted = set(add_months(this_month, n) for n in range(ahead + 1))
+    wanted.update(default_months)
+    return sorted(wanted - set(existing))
+
+
+def expired(existing, retention_months, today):
+    "The `existing` months older than `retention_months` before `today`'s."
+    cutoff = add_months(today.replace(day=1), -retention_months)
+    return sorted(month for month in existing if month < cutoff)
+
+
+def is_partitioned(table):
+    return bool(db.session.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)",
+        {'table': table}).scalar())
+
+
+def partitions(table):
+    "{first day of month: partition name} of `table`'s monthly partitions."
+    names = db.session.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:table)""", {'table': table})
+    months = {}
+    for (name, ) in names:
+        match = _MONTH_SUFFIX.search(name)
+        if match:
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def _lock():
+    "Serializes partition changes across processes until commit."
+    db.session.execute("SELECT pg_advisory_xact_lock(hashtext('partitions'))")
+
+
+def create_partition(table, month):
+    """Adds `table`'s partition for `month`, moving in that month's rows from
+    the default partition; returns the number of rows moved."""
+    name = partition_name(table, month)
+    # As strings: PostgreSQL 11 takes only plain literals as bounds
+    bounds = {'lower': month.isoformat(),
+              'upper': add_months(month, 1).isoformat()}
+    db.session.execute('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS)'
+                       .format(name, table))
+    moved = db.session.execute("""
+        WITH moved AS (DELETE FROM {0}_default
+                       WHERE created_at >= :lower AND created_at < :upper
+                       RETURNING *)
+        INSERT INTO {1} SELECT * FROM moved""".format(table, name),
+                               bounds).rowcount
+    # Attaching creates the partition's indexes and foreign keys
+    db.session.execute('ALTER TABLE {0} ATTACH PARTITION {1} '
+                       'FOR VALUES FROM (:lower) TO (:upper)'
+                       .format(table, name), bounds)
+    return moved
+
+
+def maintain(today=None, ahead=AHEAD_MONTHS):
+    "Adds the partitions `months_to_create` lists; returns their names."
+    created = []
+    for table in TABLES:
+        if not is_partitioned(table):
+            continue
+        _lock()
+        default_months = [row[0] for row in db.session.execute(
+            "SELECT DISTINCT date_trunc('month', created_at)::date "
+            "FROM {0}_default WHERE created_at IS NOT NULL".format(table))]
+        for month in months_to_create(partitions(table), default_months,
+                                      today or date.today(), ahead):
+            create_partition(table, month)
+            created.append(partition_name(table, month))
+        db.session.commit()
+    return created
+
+
+def _new_archive(name, directory):
+    """Creates an empty <directory>/<name>.csv.gz, or <name>.2.csv.gz and so
+    on if that exists: a month's partition re-created by late events is
+    archived again when dropped again, and never over the earlier archive.
+    Returns the file, open for writing, and its path."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    n = 1
+    while True:
+        path = os.path.join(directory, '{0}{1}.csv.gz'.format(
+            name, '' if n == 1 else '.{0}'.format(n)))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            n += 1
+        else:
+            return (os.fdopen(fd, 'wb'), path)
+
+
+def _archive(name, directory):
+    "Writes table `name` to a `_new_archive` file; returns its path."
+    (output, path) = _new_archive(name, directory)
+    cursor = db.session.connection().connection.cursor()
+    with output:
+        with gzip.GzipFile(fileobj=output, mode='wb') as archive:
+            cursor.copy_expert(
+                'COPY {0} TO STDOUT WITH CSV HEADER'.format(name), archive)
+    return path
+
+
+def apply_retention(retention_months, archive_dir=None, today=None):
+    """Detaches and drops each partition `expired` lists, first archiving it
+    under `archive_dir` if given, one commit per partition.  Returns the rows
+    dropped, by partition."""
+    dropped = {}
+    for table in TABLES:
+        if not is_partitioned(table):
+            continue
+        existing = partitions(table)
+        for month in expired(existing, retention_months,
+                             today or date.today()):
+            name = existing[month]
+            _lock()
+            db.session.execute('ALTER TABLE {0} DETACH PARTITION {1}'
+                               .format(table, name))
+            dropped[name] = db.session.execute(
+                'SELECT count(*) FROM {0}'.format(name)).scalar()
+            if archive_dir:
+                _archive(name, archive_dir)
+            db.session.execute('DROP TABLE {0}'.format(name))
+            db.session.commit()
+    return dropped
+
+
+def archive_dir():
+    return current_app.config.get('PARTITION_ARCHIVE_DIR') or \
+        os.path.join(current_app.instance_path, 'archive')
+
+
+def housekeeping():
+    """`maintain`, then `apply_retention` if EVENT_RETENTION_MONTHS is set;
+    returns the partitions created and those dropped."""
+    created = maintain()
+    retention_months = current_app.config.get('EVENT_RETENTION_MONTHS')
+    dropped = {}
+    if retention_months:
+        dropped = apply_retention(retention_months, archive_dir())
+    return (created, dropped)
@@ -0,0 +1,158 @@
+"""Profiles single requests on demand, for admins.
+
+Adding `profile=1` to the query string of any page behind `requires_auth`
+runs that request under `lib.profiler`'s sampling profiler (streamed pages
+until their last piece is sent), and saves under PROFILE_DIR:
+
+*   <name>.svg     flame graph
+*   <name>.folded  the same stacks, for speedscope or flamegraph.pl
+*   <name>.txt     time split between SQL, HTTP, templates and other Python,
+                   the slowest functions and the call tree
+
+The response's X-Profile header gives the flame graph's URL, and /profiles/
+lists the saved profiles.  Each process profiles at most one request every
+PROFILE_MIN_INTERVAL_SECONDS, and one at a time; requests over that limit
+run unprofiled, with "X-Profile: rate-limited".
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from flask import current_app, request, url_for
+from lib import metrics
+from lib.profiler import Profile
+
+PROFILED_REQUESTS = metrics.counter(
+    'profiled_requests_total', 'Requests asking to be profiled, by outcome',
+    ('outcome', ))
+
+_lock = threading.Lock()
+# Whether a request is being profiled, and when the last one started
+_state = {'active': False, 'started_at': 0}
+
+
+def _claim(min_interval_seconds):
+    "True if this process may profile a request now; marks it as busy."
+    with _lock:
+        if _state['active'] or \
+                time.time() - _state['started_at'] < min_interval_seconds:
+            return False
+        _state.update(active=True, started_at=time.time())
+        return True
+
+
+def _release():
+    with _lock:
+        _state['active'] = False
+
+
+def profile_dir():
+    return current_app.config.get('PROFILE_DIR') or \
+        os.path.join(current_app.instance_path, 'profiles')
+
+
+def report(profile, url):
+    "Plain text summary of `profile`, a profile of a request to `url`."
+    summary = profile.summary()
+    lines = ['{0}: {1:.3f}s wall, {2} samples every {3}s'.format(
+        url, profile.seconds, summary['samples'], profile.interval), '']
+    lines.extend('{0:6.1%}  {1}'.format(fraction, category)
+                 for (category, fraction) in sorted(
+                     summary['split'].items(), key=lambda item: -item[1]))
+    for (title, key) in (('Self time', 'self'),
+                         ('Inclusive time', 'inclusive')):
+        lines.extend(['', title])
+        lines.extend('{0:6.1%}  {1}'.format(fraction, label)
+                     for (label, fraction) in summary[key])
+    lines.extend(['', 'Call tree', profile.tree()])
+    return '\n'.join(lines)
+
+
+def _save(profile, directory, name, url):
+    profile.stop()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    outputs = (('svg', profile.svg()), ('folded', profile.folded()),
+               ('txt', report(profile, url)),
+               ('json', json.dumps(dict(profile.summary(), url=url))))
+    for (extension, text) in outputs:
+        path = os.path.join(directory, '{0}.{1}'.format(name, extension))
+        with open(path, 'w') as output:
+            output.write(text)
+
+
+class _ProfiledIterable(object):
+    """A streamed body that calls `finish` once when closed.  The WSGI
+    server closes the body whether it was sent in full, in part or not at
+    all (a HEAD request), which a generator's `finally` would miss."""
+
+    def __init__(self, iterable, finish):
+        self._iterable = iterable
+        self._finish = finish
+        self._finished = False
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._finish()
+
+
+def profiled(view, *args, **kwargs):
+    """Calls `view`, under the profiler if the rate limit allows; returns
+    its response, with an X-Profile header."""
+    app = current_app._get_current_object()
+    if not _claim(app.config.get('PROFILE_MIN_INTERVAL_SECONDS', 60)):
+        PROFILED_REQUESTS.inc(outcome='rate-limited')
+        response = app.make_response(view(*args, **kwargs))
+        response.headers['X-Profile'] = 'rate-limited'
+        return response
+    name = '{0}-{1}-{2}'.format(datetime.now().strftime('%Y%m%d-%H%M%S'),
+                                request.endpoint, os.getpid())
+    (directory, url) = (profile_dir(), request.url)
+
+    def finish():
+        try:
+            _save(profile, directory, name, url)
+        except Exception:
+            app.logger.exception('Saving profile %s failed', name)
+        finally:
+            _release()
+
+    profile = Profile(app.config.get('PROFILE_INTERVAL_SECONDS', 0.005))
+    profile.start()
+    try:
+        response = app.make_response(view(*args, **kwargs))
+    except Exception:
+        finish()
+        raise
+    PROFILED_REQUESTS.inc(outcome='profiled')
+    response.headers['X-Profile'] = url_for('profile_file',
+                                            filename=name + '.svg')
+    if response.is_streamed:
+        response.response = _ProfiledIterable(response.response, finish)
+    else:
+        finish()
+    return response
+
+
+def saved_profiles():
+    "Summaries of the saved profiles, newest first."
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if filename.endswith('.json'):
+            with open(os.path.join(directory, filename)) as summary:
+                profiles.append(dict(json.load(summary),
+                                     name=filename[:-len('.json')]))
+    return profiles
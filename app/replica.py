@@ -0,0 +1,134 @@
+"""Sends read-only queries to a streaming replica of the database.
+
+With a 'replica' entry in SQLALCHEMY_BINDS, a session that has been told to
+`read_from_replica` runs SELECTs there and everything else on the primary.
+Once the session has written anything it stays on the primary, so it always
+reads its own writes.  Before each use the replica's replay lag is checked
+(at most every REPLICA_LAG_CHECK_SECONDS); while it is over
+REPLICA_MAX_LAG_SECONDS, or the replica can't be reached, reads go to the
+primary too.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.sql.expression import Select, CompoundSelect, TextClause
+from lib import metrics
+
+REPLICA = 'replica'
+# Session info key set once a session has written, pinning it to the primary
+WROTE = 'wrote_to_primary'
+
+REPLICA_LAG_SECONDS = metrics.gauge(
+    'replica_lag_seconds', 'Replay lag of the read replica at the last check')
+REPLICA_READS = metrics.counter(
+    'replica_routed_reads_total', 'Reads routed for the replica, by target',
+    ('target', ))
+
+# Last lag check of each replica engine: url -> (checked at, usable)
+_lag_checks = {}
+_lag_lock = threading.Lock()
+
+
+def lag_sql(server_version_num):
+    """Query for a standby's replay lag in seconds: 0 when it has replayed
+    everything it received (or is not a standby at all), NULL if it has not
+    replayed anything yet."""
+    if server_version_num >= 100000:
+        (received, replayed) = ('pg_last_wal_receive_lsn()',
+                                'pg_last_wal_replay_lsn()')
+    else:
+        (received, replayed) = ('pg_last_xlog_receive_location()',
+                                'pg_last_xlog_replay_location()')
+    return """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN {0} = {1} THEN 0
+            ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+        END""".format(received, replayed)
+
+
+def replica_lag_seconds(engine):
+    "The replay lag of the database behind `engine`, or None if unknown."
+    with engine.connect() as connection:
+        version = int(connection.execute('SHOW server_version_num').scalar())
+        lag = connection.execute(lag_sql(version)).scalar()
+    return None if lag is None else float(lag)
+
+
+def replica_is_fresh(engine, max_lag_seconds, check_seconds):
+    """True if `engine`'s replay lag is at most `max_lag_seconds`, as of a
+    check made no more than `check_seconds` ago."""
+    key = str(engine.url)
+    with _lag_lock:
+        (checked_at, usable) = _lag_checks.get(key, (0, False))
+        if time.time() - checked_at <= check_seconds:
+            return usable
+        try:
+            lag = replica_lag_seconds(engine)
+        except Exception:
+            lag = None
+        usable = lag is not None and lag <= max_lag_seconds
+        REPLICA_LAG_SECONDS.set(lag if lag is not None else float('inf'))
+        _lag_checks[key] = (time.time(), usable)
+        return usable
+
+
+def _is_read(clause):
+    if isinstance(clause, (Select, CompoundSelect)):
+        # A standby can't take row locks
+        return getattr(clause, '_for_update_arg', None) is None
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().upper().startswith('SELECT')
+    return False
+
+
+class RoutingSession(SignallingSession):
+    "A session that can send its reads to the replica bind; see module doc."
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not _is_read(clause):
+            self.info[WROTE] = True
+        elif self.info.get(REPLICA) and not self.info.get(WROTE):
+            engine = self._replica_engine()
+            if engine is not None:
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _replica_engine(self):
+        "The replica's engine, or None if there is none or it is stale."
+        config = self.app.config
+        if REPLICA not in (config.get('SQLALCHEMY_BINDS') or {}):
+            return None
+        engine = self.db.get_engine(self.app, bind=REPLICA)
+        fresh = replica_is_fresh(engine,
+                                 config.get('REPLICA_MAX_LAG_SECONDS', 30),
+                                 config.get('REPLICA_LAG_CHECK_SECONDS', 5))
+        REPLICA_READS.inc(target=REPLICA if fresh else 'primary')
+        return engine if fresh else None
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    "`SQLAlchemy` whose sessions can read from a replica."
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def read_from_replica(self, enabled=True):
+        "Lets the current session send its reads to the replica."
+        self.session().info[REPLICA] = enabled
+
+    @contextmanager
+    def primary(self):
+        "Keeps the current session on the primary for the `with` block."
+        info = self.session().info
+        previous = info.get(REPLICA)
+        info[REPLICA] = False
+        try:
+            yield
+        finally:
+            info[REPLICA] = previous
@@ -0,0 +1,151 @@
+"""Dumps and restores every model table with PostgreSQL's COPY.
+
+A snapshot is a gzipped tar holding `manifest.json` (table order and the
+Alembic revision the data was taken at) and one CSV per table, in
+foreign-key order.  Restoring loads every table in one transaction, with
+secondary indexes dropped during the load and rebuilt afterwards."""
+import io
+import json
+import tarfile
+import tempfile
+from datetime import datetime
+from . import db
+
+MANIFEST = 'manifest.json'
+
+
+def _quote(engine, name):
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def truncate_all(engine=None):
+    """Empties every model table with one TRUNCATE ... CASCADE.
+
+    Falls back to deleting table by table on databases other than
+    PostgreSQL."""
+    engine = engine or db.engine
+    tables = db.metadata.sorted_tables
+    if engine.dialect.name != 'postgresql':
+        for tbl in reversed(tables):
+            engine.execute(tbl.delete())
+        return
+    engine.execute('TRUNCATE {0} RESTART IDENTITY CASCADE'.format(
+        ', '.join(_quote(engine, t.name) for t in tables)))
+
+
+def dump(path, engine=None):
+    "Writes a snapshot of every model table to `path`; returns row counts."
+    engine = engine or db.engine
+    tables = db.metadata.sorted_tables
+    counts = {}
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # One repeatable-read transaction gives a consistent snapshot
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ '
+                       'READ ONLY')
+        with tarfile.open(path, 'w:gz') as archive:
+            for tbl in tables:
+                cursor.execute('SELECT count(*) FROM {0}'.format(
+                    _quote(engine, tbl.name)))
+                counts[tbl.name] = cursor.fetchone()[0]
+                with tempfile.TemporaryFile() as data:
+                    # A query, since COPY can't read a partitioned table
+                    cursor.copy_expert(
+                        'COPY (SELECT * FROM {0}) TO STDOUT WITH CSV HEADER'
+                        .format(_quote(engine, tbl.name)), data)
+                    info = tarfile.TarInfo('{0}.csv'.format(tbl.name))
+                    info.size = data.tell()
+                    data.seek(0)
+                    archive.addfile(info, data)
+            cursor.execute('SELECT version_num FROM alembic_version')
+            manifest = json.dumps({
+                'created_at': datetime.now().isoformat(),
+                'alembic_revision': cursor.fetchone()[0],
+                'tables': [tbl.name for tbl in tables],
+                'row_counts': counts,
+            }, indent=2, sort_keys=True).encode('utf-8')
+            info = tarfile.TarInfo(MANIFEST)
+            info.size = len(manifest)
+            archive.addfile(info, io.BytesIO(manifest))
+        connection.rollback()
+    finally:
+        connection.close()
+    return counts
+
+
+def _secondary_indexes(cursor, table_names):
+    "(name, definition) of indexes not backing a PK/unique constraint."
+    cursor.execute("""
+        SELECT i.indexname, i.indexdef
+        FROM pg_indexes i
+        WHERE i.schemaname = current_schema()
+          AND i.tablename = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                          WHERE c.conname = i.indexname)""",
+                   (list(table_names), ))
+    return cursor.fetchall()
+
+
+def load(path, engine=None):
+    """Replaces every model table's contents with the snapshot at `path`.
+
+    The snapshot must have been taken at the database's current Alembic
+    revision.  Runs in a single transaction: on any error nothing changes.
+    Returns the row counts recorded in the snapshot."""
+    engine = engine or db.engine
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        with tarfile.open(path, 'r:gz') as archive:
+            manifest = json.loads(
+                archive.extractfile(MANIFEST).read().decode('utf-8'))
+            cursor.execute('SELECT version_num FROM alembic_version')
+            revision = cursor.fetchone()[0]
+            if manifest['alembic_revision'] != revision:
+                raise ValueError(
+                    'Snapshot was taken at revision {0} but the database is '
+                    'at {1}; run `manage.py db upgrade` to match'.format(
+                        manifest['alembic_revision'], revision))
+            tables = manifest['tables']
+            quoted = [_quote(engine, name) for name in tables]
+            cursor.execute('TRUNCATE {0} RESTART IDENTITY CASCADE'.format(
+                ', '.join(quoted)))
+            indexes = _secondary_indexes(cursor, tables)
+            for (name, _) in indexes:
+                cursor.execute('DROP INDEX {0}'.format(_quote(engine, name)))
+            for (name, quoted_name) in zip(tables, quoted):
+                cursor.copy_expert(
+                    'COPY {0} FROM STDIN WITH CSV HEADER'.format(quoted_name),
+                    archive.extractfile('{0}.csv'.format(name)))
+            for (_, definition) in indexes:
+                # A partitioned table's index is defined ON ONLY the parent;
+                # recreated without it, it is built on every partition too
+                cursor.execute(definition.replace(' ON ONLY ', ' ON ', 1))
+            _reset_sequences(cursor, engine, tables)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    for name in tables:
+        engine.execute('ANALYZE {0}'.format(_quote(engine, name)))
+    return manifest['row_counts']
+
+
+def _reset_sequences(cursor, engine, tables):
+    "Moves serial sequences past the highest restored id."
+    for tbl in db.metadata.sorted_tables:
+        if tbl.name not in tables:
+            continue
+        for column in tbl.primary_key.columns:
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)',
+                           (tbl.name, column.name))
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute(
+                    'SELECT setval(%s, COALESCE(MAX({0}), 0) + 1, false) '
+                    'FROM {1}'.format(_quote(engine, column.name),
+                                      _quote(engine, tbl.name)),
+                    (sequence, ))
@@ -0,0 +1,114 @@
+"""Pages rendered as a stream, gzip-compressed on the fly.
+
+    return streamed_page('issues.html', issues=Issue.listing())
+
+The template is rendered a piece at a time while the response is being
+sent, so the top of the page reaches the client before the slow parts are
+generated, and the whole page is never held in memory.  Rendered text goes
+out in pieces of about FLUSH_BYTES, and at once wherever the template calls
+`{{ flush() }}`.  Clients that accept gzip get it compressed, each piece
+flushed through the compressor as it is sent.
+
+waitress holds back output shorter than its `send_bytes` (18000 bytes by
+default) while a response is being written, so the first piece is padded
+to FIRST_PIECE_BYTES: in the gzip header's extra field, which clients skip,
+or with an HTML comment.  Later pieces go out as they add up.
+"""
+import struct
+import zlib
+from flask import Response, current_app, request, stream_with_context
+from jinja2 import Markup
+
+FLUSH_BYTES = 16 * 1024
+FIRST_PIECE_BYTES = 18000
+GZIP_LEVEL = 6
+# Never part of a page: marks where the template called `flush()`
+_FLUSH = u'\x00'
+
+
+def flush():
+    "Template global: sends everything rendered so far to the client."
+    return Markup(_FLUSH)
+
+
+def coalesce(chunks, flush_bytes=FLUSH_BYTES):
+    """Joins text `chunks` into UTF-8 pieces of at least `flush_bytes`,
+    cutting one short wherever `flush()` was rendered."""
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        flush_now = _FLUSH in chunk
+        data = chunk.replace(_FLUSH, u'').encode('utf-8')
+        buffered.append(data)
+        size += len(data)
+        if size and (flush_now or size >= flush_bytes):
+            yield b''.join(buffered)
+            buffered = []
+            size = 0
+    if size:
+        yield b''.join(buffered)
+
+
+def padded(pieces, first_piece_bytes=FIRST_PIECE_BYTES):
+    "`pieces`, the first padded to `first_piece_bytes` with an HTML comment."
+    first = True
+    for piece in pieces:
+        if first and len(piece) < first_piece_bytes:
+            piece += b'<!--' + b' ' * max(
+                0, first_piece_bytes - len(piece) - 7) + b'-->'
+        first = False
+        yield piece
+
+
+def _gzip_header(padding):
+    """A gzip header (RFC 1952), made at least `padding` bytes longer than
+    the usual 10 by an extra field, if `padding` is positive."""
+    if padding <= 0:
+        return struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 0, 255)
+    # One subfield: its 2-byte ID and 2-byte length, then zeros
+    length = min(max(padding - 6, 0), 0xffff - 4)
+    return struct.pack('<BBBBIBBHBBH', 0x1f, 0x8b, 8, 4, 0, 0, 255,
+                       length + 4, ord('P'), ord('D'), length) + \
+        b'\x00' * length
+
+
+def gzipped(pieces, level=GZIP_LEVEL, first_piece_bytes=0):
+    """Gzip stream of the byte strings `pieces`; each yielded piece ends on
+    a sync flush, so the client can decompress it as soon as it arrives.
+    The first is padded to `first_piece_bytes` in the gzip header."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    (crc, size, header) = (zlib.crc32(b''), 0, None)
+    for piece in pieces:
+        crc = zlib.crc32(piece, crc)
+        size += len(piece)
+        data = compressor.compress(piece) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        if header is None:
+            header = _gzip_header(first_piece_bytes - 10 - len(data))
+            data = header + data
+        yield data
+    yield (b'' if header is not None else _gzip_header(0)) + \
+        compressor.flush() + \
+        struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+
+def accepts_gzip():
+    "True if the current request's Accept-Encoding allows gzip."
+    return request.accept_encodings['gzip'] > 0
+
+
+def streamed_page(template_name, **context):
+    """A response rendering `template_name` with `context` as it is sent,
+    like `render_template` otherwise; the request context (and with it the
+    database session) stays open until the last piece is sent."""
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    pieces = coalesce(template.stream(context))
+    headers = {'Vary': 'Accept-Encoding'}
+    if accepts_gzip():
+        pieces = gzipped(pieces, first_piece_bytes=FIRST_PIECE_BYTES)
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        pieces = padded(pieces)
+    return Response(stream_with_context(pieces), mimetype='text/html',
+                    headers=headers)
@@ -0,0 +1,148 @@
+"""Applies GitHub webhook deliveries as targeted updates of stored rows.
+
+Each handler takes the decoded JSON payload of one delivery and touches only
+the rows it describes; `update_db_from_github` remains as a periodic
+reconciliation pass for anything a missed delivery left behind."""
+from .models import Author, Issue, Label, Milestone, ReviewStage, db
+from .models import issue_repos
+from . import jobs
+from lib.git_parse import site_api, hub_api
+
+# Issue actions that change the issue's milestone or event history
+EVENT_ACTIONS = ('milestoned', 'demilestoned', 'closed', 'reopened',
+                 'labeled', 'unlabeled', 'assigned', 'unassigned')
+# Issue actions after which the issue is no longer in the repo
+REMOVED_ACTIONS = ('deleted', 'transferred')
+
+
+def _is_repo(payload, api):
+    return payload.get('repository', {}).get('full_name') == api.full_name
+
+
+def _issue_repo(payload):
+    "'owner/repo' of the delivery's repository, if its issues are tracked."
+    for api in issue_repos():
+        if _is_repo(payload, api):
+            return api.full_name
+
+
+def handle_issues(payload):
+    """`issues`: upserts the issue, queueing a read of the repo's new issue
+    events if its events changed, or removes it if it left the repo.  The
+    event feed is read by a worker, not within GitHub's delivery timeout."""
+    repo = _issue_repo(payload)
+    if not repo:
+        return
+    if payload.get('action') in REMOVED_ACTIONS:
+        Issue.remove(repo, payload['issue']['number'])
+        return
+    Issue.upsert_from_gh_data(payload['issue'], repo)
+    if payload.get('action') in EVENT_ACTIONS:
+        jobs.enqueue('repo_events', repo=repo)
+
+
+def handle_issue_comment(payload):
+    "`issue_comment`: the issue's comment count and updated date change."
+    repo = _issue_repo(payload)
+    if not repo:
+        return
+    Issue.upsert_from_gh_data(payload['issue'], repo)
+
+
+def handle_label(payload):
+    "`label`: renames, recolors or removes one label."
+    if not _issue_repo(payload):
+        return
+    label_data = payload['label']
+    old_name = payload.get('changes', {}).get('name', {}).get('from')
+    label = Label.query.filter_by(name=old_name or label_data['name']).first()
+    if payload.get('action') == 'deleted':
+        if label:
+            label.issues = []
+            db.session.delete(label)
+        return
+    label = label or Label.get_or_create(label_data)
+    label.name = label_data['name']
+    label.url = label_data.get('url')
+    label.color = label_data.get('color')
+    db.session.add(label)
+
+
+def handle_milestone(payload):
+    """`milestone`: a renamed milestone is renamed on every issue of the
+    repo that has it."""
+    repo = _issue_repo(payload)
+    if not repo:
+        return
+    old_title = payload.get('changes', {}).get('title', {}).get('from')
+    if payload.get('action') == 'edited' and old_title:
+        new_title = payload['milestone']['title']
+        repo_issues = db.session.query(Issue.id).filter_by(repo=repo)
+        Milestone.query.filter(Milestone.title == old_title,
+                               Milestone.issue_id.in_(repo_issues)).update(
+            {'title': new_title}, synchronize_session=False)
+        ReviewStage.query.filter(ReviewStage.stage == old_title,
+                                 ReviewStage.issue_id.in_(repo_issues)).update(
+            {'stage': new_title}, synchronize_session=False)
+
+
+def _changed_files(payload):
+    """{path: whether the push leaves it removed} of each file the push's
+    commits touched, oldest commit first."""
+    changed = {}
+    for commit in payload.get('commits', []):
+        for key in ('added', 'modified', 'removed'):
+            for path in commit.get(key, []):
+                changed[path] = key == 'removed'
+    return changed
+
+
+def _username(path, prefix, suffix):
+    if path.startswith(prefix) and path.endswith(suffix):
+        return path[len(prefix):-len(suffix)]
+
+
+def handle_push(payload):
+    """`push`: queues re-reads of authors.yml, team files and locations.yml
+    when a push to the tracked branch of the 18F site or hub touches them.
+    Workers fetch the files, not the delivery, which GitHub times out."""
+    for api in (site_api, hub_api):
+        if _is_repo(payload, api) and \
+                payload.get('ref') == 'refs/heads/{0}'.format(api.branch):
+            break
+    else:
+        return
+    for (path, removed) in _changed_files(payload).items():
+        if api is site_api and path == '_data/authors.yml':
+            jobs.enqueue('authors')
+            continue
+        if api is hub_api and path == '_data/locations.yml':
+            jobs.enqueue('duty_stations')
+            continue
+        username = (_username(path, '_team/', '.md') if api is site_api
+                    else _username(path, '_data/team/', '.yml'))
+        if not username:
+            continue
+        # The payload has no blob SHAs: UNKNOWN_SHA keeps the stored one, so
+        # the next team file diff sees the file as changed and records it.
+        jobs.enqueue('author_file', repo=api.full_name, username=username,
+                     sha=None if removed else Author.UNKNOWN_SHA)
+
+
+HANDLERS = {
+    'issues': handle_issues,
+    'issue_comment': handle_issue_comment,
+    'label': handle_label,
+    'milestone': handle_milestone,
+    'push': handle_push,
+}
+
+
+def apply(event, payload):
+    """Applies one delivery; returns False for event types not handled."""
+    handler = HANDLERS.get(event)
+    if not handler:
+        return False
+    handler(payload)
+    db.session.commit()
+    return True
@@ -0,0 +1,357 @@
+"""A local stand-in for the GitHub API, raw.githubusercontent.com and the
+18F authors API, serving synthetic but realistically shaped data.
+
+    standin = GitHubStandIn(Dataset(n_issues=1000, n_months=60))
+    standin.start()
+    standin.point(site_api, drafts_api, hub_api)
+    ...
+    standin.stop()
+
+Routes:
+
+*   /repos/{owner}/{repo}/issues         issues, filtered by `since`
+*   /repos/{owner}/{repo}/issues/N/events  paginated, with a Link header
+*   /repos/{owner}/{repo}/issues/events  every issue's events, newest first,
+                                         each embedding its issue; paginated
+*   /repos/{owner}/{repo}/commits        one commit per month of authors.yml
+*   /repos/{owner}/{repo}/contents/{path}  blob SHA of a raw file
+*   /repos/{owner}/{repo}/git/trees/{ref}:{dir}  blob SHAs of the raw
+                                        files in a directory
+*   /raw/{owner}/{repo}/{ref}/{path}     authors.yml, locations and team files
+*   /site-api/authors.json               the 18F website's current authors
+
+Faults can be injected per route (the names counted in `request_counts`):
+
+    standin.inject('raw', delay=2)                # every raw file is slow
+    standin.inject('issues', status=502, times=3)  # three failures, then OK
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+import yaml
+
+GH_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+AIRPORTS = ('DCA', 'SFO', 'CHI', 'NYC', 'TUS', 'DEN', 'SEA', 'BOS')
+TEAMS = ('Delivery', 'Outreach', 'Infrastructure', 'Design', 'Talent')
+LABELS = ('idea', 'in progress', 'ready to approve', 'approved', 'on hold')
+MILESTONES = ('drafting', 'ready to approve', 'ready to publish')
+
+
+def _add_months(day, n):
+    month = day.month - 1 + n
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+class Dataset(object):
+    """Deterministic synthetic data for one benchmark scale.
+
+    Args:
+        n_issues: issues in the drafts repo
+        n_months: months of authors.yml history, ending this month
+        authors_per_month: new authors joining each month
+        events_per_issue: (min, max) events per issue
+        seed: random seed, so runs at the same scale are comparable
+    """
+
+    def __init__(self, n_issues=100, n_months=30, authors_per_month=3,
+                 events_per_issue=(2, 12), seed=18):
+        rng = random.Random(seed)
+        self.first_month = _add_months(date.today().replace(day=1),
+                                       1 - n_months)
+        self.months = [_add_months(self.first_month, n)
+                       for n in range(n_months)]
+        self.authors = {}
+        self.authors_by_month = {}
+        for (n, month) in enumerate(self.months):
+            for k in range(authors_per_month):
+                username = 'author{0}x{1}'.format(n, k)
+                self.authors[username] = {
+                    'first_name': 'Author',
+                    'last_name': '{0}-{1}'.format(n, k),
+                    'full_name': 'Author {0}-{1}'.format(n, k),
+                    'url': 'https://18f.gsa.gov/author/{0}'.format(username),
+                }
+            self.authors_by_month[month] = dict(self.authors)
+        self.locations = [{'code': code,
+                           'label': 'Station {0}'.format(code),
+                           'latitude': rng.uniform(25, 48),
+                           'longitude': rng.uniform(-122, -71),
+                           'timezone': 'America/New_York'}
+                          for code in AIRPORTS]
+        self.team_files = dict((username, {
+            'location': rng.choice(AIRPORTS),
+            'team': rng.choice(TEAMS),
+        }) for username in self.authors)
+
+        start = datetime(2015, 1, 1)
+        self.issues = []
+        self.events = {}
+        for number in range(1, n_issues + 1):
+            created = start + timedelta(minutes=number)
+            updated = created + timedelta(days=rng.randint(0, 90))
+            self.issues.append({
+                'id': 10 ** 6 + number,
+                'number': number,
+                'title': 'Draft post #{0}'.format(number),
+                'body': 'Lorem ipsum dolor sit amet. ' * rng.randint(5, 200),
+                'state': rng.choice(('open', 'open', 'closed')),
+                'locked': False,
+                'comments': rng.randint(0, 30),
+                'user': {'login': rng.choice(list(self.authors))},
+                'labels': [{'name': name,
+                            'url': 'https://api.github.com/labels/' + name,
+                            'color': 'ededed'}
+                           for name in rng.sample(LABELS, rng.randint(0, 2))],
+                'created_at': created.strftime(GH_DATE_FORMAT),
+                'updated_at': updated.strftime(GH_DATE_FORMAT),
+                'closed_at': None,
+            })
+            self.events[number] = [{
+                'id': number * 1000 + k,
+                'commit_id': None,
+                'url': 'https://api.github.com/events/{0}'.format(
+                    number * 1000 + k),
+                'actor': {'login': rng.choice(list(self.authors))},
+                'event': 'milestoned' if k % 3 == 0 else 'labeled',
+                'milestone': {'title': MILESTONES[k // 3 % len(MILESTONES)]},
+                'created_at': (created + timedelta(days=k)).strftime(
+                    GH_DATE_FORMAT),
+            } for k in range(rng.randint(*events_per_issue))]
+        self.issues.sort(key=lambda i: i['updated_at'])
+
+    def issues_since(self, since, per_page):
+        return [i for i in self.issues if i['updated_at'] >= since][:per_page]
+
+    def repo_events(self):
+        "Events of every issue, newest first, each with its issue embedded."
+        issues = dict((i['number'], i) for i in self.issues)
+        return sorted((dict(e, issue=issues[number])
+                       for (number, events) in self.events.items()
+                       for e in events),
+                      key=lambda e: -e['id'])
+
+    def month_for_range(self, since):
+        "The month a `Month._date_range` query starts in, if it has data."
+        try:
+            (year, month) = since.split('-')[:2]
+            day = date(int(year), int(month), 1)
+        except ValueError:
+            return None
+        return day if day in self.authors_by_month else None
+
+
+class GitHubStandIn(ThreadingMixIn, HTTPServer):
+    "Serves a `Dataset` on localhost, counting requests by route."
+    daemon_threads = True
+
+    def __init__(self, dataset, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.dataset = dataset
+        self.request_counts = {}
+        self.faults = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def count(self, route):
+        """Counts a request to `route`; returns the (delay, status) of the
+        fault injected into it, if any."""
+        with self._lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+            fault = self.faults.get(route)
+            if not fault:
+                return None
+            (delay, status, times) = fault
+            if times is not None:
+                if times <= 1:
+                    del self.faults[route]
+                else:
+                    fault[2] = times - 1
+            return (delay, status)
+
+    def inject(self, route, delay=0, status=None, times=None):
+        """Makes the next `times` requests to `route` (all of them, if None)
+        wait `delay` seconds, then fail with HTTP `status` if it is given."""
+        with self._lock:
+            self.faults[route] = [delay, status, times]
+
+    def total_requests(self):
+        return sum(self.request_counts.values())
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def point(self, *apis):
+        "Redirects `lib.git_parse.GitHub` instances at this server."
+        for api in apis:
+            api.api = self.url
+            api.raw = self.url + '/raw'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json',
+              headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Remaining', '4999')
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, data, headers=None):
+        self._send(200, json.dumps(data), headers=headers)
+
+    def _yaml(self, data, front_matter=False):
+        self._send(200, _yaml_text(data, front_matter),
+                   content_type='text/plain')
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.strip('/').split('/')
+        query = dict((k, v[-1]) for (k, v) in parse_qs(parsed.query).items())
+        route = _route(parsed.path, parts)
+        fault = self.server.count(route)
+        if fault:
+            (delay, status) = fault
+            time.sleep(delay)
+            if status is not None:
+                return self._send(status, '{"message": "Injected fault"}')
+        data = self.server.dataset
+        if route == 'issues':
+            return self._json(data.issues_since(
+                query.get('since', ''), int(query.get('per_page', 30))))
+        if route == 'repo_events':
+            return self._paginated(data.repo_events(), query)
+        if route == 'events':
+            return self._paginated(data.events.get(int(parts[4]), []), query)
+        if route == 'commits':
+            month = data.month_for_range(query.get('since', ''))
+            return self._json(
+                [{'sha': 'month-{0}'.format(month)}] if month else [])
+        if route == 'contents':
+            text = self._raw_text('/'.join(parts[4:]))
+            if text is None:
+                return self._send(404, '{"message": "Not Found"}')
+            return self._json({'path': '/'.join(parts[4:]), 'sha': _sha(text)})
+        if route == 'trees':
+            # {ref}:{directory} lists that directory's files, relative to it
+            directory = unquote('/'.join(parts[5:])).partition(':')[2]
+            prefix = directory + '/' if directory else ''
+            return self._json({'truncated': False, 'tree': [
+                {'path': path[len(prefix):], 'type': 'blob', 'sha': _sha(text)}
+                for (path, text) in self._raw_files(parts[2])
+                if path.startswith(prefix) and
+                '/' not in path[len(prefix):]]})
+        if route == 'raw':
+            return self._raw(parts[3], '/'.join(parts[4:]))
+        if route == 'site':
+            return self._json(data.authors)
+        self._send(404, '{"message": "Not Found"}')
+
+    def _paginated(self, items, query):
+        per_page = int(query.get('per_page', 30))
+        page = int(query.get('page', 1))
+        headers = {}
+        if page * per_page < len(items):
+            headers['Link'] = '<{0}{1}?per_page={2}&page={3}>; rel="next"'\
+                .format(self.server.url, urlparse(self.path).path, per_page,
+                        page + 1)
+        self._json(items[(page - 1) * per_page:page * per_page], headers)
+
+    def _raw_files(self, repo):
+        "(path, text) of every file served from `repo`'s branch."
+        data = self.server.dataset
+        if repo == 'hub':
+            yield ('_data/locations.yml', _yaml_text(data.locations))
+            for (username, team_file) in sorted(data.team_files.items()):
+                yield ('_data/team/{0}.yml'.format(username),
+                       _yaml_text(team_file))
+        else:
+            for (username, team_file) in sorted(data.team_files.items()):
+                yield ('_team/{0}.md'.format(username),
+                       _yaml_text(team_file, front_matter=True))
+
+    def _raw_text(self, path):
+        data = self.server.dataset
+        if path == '_data/locations.yml':
+            return _yaml_text(data.locations)
+        for (prefix, suffix) in (('_data/team/', '.yml'), ('_team/', '.md')):
+            if path.startswith(prefix) and path.endswith(suffix):
+                username = path[len(prefix):-len(suffix)]
+                if username in data.team_files:
+                    return _yaml_text(data.team_files[username],
+                                      front_matter=suffix == '.md')
+
+    def _raw(self, ref, path):
+        data = self.server.dataset
+        if path == '_data/authors.yml' and ref.startswith('month-'):
+            day = datetime.strptime(ref[len('month-'):], '%Y-%m-%d').date()
+            return self._send(200, yaml.safe_dump(data.authors_by_month[day]),
+                              content_type='text/plain')
+        text = self._raw_text(path)
+        if text is None:
+            return self._send(404, '404: Not Found', content_type='text/plain')
+        self._send(200, text, content_type='text/plain')
+
+
+def _route(path, parts):
+    "Name of the route serving `path`, as counted in `request_counts`."
+    if parts[0] == 'repos' and parts[3:] == ['issues', 'events']:
+        return 'repo_events'
+    if parts[0] == 'repos' and parts[3:4] == ['issues']:
+        return 'issues' if len(parts) == 4 else 'events'
+    if parts[0] == 'repos' and parts[3:4] in (['commits'], ['contents']):
+        return parts[3]
+    if parts[0] == 'repos' and parts[3:5] == ['git', 'trees']:
+        return 'trees'
+    if parts[0] == 'raw':
+        return 'raw'
+    if path == '/site-api/authors.json':
+        return 'site'
+    return 'not_found'
+
+
+def _yaml_text(data, front_matter=False):
+    "`data` as a Jekyll data file, or as front matter of an empty page."
+    text = '---\n' + yaml.safe_dump(data, default_flow_style=False)
+    if front_matter:
+        text += '---\n'
+    return text
+
+
+def _sha(text):
+    "Git's blob SHA for `text`."
+    content = text.encode('utf-8')
+    header = 'blob {0}\0'.format(len(content)).encode('utf-8')
+    return hashlib.sha1(header + content).hexdigest()
@@ -0,0 +1,89 @@
+"""Measures cold import time of the CLI and the test suite.
+
+Runs each target in a fresh interpreter under `python -X importtime`
+(Python 3.7+), sums the cumulative time of every top-level import, and
+compares the fastest of several runs against the budget in budgets.json.
+
+    python benchmarks/importtime.py [--runs 5] [--output results.json]
+
+Exits non-zero if any target is over budget, and raises if one fails to
+run, since a crash part way through would import less and look fast.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'budgets.json')
+
+TARGETS = {
+    'manage_help': ['manage.py', '--help'],
+    'test_suite': ['-m', 'nose', '--collect-only', 'test.py'],
+}
+
+
+def parse_importtime(stderr):
+    """Returns total import time in milliseconds from -X importtime output.
+
+    Only top-level imports (those not indented under another import) are
+    summed, since their cumulative times already include their children."""
+    total_us = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # header row
+        name = fields[2]
+        if name.startswith(' ') and not name.startswith('  '):
+            total_us += int(fields[1])
+    return total_us / 1000.0
+
+
+def measure(args, runs):
+    """Fastest total import time, in ms, over `runs` fresh interpreters.
+    Raises RuntimeError if a run exits with an error."""
+    timings = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                              cwd=ROOT, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            errors = [line for line in proc.stderr.splitlines()
+                      if not line.startswith('import time:')]
+            raise RuntimeError('{0} exited with status {1}:\n{2}'.format(
+                ' '.join(args), proc.returncode, '\n'.join(errors[-20:])))
+        timings.append(parse_importtime(proc.stderr))
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    options = parser.parse_args()
+
+    with open(BUDGETS) as budget_file:
+        budgets = json.load(budget_file)['importtime_ms']
+    results = {}
+    over_budget = []
+    for (name, args) in sorted(TARGETS.items()):
+        results[name] = measure(args, options.runs)
+        budget = budgets[name]
+        print('{0:<12} {1:8.1f} ms  (budget {2} ms)'.format(
+            name, results[name], budget))
+        if results[name] > budget:
+            over_budget.append(name)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if over_budget:
+        print('Over budget: {0}'.format(', '.join(over_budget)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
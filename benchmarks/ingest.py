@@ -0,0 +1,156 @@
+"""Benchmarks ingestion against a local GitHub stand-in at several scales.
+
+Runs `DutyStation.fill`, `Author.fetch` (30 to 150 months of authors.yml
+history) and `Issue.fetch` (100 to 10,000 issues) against synthetic data
+served by `github_standin`, each in a fresh process on an emptied
+database, and reports wall-clock time, HTTP requests, SQL statements and
+peak RSS.
+
+    FLASK_CONFIG=testing python benchmarks/ingest.py [--quick]
+
+Uses the database of the active FLASK_CONFIG, whose contents are deleted.
+Results are saved as JSON under benchmarks/results/ for comparison.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, HERE]
+os.environ.setdefault('GITHUB_USER', 'benchmark')
+os.environ.setdefault('GITHUB_AUTH', 'benchmark')
+
+CASES = [('duty_stations', 0)] + \
+    [('authors', months) for months in (30, 90, 150)] + \
+    [('issues', n) for n in (100, 1000, 10000)]
+QUICK_CASES = [('duty_stations', 0), ('authors', 30), ('issues', 100)]
+
+
+def _app():
+    from config import config
+    from app import db
+    from app.app import app
+    app.config.from_object(config[os.getenv('FLASK_CONFIG') or 'testing'])
+    db.init_app(app)
+    return app
+
+
+def run_case(scenario, scale, trace_memory=False):
+    """Runs one scenario in this process; returns its measurements.
+
+    With `trace_memory`, tracemalloc records the peak memory of decoding
+    each page of issues (slow)."""
+    from sqlalchemy import event
+    from github_standin import Dataset, GitHubStandIn
+    from app import db, models
+    from lib.git_parse import site_api, drafts_api, hub_api
+    from lib.git_parse import ISSUE_PAGE_PEAK_BYTES
+
+    if scenario == 'authors':
+        dataset = Dataset(n_issues=0, n_months=scale)
+    elif scenario == 'issues':
+        dataset = Dataset(n_issues=scale, n_months=1)
+    else:
+        dataset = Dataset(n_issues=0, n_months=1)
+    standin = GitHubStandIn(dataset).start()
+    standin.point(site_api, drafts_api, hub_api)
+    models.SITE_AUTHORS_URL = standin.url + '/site-api/authors.json'
+    models.Month.FIRST_MONTH_OF_BLOG = dataset.first_month
+
+    app = _app()
+    with app.app_context():
+        for tbl in reversed(db.metadata.sorted_tables):
+            db.engine.execute(tbl.delete())
+        if scenario != 'duty_stations':
+            models.DutyStation.fill()
+        db.session.commit()
+        standin.request_counts.clear()
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(1))
+
+        if trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        if scenario == 'duty_stations':
+            models.DutyStation.fill()
+        elif scenario == 'authors':
+            models.Author.fetch()
+        else:
+            models.Issue.fetch(since=models.GithubQueryLog.last_query_datetime(
+                models.Issue.watermark(drafts_api.full_name)))
+        elapsed = time.time() - start
+    standin.stop()
+    pages = [s for s in ISSUE_PAGE_PEAK_BYTES.samples() if s[0] == '_bucket']
+    page_peak = None
+    if pages:
+        # Upper bound of the highest non-empty bucket
+        counts = [(s[2][0][1], s[3]) for s in pages]
+        page_peak = next(float(bound) for (bound, count) in counts
+                         if count == counts[-1][1])
+    return {
+        'page_peak_bytes_at_most': page_peak,
+        'scenario': scenario,
+        'scale': scale,
+        'seconds': round(elapsed, 3),
+        'http_requests': standin.total_requests(),
+        'http_requests_by_route': standin.request_counts,
+        'sql_statements': len(statements),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='run only the smallest scale of each scenario')
+    parser.add_argument('--output', help='results file (default: '
+                        'benchmarks/results/ingest-<timestamp>.json)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also record peak memory per page of issues '
+                        '(much slower)')
+    parser.add_argument('--case', nargs=2, metavar=('SCENARIO', 'SCALE'),
+                        help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.case:
+        print(json.dumps(run_case(options.case[0], int(options.case[1]),
+                                  options.trace_memory)))
+        return
+
+    results = []
+    print('{0:<14} {1:>6} {2:>9} {3:>8} {4:>8} {5:>8}'.format(
+        'scenario', 'scale', 'seconds', 'http', 'sql', 'rss MB'))
+    for (scenario, scale) in (QUICK_CASES if options.quick else CASES):
+        # A fresh process per case keeps peak RSS comparable
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--case', scenario, str(scale)] +
+            (['--trace-memory'] if options.trace_memory else []),
+            universal_newlines=True)
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print('{scenario:<14} {scale:>6} {seconds:>9} {http_requests:>8} '
+              '{sql_statements:>8} {peak_rss_mb:>8}'.format(**result))
+
+    output = options.output or os.path.join(
+        HERE, 'results',
+        'ingest-{0}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as results_file:
+        json.dump({'run_at': datetime.now().isoformat(), 'results': results},
+                  results_file, indent=2, sort_keys=True)
+    print('Saved {0}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
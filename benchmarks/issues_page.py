@@ -0,0 +1,179 @@
+"""Benchmarks the /issues/ page, buffered as it used to be and streamed.
+
+Fills the database with synthetic issues (each with two labels and a
+"ready to approve" milestone), then measures both ways of serving the page
+at several scales:
+
+*   buffered: every issue loaded through the ORM with its labels and
+    milestones, the whole page rendered, then gzipped, before the first byte
+    goes out, as /issues/ did before it streamed
+*   streamed: the /issues/ view itself, consumed through WSGI
+
+For each it reports time to first byte, total time, bytes sent and peak
+memory traced while serving (tracemalloc, Python 3.4+).
+
+    FLASK_CONFIG=testing python benchmarks/issues_page.py [--quick]
+
+Uses the database of the active FLASK_CONFIG, whose contents are deleted.
+Results are saved as JSON under benchmarks/results/ for comparison.
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, HERE]
+os.environ.setdefault('HTUSER', 'benchmark')
+os.environ.setdefault('HTAUTH', 'benchmark')
+
+SCALES = (1000, 10000, 50000)
+QUICK_SCALES = (1000, )
+
+
+def _app():
+    from config import config
+    from app import db
+    from app.app import app
+    app.config.from_object(config[os.getenv('FLASK_CONFIG') or 'testing'])
+    # Keep the view from syncing with GitHub first
+    app.config['BACKGROUND_SYNC'] = True
+    db.init_app(app)
+    return app
+
+
+def fill(n_issues):
+    "Empties the database, then adds `n_issues` synthetic issues."
+    from app import db
+    from app.models import Issue, Label, Milestone, labels_issues
+    for table in reversed(db.metadata.sorted_tables):
+        db.engine.execute(table.delete())
+    db.engine.execute(Label.__table__.insert(), [
+        {'id': n, 'name': name, 'url': ''}
+        for (n, name) in enumerate(('idea', 'draft', 'approved', 'blog'))])
+    today = date.today()
+    for start in range(0, n_issues, 5000):
+        numbers = range(start + 1, min(start + 5000, n_issues) + 1)
+        db.engine.execute(Issue.__table__.insert(), [{
+            'id': n, 'repo': '18F/blog-drafts', 'number': n,
+            'title': 'Synthetic blog post number {0}'.format(n),
+            'body': 'Body of post {0}. '.format(n) * 20, 'state': 'open',
+            'html_url': 'https://github.com/18F/blog-drafts/issues/{0}'
+                        .format(n),
+            'created_at': today - timedelta(days=n % 700),
+            'updated_at': today - timedelta(days=n % 90),
+        } for n in numbers])
+        db.engine.execute(labels_issues.insert(), [
+            {'issue_id': n, 'label_id': (n + k) % 4}
+            for n in numbers for k in (0, 1)])
+        db.engine.execute(Milestone.__table__.insert(), [{
+            'id': n, 'issue_id': n, 'title': 'ready to approve', 'url': '',
+            'created_at': today - timedelta(days=n % 60),
+        } for n in numbers])
+
+
+def buffered(app, headers):
+    "The page as /issues/ used to serve it: (TTFB, seconds, bytes, peak)."
+    from flask import render_template
+    from app.models import Issue
+    tracemalloc.start()
+    start = time.time()
+    with app.test_request_context('/issues/', headers=headers):
+        issues = []
+        for issue in Issue.query.all():
+            milestones = issue.milestones
+            issues.append({
+                'id': issue.id, 'title': issue.title,
+                'html_url': issue.html_url, 'created_at': issue.created_at,
+                'updated_at': issue.updated_at,
+                'labels': [l.name for l in issue.labels],
+                'approved_at': milestones[-1].created_at
+                if milestones and milestones[-1].title == 'ready to approve'
+                else None})
+        issues.sort(key=lambda i: i['updated_at'], reverse=True)
+        page = render_template('issues.html', issues=issues)
+        body = gzip.compress(page.encode('utf-8'))
+    ttfb = elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (ttfb, elapsed, len(body), peak)
+
+
+def streamed(app, headers):
+    "The /issues/ view through WSGI: (TTFB, seconds, bytes, peak)."
+    from werkzeug.test import EnvironBuilder
+    environ = EnvironBuilder('/issues/', headers=headers).get_environ()
+    statuses = []
+    tracemalloc.start()
+    start = time.time()
+    pieces = app.wsgi_app(environ, lambda status, headers, *exc_info:
+                          statuses.append(status))
+    size = 0
+    ttfb = None
+    for piece in pieces:
+        if ttfb is None:
+            ttfb = time.time() - start
+        size += len(piece)
+    if hasattr(pieces, 'close'):
+        pieces.close()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert statuses == ['200 OK'], statuses
+    return (ttfb, elapsed, size, peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='run only the smallest scale')
+    parser.add_argument('--output', help='results file (default: '
+                        'benchmarks/results/issues-page-<timestamp>.json)')
+    options = parser.parse_args()
+
+    from app.models import _mark_fresh, sync_state
+    app = _app()
+    for source in sync_state:
+        _mark_fresh(source)
+    credentials = base64.b64encode('{0}:{1}'.format(
+        os.environ['HTUSER'], os.environ['HTAUTH']).encode('utf-8'))
+    headers = {'Authorization': 'Basic ' + credentials.decode('ascii'),
+               'Accept-Encoding': 'gzip'}
+
+    results = []
+    print('{0:<9} {1:>6} {2:>9} {3:>9} {4:>10} {5:>10}'.format(
+        'path', 'issues', 'ttfb s', 'total s', 'gzip KB', 'peak MB'))
+    for n_issues in (QUICK_SCALES if options.quick else SCALES):
+        with app.app_context():
+            fill(n_issues)
+        for (path, serve) in (('buffered', buffered),
+                              ('streamed', streamed)):
+            (ttfb, elapsed, size, peak) = serve(app, headers)
+            result = {'path': path, 'issues': n_issues,
+                      'ttfb_seconds': round(ttfb, 4),
+                      'seconds': round(elapsed, 3),
+                      'gzip_kb': round(size / 1024.0, 1),
+                      'peak_mb': round(peak / 1024.0 ** 2, 1)}
+            results.append(result)
+            print('{path:<9} {issues:>6} {ttfb_seconds:>9} {seconds:>9} '
+                  '{gzip_kb:>10} {peak_mb:>10}'.format(**result))
+
+    output = options.output or os.path.join(
+        HERE, 'results', 'issues-page-{0}.json'.format(
+            datetime.now().strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as results_file:
+        json.dump({'run_at': datetime.now().isoformat(), 'results': results},
+                  results_file, indent=2, sort_keys=True)
+    print('Saved {0}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+"""Load-tests the dashboard as `manage.py deploy` serves it.
+
+Seeds the database with synthetic authors, months, issues, labels,
+milestones and events at `--scale` times roughly today's volume, starts
+`manage.py deploy --background` in a child process, with GitHub and Google
+Analytics replaced by local stand-ins, and has `--concurrency` viewers
+request /, /issues/ and /analytics/ in turn, each as soon as the last one
+is answered, for `--seconds`.  Reports throughput, p50/p95/p99 latency and
+error rate for each route, and the server's resident memory.
+
+    FLASK_CONFIG=testing python benchmarks/load_test.py --scale 10 \\
+        --concurrency 8
+    python benchmarks/load_test.py --compare OLD.json NEW.json
+
+Uses the database of the active FLASK_CONFIG, whose contents are deleted.
+Results are saved as JSON under benchmarks/results/ for comparison.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, HERE]
+# Settings the server needs, where the environment doesn't give them
+ENVIRONMENT = (('GITHUB_USER', 'benchmark'), ('GITHUB_AUTH', 'benchmark'),
+               ('HTUSER', 'benchmark'), ('HTAUTH', 'benchmark'),
+               ('ENV', 'local'))
+
+# Roughly today's data; --scale multiplies authors and issues
+BASE_AUTHORS = 120
+BASE_ISSUES = 1500
+LABELS = ('idea', 'draft', 'in progress', 'ready to approve', 'approved',
+          'on hold', 'blog', 'event', 'guide', 'hiring', 'open source',
+          'design')
+MILESTONES = ('drafting', 'ready to approve', 'ready to publish')
+EVENTS_PER_ISSUE = 6
+ROUTES = ('/', '/issues/', '/analytics/')
+PERCENTILES = (50, 95, 99)
+# Rows per INSERT while seeding
+BATCH_ROWS = 5000
+
+
+def _app():
+    from config import config
+    from app import db
+    from app.app import app
+    app.config.from_object(config[os.getenv('FLASK_CONFIG') or 'testing'])
+    db.init_app(app)
+    return app
+
+
+def _insert(table, rows):
+    from app import db
+    for start in range(0, len(rows), BATCH_ROWS):
+        db.engine.execute(table.insert(), rows[start:start + BATCH_ROWS])
+
+
+def seed(scale, rng_seed=18):
+    """Empties the database, then fills it with synthetic data at `scale`
+    times today's volume and marks every source freshly synced, so the
+    server doesn't sync before serving.  Returns the rows added by table."""
+    from app import db, partitions
+    from app.models import (Author, Event, GithubQueryLog, Issue, Label,
+                            Milestone, Month, author_months, issue_repos,
+                            labels_issues)
+    rng = random.Random(rng_seed)
+    for table in reversed(db.metadata.sorted_tables):
+        db.engine.execute(table.delete())
+
+    months = [Month.FIRST_MONTH_OF_BLOG]
+    while months[-1] < date.today().replace(day=1):
+        day = months[-1]
+        months.append(date(day.year + day.month // 12, day.month % 12 + 1, 1))
+    n_authors = int(BASE_AUTHORS * scale)
+    authors = [{'id': n, 'username': 'author{0}'.format(n),
+                'first_name': 'Author', 'last_name': str(n),
+                'full_name': 'Author {0}'.format(n),
+                'url': 'https://18f.gsa.gov/author/author{0}'.format(n)}
+               for n in range(1, n_authors + 1)]
+    # Each author is listed for a stretch of months after joining
+    memberships = []
+    for author in authors:
+        joined = rng.randrange(len(months))
+        stay = rng.randint(6, 60)
+        memberships.extend({'month_begin': month, 'author_id': author['id']}
+                           for month in months[joined:joined + stay])
+
+    repo = issue_repos()[0].full_name
+    n_issues = int(BASE_ISSUES * scale)
+    start = datetime(2014, 3, 1)
+    today = datetime.now()
+    issues = []
+    issue_labels = []
+    milestones = []
+    events = []
+    for number in range(1, n_issues + 1):
+        created = start + (today - start) * number / (n_issues + 1)
+        updated = min(today, created + timedelta(days=rng.randint(0, 120)))
+        issues.append({
+            'id': number, 'repo': repo, 'number': number,
+            'title': 'Synthetic blog post number {0}'.format(number),
+            'body': 'Body of post {0}. '.format(number) * rng.randint(5, 80),
+            'state': rng.choice(('open', 'open', 'closed')),
+            'html_url': 'https://github.com/{0}/issues/{1}'.format(
+                repo, number),
+            'created_at': created.date(), 'updated_at': updated.date(),
+        })
+        issue_labels.extend({'issue_id': number, 'label_id': label_id}
+                            for label_id in rng.sample(
+                                range(len(LABELS)), rng.randint(0, 3)))
+        for k in range(EVENTS_PER_ISSUE):
+            event_id = number * EVENTS_PER_ISSUE + k
+            day = min(today, created + timedelta(days=3 * k)).date()
+            events.append({'id': event_id, 'issue_id': number,
+                           'url': '', 'actor': 'author1', 'created_at': day,
+                           'event': 'milestoned' if k % 3 == 0
+                           else 'labeled'})
+            if k % 3 == 0:
+                milestones.append({'id': event_id, 'issue_id': number,
+                                   'title': MILESTONES[k // 3 % 3],
+                                   'url': '', 'created_at': day})
+
+    _insert(Label.__table__, [{'id': n, 'name': name, 'url': ''}
+                              for (n, name) in enumerate(LABELS)])
+    _insert(Month.__table__, [{'begin': month} for month in months])
+    _insert(Author.__table__, authors)
+    _insert(author_months, memberships)
+    _insert(Issue.__table__, issues)
+    _insert(labels_issues, issue_labels)
+    _insert(Milestone.__table__, milestones)
+    _insert(Event.__table__, events)
+    # Moves the events into monthly partitions, as the server's sync would
+    partitions.maintain()
+    for query_type in ('authors', 'author_months', Issue.watermark(repo)):
+        GithubQueryLog.log(query_type)
+    GithubQueryLog.log(Issue.events_watermark(repo),
+                       cursor=str(max([e['id'] for e in events] or [0])))
+    db.session.commit()
+    return {'author': len(authors), 'author_months': len(memberships),
+            'month': len(months), 'issue': len(issues),
+            'labels_issues': len(issue_labels),
+            'milestone': len(milestones), 'event': len(events)}
+
+
+def serve(port, ga_seconds):
+    """Runs `manage.py deploy --background` on `port`, with GitHub and
+    Google Analytics stand-ins; for the child process."""
+    from github_standin import Dataset, GitHubStandIn
+    from lib import ga
+    from lib.git_parse import site_api, drafts_api, hub_api
+    # Only duty stations are synced; seeding left the rest fresh
+    standin = GitHubStandIn(Dataset(n_issues=0, n_months=1)).start()
+    standin.point(site_api, drafts_api, hub_api)
+
+    def sessions_by_month(service, profile_id, start, end):
+        time.sleep(ga_seconds)
+        return str(1000 + sum(map(ord, start + end)))
+
+    ga.main = lambda: [None, 'load-test']
+    ga.get_sessions_by_month = sessions_by_month
+    os.environ['VCAP_APP_PORT'] = str(port)
+    sys.argv = [os.path.join(ROOT, 'manage.py'), 'deploy', '--background']
+    import manage
+    manage.manager.run()
+
+
+def _free_port():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def rss_mb(pid):
+    "Resident memory of process `pid` in MB, or None if it can't be read."
+    try:
+        with open('/proc/{0}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    try:
+        output = subprocess.check_output(['ps', '-o', 'rss=', '-p', str(pid)])
+        return int(output.strip()) / 1024.0
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+class MemorySampler(threading.Thread):
+    "Records the resident memory of a process every `interval` seconds."
+
+    def __init__(self, pid, interval=0.5):
+        threading.Thread.__init__(self, name='memory-sampler')
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            rss = rss_mb(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self
+
+
+def wait_until_ready(url, server, timeout=120):
+    "Polls /readyz until the server has synced every source."
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('The server exited with {0}'.format(
+                server.returncode))
+        try:
+            if requests.get(url + '/readyz', timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('The server was not ready after {0}s'.format(timeout))
+
+
+def drive(url, routes, concurrency, seconds, auth):
+    """Has `concurrency` viewers request `routes` in turn for `seconds`;
+    returns a (route, seconds, ok) sample per request."""
+    samples = []
+    deadline = time.time() + seconds
+
+    def viewer(n):
+        session = requests.Session()
+        session.auth = auth
+        while time.time() < deadline:
+            route = routes[n % len(routes)]
+            n += 1
+            start = time.time()
+            try:
+                # The whole body is read, so streamed pages count in full
+                ok = session.get(url + route, timeout=60).status_code == 200
+            except requests.RequestException:
+                ok = False
+            samples.append((route, time.time() - start, ok))
+
+    threads = [threading.Thread(target=viewer, args=(n, ),
+                                name='viewer-{0}'.format(n))
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def percentile(values, p):
+    "The nearest-rank `p`th percentile of sorted `values`."
+    if not values:
+        return None
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[rank - 1]
+
+
+def summarize(samples, seconds):
+    """Requests, throughput, latency percentiles (ms) and error rate of the
+    samples of each route, and of all of them as 'all'."""
+    by_route = {'all': samples}
+    for sample in samples:
+        by_route.setdefault(sample[0], []).append(sample)
+    summary = {}
+    for (route, route_samples) in by_route.items():
+        latencies = sorted(s[1] for s in route_samples)
+        errors = sum(1 for s in route_samples if not s[2])
+        stats = {
+            'requests': len(route_samples),
+            'requests_per_second': round(len(route_samples) / seconds, 2),
+            'error_rate': round(errors / float(len(route_samples) or 1), 4),
+        }
+        for p in PERCENTILES:
+            latency = percentile(latencies, p)
+            stats['p{0}_ms'.format(p)] = latency and round(latency * 1000, 1)
+        summary[route] = stats
+    return summary
+
+
+def compare(old, new):
+    """Rows of (route, metric, old value, new value, change in percent) for
+    two saved runs."""
+    rows = []
+    metrics = ['requests_per_second'] + \
+        ['p{0}_ms'.format(p) for p in PERCENTILES] + ['error_rate']
+    for route in sorted(set(old['routes']) & set(new['routes'])):
+        for metric in metrics:
+            (before, after) = (old['routes'][route][metric],
+                               new['routes'][route][metric])
+            change = None
+            if before and after is not None:
+                change = round((after - before) * 100.0 / before, 1)
+            rows.append((route, metric, before, after, change))
+    for metric in ('peak_rss_mb', 'final_rss_mb'):
+        (before, after) = (old['server'][metric], new['server'][metric])
+        change = None
+        if before and after is not None:
+            change = round((after - before) * 100.0 / before, 1)
+        rows.append(('server', metric, before, after, change))
+    return rows
+
+
+def print_comparison(old_path, new_path):
+    with open(old_path) as old_file, open(new_path) as new_file:
+        (old, new) = (json.load(old_file), json.load(new_file))
+    for (name, run) in (('old', old), ('new', new)):
+        print('{0}: {1} (scale {2[scale]}, concurrency {2[concurrency]}, '
+              '{2[seconds]}s)'.format(name, run['run_at'], run['settings']))
+    print('{0:<12} {1:<20} {2:>10} {3:>10} {4:>9}'.format(
+        'route', 'metric', 'old', 'new', 'change %'))
+    for row in compare(old, new):
+        print('{0:<12} {1:<20} {2!s:>10} {3!s:>10} {4!s:>9}'.format(*row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help="data volume, as a multiple of today's "
+                        '(default 1)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='viewers requesting pages at once (default 4)')
+    parser.add_argument('--seconds', type=float, default=30,
+                        help='how long to apply load (default 30)')
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help='comma-separated paths requested in turn')
+    parser.add_argument('--ga-seconds', type=float, default=0.25,
+                        help='latency of the Google Analytics stand-in')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='keep the data already in the database')
+    parser.add_argument('--output', help='results file (default: '
+                        'benchmarks/results/load-<timestamp>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved runs instead')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    for (variable, value) in ENVIRONMENT:
+        os.environ.setdefault(variable, value)
+    if options.serve:
+        return serve(options.serve, options.ga_seconds)
+    if options.compare:
+        return print_comparison(*options.compare)
+
+    counts = None
+    if not options.no_seed:
+        app = _app()
+        with app.app_context():
+            counts = seed(options.scale)
+        print('Seeded {0}'.format(', '.join(
+            '{0} {1}'.format(n, table) for (table, n) in sorted(
+                counts.items()))))
+
+    port = _free_port()
+    url = 'http://127.0.0.1:{0}'.format(port)
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--serve', str(port),
+                               '--ga-seconds', str(options.ga_seconds)])
+    try:
+        wait_until_ready(url, server)
+        routes = [r.strip() for r in options.routes.split(',') if r.strip()]
+        auth = (os.environ['HTUSER'], os.environ['HTAUTH'])
+        # One untimed pass, so first-request costs aren't counted
+        for route in routes:
+            requests.get(url + route, auth=auth, timeout=60)
+        sampler = MemorySampler(server.pid)
+        sampler.start()
+        samples = drive(url, routes, options.concurrency, options.seconds,
+                        auth)
+        sampler.stop()
+        final_rss = rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {
+        'run_at': datetime.now().isoformat(),
+        'settings': {'scale': options.scale,
+                     'concurrency': options.concurrency,
+                     'seconds': options.seconds, 'routes': routes,
+                     'ga_seconds': options.ga_seconds},
+        'rows': counts,
+        'routes': summarize(samples, options.seconds),
+        'server': {'peak_rss_mb': round(max(sampler.samples or [0]), 1),
+                   'final_rss_mb': final_rss and round(final_rss, 1)},
+    }
+    print('{0:<12} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>7}'.format(
+        'route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'errors'))
+    for (route, stats) in sorted(result['routes'].items()):
+        print('{0:<12} {requests:>8} {requests_per_second:>8} {p50_ms!s:>9} '
+              '{p95_ms!s:>9} {p99_ms!s:>9} {error_rate:>7.1%}'.format(
+                  route, **stats))
+    print('server RSS: {peak_rss_mb} MB peak, {final_rss_mb} MB at the '
+          'end'.format(**result['server']))
+
+    output = options.output or os.path.join(
+        HERE, 'results',
+        'load-{0}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as results_file:
+        json.dump(result, results_file, indent=2, sort_keys=True)
+    print('Saved {0}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,57 @@ from datetime import timedelta
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
+def replica_binds(variable):
+    "SQLALCHEMY_BINDS with the read replica named by `variable`, if it's set."
+    url = os.environ.get(variable)
+    return {'replica': url} if url else {}
+
+
 class Config:
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_RECORD_QUERIES = True
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # With webhooks configured, polling GitHub is only a reconciliation pass
+    GITHUB_WEBHOOK_SECRET = os.environ.get('GITHUB_WEBHOOK_SECRET')
+    RECONCILE_TIMEDELTA = timedelta(days=7)
+    # Repositories whose issues are tracked, 'owner/repo[@branch]' each
+    ISSUE_REPOS = os.environ.get('ISSUE_REPOS',
+                                 '18F/blog-drafts@staging').split(',')
+    # Repositories whose issues are downloaded at once during a sync
+    ISSUE_SYNC_WORKERS = int(os.environ.get('ISSUE_SYNC_WORKERS', 4))
+    # Job queue (app/jobs.py): attempts per job, first retry delay (doubling
+    # after each attempt) and how long a job may run before it is requeued
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_SECONDS = 30
+    JOB_STALLED_SECONDS = 15 * 60
+    # Site build hooks /manage/ can trigger, and how long a requested
+    # rebuild waits for others to merge into it before it is sent
+    REBUILD_HOOKS = {'production': os.environ.get('PROD'),
+                     'staging': os.environ.get('STAGING')}
+    REBUILD_COALESCE_SECONDS = int(os.environ.get('REBUILD_COALESCE_SECONDS',
+                                                  30))
+    # Requests made with ?profile=1 (app/profiling.py): seconds between
+    # samples, where profiles are saved (default: instance/profiles) and
+    # how often each process may profile one
+    PROFILE_INTERVAL_SECONDS = 0.005
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')
+    PROFILE_MIN_INTERVAL_SECONDS = 60
+    # Monthly partitions of `event` (app/partitions.py): months of events
+    # kept besides the current one (unset: all), and where older partitions
+    # are archived before they are dropped (default: instance/archive)
+    EVENT_RETENTION_MONTHS = int(os.environ['EVENT_RETENTION_MONTHS']) \
+        if os.environ.get('EVENT_RETENTION_MONTHS') else None
+    PARTITION_ARCHIVE_DIR = os.environ.get('PARTITION_ARCHIVE_DIR')
+    # Reads of GET requests go to the 'replica' bind, if any (app/replica.py)
+    REPLICA_MAX_LAG_SECONDS = 30
+    REPLICA_LAG_CHECK_SECONDS = 5
 
 
 class DevelopmentConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'postgresql:///site-data-dev'
+    SQLALCHEMY_BINDS = replica_binds('DEV_REPLICA_DATABASE_URL')
     REFRESH_TIMEDELTA = timedelta(minutes=1)
 
 
@@ -20,6 +61,7 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'postgresql:///site-data-test'
+    SQLALCHEMY_BINDS = replica_binds('TEST_REPLICA_DATABASE_URL')
     WTF_CSRF_ENABLED = False
     REFRESH_TIMEDELTA = timedelta(minutes=1)
 
@@ -27,6 +69,7 @@ class TestingConfig(Config):
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'postgresql:///site-data'
+    SQLALCHEMY_BINDS = replica_binds('REPLICA_DATABASE_URL')
     REFRESH_TIMEDELTA = timedelta(hours=24)
 
 
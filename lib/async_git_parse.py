@@ -0,0 +1,315 @@
+"""Asyncio counterpart of `lib.git_parse.GitHub`, built on aiohttp.
+
+Requires Python 3.6+ and aiohttp.  Every `AsyncGitHub` shares one
+`ConnectionPool` by default: a single aiohttp session (so connections are
+reused across repos) and a bounded semaphore per host, so hundreds of
+requests can be in flight without overrunning any one host.  Requests get
+the timeouts and per-host circuit breakers of `lib.resilience`, as the
+blocking client's do.
+
+    async with ConnectionPool() as pool:
+        drafts = AsyncGitHub('blog-drafts', '18F', 'staging', pool=pool)
+        async for page in drafts.iter_issue_pages(since):
+            ...
+
+Methods return the same values as their `GitHub` namesakes, except that
+responses are `AsyncResponse` objects whose body has already been read, and
+issues are `IssueRecord`s decoded as they stream in, as from
+`GitHub.iter_issue_pages`.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+from lib import resilience
+from lib.git_parse import BEGINNING_OF_TIME, GitHub, GitHubError
+from lib.git_parse import IssueRecord, JSONArrayDecoder, _latest_update
+from lib.git_parse import endpoint_name, issue_query_params, record_error
+from lib.git_parse import record_response
+from lib.git_parse import yaml_segment, STREAM_CHUNK_SIZE
+
+DEFAULT_PER_HOST = 32
+_NEXT_LINK = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+class AsyncResponse(object):
+    "The parts of a `requests.Response` the GitHub clients use."
+
+    def __init__(self, status_code, headers, content, size=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        # Bytes received, which a streamed body doesn't keep in `content`
+        self.size = len(content) if size is None else size
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def next_url(self):
+        "URL of the next page, from the Link header, or None."
+        match = _NEXT_LINK.search(self.headers.get('Link', ''))
+        return match and match.group(1)
+
+
+class ConnectionPool(object):
+    """One aiohttp session plus a bounded semaphore per host.
+
+    Args:
+        per_host: requests allowed in flight to any one host
+    """
+
+    def __init__(self, per_host=DEFAULT_PER_HOST):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0,
+                                             limit_per_host=self.per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def semaphore(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.BoundedSemaphore(self.per_host)
+        return self._semaphores[host]
+
+    async def get(self, url, endpoint='default', on_chunk=None, **kwargs):
+        """GETs `url`, waiting for a slot on its host; returns AsyncResponse.
+
+        Uses `endpoint`'s timeouts and the host's circuit breaker from
+        `lib.resilience`, raising CircuitOpenError without calling if the
+        circuit is open.  With `on_chunk`, the body of a successful response
+        is passed to it chunk by chunk as it arrives, and not kept."""
+        host = urlparse(url).netloc
+        breaker = resilience.breaker_for(host)
+        if not breaker.allow():
+            resilience.CIRCUIT_REJECTIONS.inc(host=host)
+            raise resilience.CircuitOpenError(
+                'Circuit to {0} is open'.format(host))
+        (connect, read) = resilience.TIMEOUTS.get(endpoint,
+                                                  resilience.DEFAULT_TIMEOUT)
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(
+            sock_connect=connect, sock_read=read))
+        async with self.semaphore(host):
+            start = time.time()
+            try:
+                async with self.session.get(url, **kwargs) as response:
+                    if on_chunk is not None and response.status < 400:
+                        (content, size) = (b'', 0)
+                        async for chunk in response.content.iter_chunked(
+                                STREAM_CHUNK_SIZE):
+                            size += len(chunk)
+                            on_chunk(chunk)
+                    else:
+                        content = await response.read()
+                        size = len(content)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.record_failure()
+                raise
+        if response.status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+            resilience.latencies_for(host, endpoint).add(time.time() - start)
+        return AsyncResponse(response.status, response.headers, content,
+                             size)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncGitHub(object):
+    """Async client for one repository; see `lib.git_parse.GitHub`.
+
+    Args:
+        repo, owner, branch: as for `GitHub`
+        pool: `ConnectionPool` to share with other clients
+    """
+
+    def __init__(self, repo, owner, branch='master', pool=None):
+        self.repo = repo.strip()
+        self.owner = owner.strip()
+        self.branch = branch
+        self.api = "https://api.github.com"
+        self.raw = "https://raw.githubusercontent.com"
+        self.user = os.environ['GITHUB_USER']
+        self.auth = os.environ['GITHUB_AUTH']
+        self.pool = pool or ConnectionPool()
+
+    @classmethod
+    def like(cls, gh, pool=None):
+        "An AsyncGitHub for the same repo and hosts as GitHub `gh`."
+        client = cls(gh.repo, gh.owner, gh.branch, pool=pool)
+        client.api = gh.api
+        client.raw = gh.raw
+        return client
+
+    full_name = GitHub.full_name
+    git_url = GitHub.git_url
+
+    async def _get(self, url, endpoint, **kwargs):
+        start = time.time()
+        try:
+            response = await self.pool.get(url, endpoint, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                resilience.CircuitOpenError):
+            record_error(self.full_name, endpoint, time.time() - start)
+            raise
+        record_response(self.full_name, endpoint, time.time() - start,
+                        response.status_code, response.size,
+                        response.headers)
+        return response
+
+    async def fetch_raw(self, request_string):
+        url = "%s/%s" % (self.raw, request_string)
+        content = await self._get(url, 'raw')
+        return content if content.ok else False
+
+    async def raw_file(self, path):
+        return await self.fetch_raw('{0}/{1}/{2}/{3}'.format(
+            self.owner, self.repo, self.branch, path))
+
+    async def yaml(self, path, segment_number, default={}):
+        raw = await self.raw_file(path)
+        if raw:
+            return yaml_segment(raw.text, segment_number) or {}
+        return default
+
+    async def fetch_endpoint(self, endpoint, params=None):
+        content = await self._get(
+            self.git_url(endpoint), endpoint_name(endpoint),
+            params=params or {},
+            auth=aiohttp.BasicAuth(self.user, self.auth))
+        return content if content.ok else False
+
+    async def fetch_commits(self, params=None):
+        commits = await self.fetch_endpoint('commits', params=params)
+        return commits.json() if commits else False
+
+    async def file_at_commit(self, sha, filename):
+        url = "%s/%s/%s/%s" % (self.owner, self.repo, sha, filename)
+        contents = await self.fetch_raw(url)
+        return (contents and contents.content) or ''
+
+    async def blob_sha(self, path):
+        contents = await self.fetch_endpoint('contents/{0}'.format(path),
+                                             params={'ref': self.branch})
+        return (contents and contents.json().get('sha')) or False
+
+    async def tree_shas(self, directory):
+        tree = await self.fetch_endpoint('git/trees/{0}:{1}'.format(
+            self.branch, directory.rstrip('/')))
+        if not tree:
+            return False
+        tree = tree.json()
+        if tree.get('truncated'):
+            return None
+        return dict((directory + entry['path'], entry['sha'])
+                    for entry in tree['tree'] if entry['type'] == 'blob')
+
+    async def iter_issue_pages(self, since=BEGINNING_OF_TIME, seen=(),
+                               **params):
+        """Yields lists of `IssueRecord`s not seen on an earlier page, or
+        among the numbers in `seen`, oldest update first.  The request for
+        each page is sent before the previous page is yielded, so it
+        overlaps with the caller's work on that page.  Raises GitHubError if
+        a page can't be fetched."""
+        params = issue_query_params(since, params)
+        page = await self._issue_page(dict(params))
+        async for issues in self._issue_pages(page, params, seen):
+            yield issues
+
+    async def _issue_page(self, params):
+        "One page of issues, projected to `IssueRecord`s as it streams in."
+        decoder = JSONArrayDecoder()
+        page = []
+
+        def on_chunk(chunk):
+            page.extend(IssueRecord(i) for i in decoder.feed(chunk))
+
+        response = await self._get(
+            self.git_url('issues'), 'issues', params=params,
+            auth=aiohttp.BasicAuth(self.user, self.auth), on_chunk=on_chunk)
+        if not response.ok:
+            raise GitHubError('Fetching issues of {0} failed with HTTP {1}'
+                              .format(self.full_name, response.status_code))
+        page.extend(IssueRecord(i) for i in decoder.close())
+        return page
+
+    async def _issue_pages(self, page, params, seen=()):
+        seen = set(seen)
+        while True:
+            new_issues = [i for i in page if i.number not in seen]
+            if not new_issues:
+                return
+            seen.update(i.number for i in new_issues)
+            # Github seems to be ignoring `sort` parameter, so each page
+            # starts at the latest update of the one before
+            params['since'] = _latest_update(new_issues)
+            next_page = asyncio.ensure_future(
+                self._issue_page(dict(params)))
+            try:
+                yield new_issues
+            except GeneratorExit:
+                next_page.cancel()
+                raise
+            page = await next_page
+
+    async def fetch_issues(self, since=BEGINNING_OF_TIME, **params):
+        params = issue_query_params(since, params)
+        try:
+            page = await self._issue_page(dict(params))
+        except GitHubError:
+            return False
+        result = {}
+        async for issues in self._issue_pages(page, params):
+            result.update((i.number, i) for i in issues)
+        return result.values()
+
+    async def iter_repo_events(self, after_id=0):
+        "Yields pages of the repository's issue event feed after `after_id`."
+        page = await self.fetch_endpoint('issues/events',
+                                         params={'per_page': 100})
+        while True:
+            if not page:
+                raise GitHubError('Fetching issue events of {0} failed'
+                                  .format(self.full_name))
+            events = page.json()
+            new_events = [e for e in events if e['id'] > after_id]
+            if new_events:
+                yield new_events
+            next_url = page.next_url()
+            if len(new_events) < len(events) or not next_url:
+                return
+            response = await self._get(next_url, 'events',
+                                       auth=aiohttp.BasicAuth(self.user,
+                                                              self.auth))
+            page = response if response.ok else False
+
+
+async def collect(pages):
+    "Lists what the async iterator `pages` yields."
+    return [page async for page in pages]
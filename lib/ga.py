@@ -1,13 +1,5 @@
 import os
 import json
-from apiclient.http import HttpRequest
-from apiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
-
-import httplib2
-from oauth2client import client
-from oauth2client import file
-from oauth2client import tools
 
 def get_service(scope, key_file_location, service_account_email):
     """Get a service that communicates to Google's API
@@ -19,6 +11,11 @@ def get_service(scope, key_file_location, service_account_email):
     returns:
         a service that is connected to the specified API
     """
+    # Imported here so that importing this module stays cheap
+    import httplib2
+    from apiclient.discovery import build
+    from oauth2client.service_account import ServiceAccountCredentials
+
     with open(key_file_location) as data_file:
         key = json.load(data_file)
     credentials = ServiceAccountCredentials.from_json_keyfile_name( key_file_location, scope )
@@ -1,11 +1,167 @@
-import os, requests, yaml
+import os, yaml
+import codecs
+import json
+import time
 import yaml
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+import requests
 from requests.auth import HTTPBasicAuth
 from datetime import datetime
+from lib import metrics, resilience
 
 GH_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 BEGINNING_OF_TIME = '1970-01-01T00:00:00Z'
 
+REQUEST_SECONDS = metrics.histogram(
+    'github_request_seconds', 'Latency of GitHub requests',
+    ('endpoint', 'repo'))
+RESPONSE_BYTES = metrics.counter(
+    'github_response_bytes_total', 'Bytes received from GitHub',
+    ('endpoint', 'repo'))
+RESPONSES = metrics.counter(
+    'github_responses_total', 'GitHub responses by HTTP status',
+    ('endpoint', 'repo', 'status'))
+RATELIMIT_REMAINING = metrics.gauge(
+    'github_ratelimit_remaining', 'X-RateLimit-Remaining of the last response',
+    ('repo', ))
+ISSUE_PAGE_PEAK_BYTES = metrics.histogram(
+    'github_issue_page_peak_bytes',
+    'Peak memory allocated while decoding one page of issues (only '
+    'recorded while tracemalloc is tracing)', ('repo', ),
+    buckets=[2 ** n for n in range(16, 28)])
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class GitHubError(Exception):
+    "A GitHub request needed to continue a sync failed."
+
+
+class IssueRecord(object):
+    """The fields of a GitHub issue that ingestion uses, and nothing else.
+
+    Reads like the issue's dict (`record['title']`, `record.get('body')`),
+    so it can be passed wherever issue data fetched from GitHub is."""
+    FIELDS = ('id', 'number', 'title', 'state', 'body', 'locked',
+              'comments', 'url', 'labels_url', 'html_url', 'events_url',
+              'created_at', 'updated_at', 'closed_at')
+    __slots__ = FIELDS + ('labels', 'user')
+
+    def __init__(self, issue_data):
+        for field in self.FIELDS:
+            setattr(self, field, issue_data.get(field))
+        self.labels = [{'name': l['name'], 'url': l.get('url'),
+                        'color': l.get('color')}
+                       for l in issue_data.get('labels') or ()]
+        user = issue_data.get('user') or {}
+        self.user = {'login': user.get('login')}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class JSONArrayDecoder(object):
+    """Decodes a JSON array arriving in byte chunks: each `feed` returns the
+    elements completed so far, without holding the whole document."""
+
+    def __init__(self, encoding='utf-8'):
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder(encoding)()
+        self._buf = ''
+        self._started = False
+
+    def feed(self, chunk, final=False):
+        """The elements completed by `chunk`; with `final`, the document
+        must end with it, else ValueError is raised."""
+        buf = self._buf + self._text_decoder.decode(chunk, final=final)
+        pos = 0
+        elements = []
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[]':
+                if buf[pos] == '[':
+                    self._started = True
+                pos += 1
+            if pos == len(buf) or not self._started:
+                break
+            try:
+                (element, pos) = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                break
+            elements.append(element)
+        self._buf = buf[pos:]
+        return elements
+
+    def close(self):
+        "The last elements; raises ValueError if the document is incomplete."
+        return self.feed(b'', final=True)
+
+
+def iter_json_array(chunks, encoding='utf-8'):
+    """Yields each element of the JSON array arriving as byte `chunks`,
+    decoding elements as soon as they are complete rather than holding the
+    whole document."""
+    decoder = JSONArrayDecoder(encoding)
+    for chunk in chunks:
+        for element in decoder.feed(chunk):
+            yield element
+    for element in decoder.close():
+        yield element
+
+
+def record_response(repo, endpoint, seconds, status, size, headers):
+    "Records one GitHub response in the request metrics."
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, repo=repo)
+    RESPONSE_BYTES.inc(size, endpoint=endpoint, repo=repo)
+    RESPONSES.inc(endpoint=endpoint, repo=repo, status=status)
+    remaining = headers.get('X-RateLimit-Remaining')
+    if remaining is not None:
+        RATELIMIT_REMAINING.set(int(remaining), repo=repo)
+
+
+def record_error(repo, endpoint, seconds):
+    """Records one GitHub request that got no response (it timed out, failed
+    to connect or found the circuit open), with the status 'error'."""
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, repo=repo)
+    RESPONSES.inc(endpoint=endpoint, repo=repo, status='error')
+
+
+def yaml_segment(text, segment_number):
+    """Splits Jekyll/YAML file content on ---, then YAML-parses and returns
+    the `segment_number`th element from the split."""
+    segments = text.split('---')
+    return yaml.load(segments[segment_number].replace("\t", ""))
+
+
+def issue_query_params(since, params):
+    "Query parameters for a page of issues updated at or after `since`."
+    try:
+        params['since'] = since.strftime(GH_DATE_FORMAT)
+    except AttributeError:
+        params['since'] = since  # did not need str conversion
+    params['per_page'] = params.get('per_page', 100)
+    params['sort'] = 'updated'
+    params['direction'] = 'asc'
+    return params
+
+
+def endpoint_name(endpoint):
+    "Logical name of a repository API endpoint, for metric labels."
+    path = endpoint.split('?')[0].strip('/')
+    if path.endswith('/events'):
+        return 'events'
+    return path.split('/')[0] or 'repo'
+
 
 class GitHub():
     def __init__(self, repo, owner, branch='master'):
@@ -31,6 +187,11 @@ class GitHub():
         self.user = os.environ['GITHUB_USER']
         self.auth = os.environ['GITHUB_AUTH']
 
+    @property
+    def full_name(self):
+        "'owner/repo', as GitHub writes it."
+        return '{0}/{1}'.format(self.owner, self.repo)
+
     def fetch_raw(self, request_string):
         """Gets the raw contents of a file from a raw.githubusercontent URL
         allowing you to fetch a file from a specific HEAD or SHA.
@@ -47,32 +208,45 @@ class GitHub():
 
         Returns the content if the request returns 200/OK or False."""
         url = "%s/%s" % (self.raw, request_string)
-        content = requests.get(url)
+        content = self._get(url, 'raw')
         if content.ok:
             return content
         else:
             return False
 
+    def _get(self, url, endpoint, **kwargs):
+        """GETs `url`, recording latency, size and status under `endpoint`.
+
+        Raw file fetches are hedged; see `lib.resilience`."""
+        start = time.time()
+        try:
+            response = resilience.get(url, endpoint, hedge=endpoint == 'raw',
+                                      **kwargs)
+        except requests.RequestException:
+            record_error(self.full_name, endpoint, time.time() - start)
+            raise
+        record_response(self.full_name, endpoint, time.time() - start,
+                        response.status_code, len(response.content),
+                        response.headers)
+        return response
+
     def raw_file(self, path, branch='staging'):
         "Gets raw file content (at STAGING) from github, given file path."
         request_string = '{owner}/{repo}/{branch}/{path}'.format(path=path,
                                                                ** self.__dict__)
         return self.fetch_raw(request_string)
 
-    def yaml(self, path, segment_number):
+    def yaml(self, path, segment_number, default={}):
         """Returns data from Jekyll/YAML file.
 
         Splits the file content on ---, then YAML-parses and returns the
-        `segment_number`th element from the split."""
+        `segment_number`th element from the split.  Returns `default` if the
+        file can't be fetched; pass None to tell that from an empty file."""
         raw = self.raw_file(path)
         if raw:
-            segments = raw.text.split('---')
-            clean_segment = segments[segment_number].replace("\t", "")
-            if clean_segment.find("\t") > 0:
-                import pdb; pdb.set_trace()
-            return yaml.load(clean_segment)
+            return yaml_segment(raw.text, segment_number) or {}
         else:
-            return {}
+            return default
 
     def git_url(self, endpoint):
         return "%s/repos/%s/%s/%s" % (self.api, self.owner, self.repo,
@@ -93,14 +267,41 @@ class GitHub():
         This will fetch all the data about 18F/18f.gsa.gov (see __init__)
         Example: gh.fetch_endpoint('issues?per_page=100')
         This will fetch the 100 most recent issues on gh.owner/gh.repo"""
-        content = requests.get(self.git_url(endpoint),
-                               params=params,
-                               auth=HTTPBasicAuth(self.user, self.auth))
+        content = self._get(self.git_url(endpoint), endpoint_name(endpoint),
+                            params=params,
+                            auth=HTTPBasicAuth(self.user, self.auth))
         if (content.ok):
             return content
         else:
             return False
 
+    def blob_sha(self, path):
+        """Returns the git blob SHA of `path` on this instance's branch, or
+        False if it cannot be fetched.  The SHA changes exactly when the
+        file's content does."""
+        contents = self.fetch_endpoint('contents/{0}'.format(path),
+                                       params={'ref': self.branch})
+        if contents:
+            return contents.json().get('sha') or False
+        return False
+
+    def tree_shas(self, directory):
+        """Maps the path of every file in `directory` (like '_data/team/') on
+        this instance's branch to its blob SHA, from one git tree request
+        for that directory alone.
+
+        Returns False if the tree can't be fetched, and None if GitHub
+        truncated it, so which files changed isn't known."""
+        tree = self.fetch_endpoint('git/trees/{0}:{1}'.format(
+            self.branch, directory.rstrip('/')))
+        if not tree:
+            return False
+        tree = tree.json()
+        if tree.get('truncated'):
+            return None
+        return dict((directory + entry['path'], entry['sha'])
+                    for entry in tree['tree'] if entry['type'] == 'blob')
+
     def fetch_commits(self, params={}):
         commits = self.fetch_endpoint('commits', params=params)
         if commits:
@@ -108,14 +309,71 @@ class GitHub():
         else:
             return False
 
+    def iter_issue_pages(self, since=BEGINNING_OF_TIME, seen=(), **params):
+        """Yields pages of issues not seen on an earlier page, or among the
+        numbers in `seen`, oldest update first, as lists of `IssueRecord`s.
+
+        Each page is decoded as it streams in and only the fields ingestion
+        uses are kept, so memory use does not grow with the repo.  Raises
+        GitHubError if a page can't be fetched."""
+        seen = set(seen)
+        while True:
+            (new_issues, since) = self.issue_page(since, seen, **params)
+            if not new_issues:
+                return
+            seen.update(i.number for i in new_issues)
+            yield new_issues
+
+    def issue_page(self, since=BEGINNING_OF_TIME, seen=(), **params):
+        """One step of `iter_issue_pages`: the issues updated at or after
+        `since` whose numbers are not in `seen`, and the `since` of the page
+        after them (None if there are no new issues).
+
+        Github seems to be ignoring `sort` parameter, so each page starts at
+        the latest update of the one before and repeats some of its issues.
+        Raises GitHubError if the page can't be fetched."""
+        page = self._issue_page(issue_query_params(since, dict(params)))
+        new_issues = [i for i in page if i.number not in seen]
+        return (new_issues, _latest_update(new_issues) if new_issues else None)
+
+    def _issue_page(self, params):
+        "One page of issues, projected to `IssueRecord`s as it streams in."
+        repo = self.full_name
+        tracing = tracemalloc is not None and tracemalloc.is_tracing()
+        if tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.time()
+        response = resilience.get(self.git_url('issues'), 'issues',
+                                  params=params,
+                                  auth=HTTPBasicAuth(self.user, self.auth),
+                                  stream=True)
+        received = [0]
+
+        def chunks():
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                received[0] += len(chunk)
+                yield chunk
+
+        if response.ok:
+            page = [IssueRecord(issue_data) for issue_data
+                    in iter_json_array(chunks(), response.encoding or 'utf-8')]
+        else:
+            page = None
+            list(chunks())
+        record_response(repo, 'issues', time.time() - start,
+                        response.status_code, received[0], response.headers)
+        if tracing:
+            ISSUE_PAGE_PEAK_BYTES.observe(
+                tracemalloc.get_traced_memory()[1] - baseline, repo=repo)
+        if page is None:
+            raise GitHubError('Fetching issues of {0} failed with HTTP {1}'
+                              .format(repo, response.status_code))
+        return page
+
     def fetch_issues(self, since=BEGINNING_OF_TIME, **params):
-        try:
-            params['since'] = since.strftime(GH_DATE_FORMAT)
-        except AttributeError:
-            params['since'] = since  # did not need str conversion
-        params['per_page'] = params.get('per_page', 100)
-        params['sort'] = 'updated'
-        params['direction'] = 'asc'
+        params = issue_query_params(since, params)
         issues = self.fetch_endpoint('issues', params=params)
         if not issues:
             return False
@@ -149,8 +407,29 @@ class GitHub():
         else:
             return False
 
-    def fetch_milestone(self, issue):
-        return self.fetch_issue_events(issue, 'milestoned')
+    def iter_repo_events(self, after_id=0):
+        """Yields pages of the repository's issue event feed, newest first,
+        up to but excluding event `after_id`; each event embeds its issue.
+
+        Stops at the first page that reaches `after_id`, so only pages
+        holding new events are downloaded.  Raises GitHubError if a page
+        can't be fetched."""
+        (url, params) = (self.git_url('issues/events'), {'per_page': 100})
+        while url:
+            page = self._get(url, 'events', params=params,
+                             auth=HTTPBasicAuth(self.user, self.auth))
+            if not page.ok:
+                raise GitHubError(
+                    'Fetching issue events of {0} failed with HTTP {1}'
+                    .format(self.full_name, page.status_code))
+            events = page.json()
+            new_events = [e for e in events if e['id'] > after_id]
+            if new_events:
+                yield new_events
+            if len(new_events) < len(events):
+                return
+            # The next page's URL carries the query parameters
+            (url, params) = (page.links.get('next', {}).get('url'), None)
 
     def file_at_commit(self, sha, filename):
         url = "%s/%s/%s/%s" % (self.owner, self.repo, sha, filename)
@@ -171,6 +450,21 @@ site_api = GitHub('18f.gsa.gov', '18F', branch='staging')
 drafts_api = GitHub('blog-drafts', '18F', branch='staging')
 hub_api = GitHub('hub', '18F', branch='master')
 
+_clients = dict((api.full_name, api) for api in (site_api, drafts_api, hub_api))
+
+
+def github_for(spec):
+    """The `GitHub` client for `spec`, 'owner/repo' or 'owner/repo@branch'
+    (branch defaults to master), made once per repo and reused after.
+
+    >>> github_for('18F/blog-drafts') is drafts_api
+    True"""
+    (full_name, _, branch) = spec.strip().partition('@')
+    if full_name not in _clients:
+        (owner, repo) = full_name.split('/')
+        _clients[full_name] = GitHub(repo, owner, branch=branch or 'master')
+    return _clients[full_name]
+
 
 def _latest_update(items, field_name='updated_at'):
     "Returns latest `field_name` in `items`"
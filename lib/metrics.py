@@ -0,0 +1,154 @@
+"""In-process metrics, rendered in the Prometheus text exposition format.
+
+    from lib import metrics
+    requests_total = metrics.counter('requests_total', 'Requests made',
+                                     ('endpoint', ))
+    requests_total.inc(endpoint='issues')
+    metrics.render()
+
+Metrics are kept in one process-wide registry and are safe to update from
+several threads."""
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for (name, value) in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{0} takes labels {1}, got {2}'.format(
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+    def samples(self):
+        "Yields (suffix, label values, extra labels, value) per sample."
+        with self._lock:
+            items = sorted(self._values.items())
+        for (key, value) in items:
+            yield ('', key, (), value)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for (suffix, key, extra, value) in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(
+                self.name, suffix, _format_labels(self.labelnames, key, extra),
+                _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, amount, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0])
+            (counts, total) = self._values[key]
+            counts[bisect.bisect_left(self.buckets, amount)] += 1
+            total[0] += amount
+
+    def value(self, **labels):
+        "Returns (observation count, sum) for the given labels."
+        found = self._values.get(self._key(labels))
+        if found:
+            return (sum(found[0]), found[1][0])
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total[0]))
+                           for (key, (counts, total)) in self._values.items())
+        for (key, (counts, total)) in items:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, counts):
+                cumulative += count
+                yield ('_bucket', key, (('le', _format_value(bound)), ),
+                       cumulative)
+            yield ('_count', key, (), cumulative)
+            yield ('_sum', key, (), total)
+
+
+def _register(cls, name, *args, **kwargs):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = cls(name, *args, **kwargs)
+        return _registry[name]
+
+
+def counter(name, documentation, labelnames=()):
+    "Returns the registered counter `name`, creating it if need be."
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    "Returns the registered gauge `name`, creating it if need be."
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    "Returns the registered histogram `name`, creating it if need be."
+    return _register(Histogram, name, documentation, labelnames,
+                     buckets=buckets)
+
+
+def render():
+    "All registered metrics, in Prometheus text format."
+    with _lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    return ''.join(m.render() + '\n' for m in metrics)
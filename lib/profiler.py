@@ -0,0 +1,201 @@
+"""A sampling profiler for one thread, with flame graph output.
+
+    profile = Profile(interval=0.005)
+    profile.start()            # samples the calling thread
+    ...
+    profile.stop()
+    profile.folded()           # 'frame;frame;frame count' lines
+    profile.svg()              # the same as a flame graph
+    profile.summary()          # time split and top functions, as a dict
+    profile.tree()             # indented call tree, as text
+
+A background thread records the profiled thread's stack every `interval`
+seconds, so the profiled code runs unmodified and other threads don't slow
+down.  Each sample is put in a category by the innermost frame of its stack
+that belongs to SQLAlchemy or psycopg2 ('sql'), an HTTP client ('http') or
+Jinja or a compiled template ('templates'); the rest are 'python'.  The
+folded output can also be loaded into speedscope or flamegraph.pl.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+import zlib
+try:
+    from html import escape
+except ImportError:  # Python 2
+    from cgi import escape
+
+# (category, substrings of the file paths of its frames), innermost first
+CATEGORIES = (
+    ('sql', ('sqlalchemy', 'psycopg2')),
+    ('http', ('/requests/', '/urllib3/', 'http/client', 'httplib',
+              '/aiohttp/', 'lib/resilience')),
+    ('templates', ('jinja2', '/templates/')),
+)
+MAX_DEPTH = 200
+
+
+def _label(code):
+    path = code.co_filename.replace(os.sep, '/').split('/')
+    return '{0} ({1}:{2})'.format(code.co_name, '/'.join(path[-2:]),
+                                  code.co_firstlineno)
+
+
+def _category(stack_paths):
+    for path in reversed(stack_paths):
+        for (category, markers) in CATEGORIES:
+            if any(marker in path for marker in markers):
+                return category
+    return 'python'
+
+
+class Profile(object):
+    """Samples of one thread's stack.
+
+    Args:
+        interval: seconds between samples
+        thread_id: ident of the thread to sample; the one calling `start`
+            by default
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        # stack (tuple of frame labels, outermost first) -> samples
+        self.stacks = collections.Counter()
+        self.categories = collections.Counter()
+        self.started_at = None
+        self.seconds = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.current_thread().ident
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._sample,
+                                        name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.seconds is None:
+            self._stopped.set()
+            self._thread.join()
+            self.seconds = time.time() - self.started_at
+        return self
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            paths = []
+            while frame is not None and len(labels) < MAX_DEPTH:
+                labels.append(_label(frame.f_code))
+                paths.append(frame.f_code.co_filename.replace(os.sep, '/'))
+                frame = frame.f_back
+            if labels:
+                # Frames were collected innermost first
+                self.stacks[tuple(reversed(labels))] += 1
+                self.categories[_category(list(reversed(paths)))] += 1
+
+    @property
+    def samples(self):
+        return sum(self.stacks.values())
+
+    def folded(self):
+        "The stacks in the folded format flame graph tools read."
+        return ''.join('{0} {1}\n'.format(';'.join(stack), count)
+                       for (stack, count) in sorted(self.stacks.items()))
+
+    def summary(self, top=20):
+        """Wall time, its split by category (fractions of the samples) and
+        the `top` functions by samples spent in them (self) and under them
+        (inclusive)."""
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for (stack, count) in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                inclusive[label] += count
+        total = float(self.samples or 1)
+        return {
+            'seconds': self.seconds,
+            'samples': self.samples,
+            'interval': self.interval,
+            'split': dict((category, round(count / total, 3))
+                          for (category, count) in self.categories.items()),
+            'self': [(label, round(count / total, 3))
+                     for (label, count) in own.most_common(top)],
+            'inclusive': [(label, round(count / total, 3))
+                          for (label, count) in inclusive.most_common(top)],
+        }
+
+    def _tree(self):
+        "Nested {label: [samples, children]} of the stacks."
+        root = [0, {}]
+        for (stack, count) in self.stacks.items():
+            root[0] += count
+            node = root
+            for label in stack:
+                node = node[1].setdefault(label, [0, {}])
+                node[0] += count
+        return root
+
+    def tree(self, min_fraction=0.01):
+        """The call tree as indented text, each line a function's share of
+        the samples; branches under `min_fraction` are left out."""
+        root = self._tree()
+        total = float(root[0] or 1)
+        lines = []
+
+        def walk(children, depth):
+            for (label, node) in sorted(children.items(),
+                                        key=lambda item: -item[1][0]):
+                if node[0] / total < min_fraction:
+                    continue
+                lines.append('{0:6.1%}  {1}{2}'.format(
+                    node[0] / total, '  ' * depth, label))
+                walk(node[1], depth + 1)
+
+        walk(root[1], 0)
+        return '\n'.join(lines) + '\n'
+
+    def svg(self, width=1200, row_height=16, min_width=0.5):
+        "A flame graph of the stacks, outermost frames at the bottom."
+        root = self._tree()
+        total = float(root[0] or 1)
+        rects = []
+
+        def depth_of(node):
+            return 1 + max([depth_of(child) for child in node[1].values()] or
+                           [0])
+
+        # The root is the thread itself, not drawn
+        height = (depth_of(root) - 1) * row_height
+
+        def walk(children, x, depth):
+            for (label, node) in sorted(children.items()):
+                w = node[0] / total * width
+                if w >= min_width:
+                    y = height - (depth + 1) * row_height
+                    hue = 10 + zlib.crc32(label.encode('utf-8')) % 40
+                    rects.append(
+                        '<g><title>{0} ({1:.1%})</title>'
+                        '<rect x="{2:.1f}" y="{3}" width="{4:.1f}" '
+                        'height="{5}" fill="hsl({6},70%,65%)" stroke="#fff"/>'
+                        '<text x="{7:.1f}" y="{8}">{9}</text></g>'.format(
+                            escape(label), node[0] / total, x, y, w,
+                            row_height, hue, x + 2, y + row_height - 4,
+                            escape(label[:int(w / 7)])))
+                    walk(node[1], x, depth + 1)
+                x += w
+
+        walk(root[1], 0, 0)
+        return (
+            '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" '
+            'height="{1}" font-family="monospace" font-size="11">\n'
+            '{2}\n</svg>\n'.format(width, height, '\n'.join(rects)))
@@ -0,0 +1,211 @@
+"""Timeouts, circuit breakers and hedged requests for upstream HTTP calls.
+
+    from lib import resilience
+    response = resilience.get(url, 'raw', hedge=True)
+
+Every call gets a (connect, read) timeout chosen by its endpoint name.  A
+circuit breaker per host opens after FAILURE_THRESHOLD failures in a row
+(connection errors, timeouts or 5xx responses) and, for RESET_SECONDS, fails
+calls to that host at once with CircuitOpenError; then one trial call is let
+through, and closes it again if it succeeds.  With `hedge`, meant for
+idempotent requests only, a duplicate request is sent once the first has run
+past the endpoint's recent p95 latency, and whichever answers first wins."""
+import collections
+import threading
+import time
+try:
+    import queue
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    import Queue as queue
+    from urlparse import urlparse
+import requests
+from lib import metrics
+
+# (connect, read) seconds by endpoint name
+TIMEOUTS = {
+    'raw': (3.05, 10),
+    'issues': (3.05, 30),
+    'events': (3.05, 20),
+    'site-api': (3.05, 10),
+    'rebuild': (3.05, 10),
+}
+DEFAULT_TIMEOUT = (3.05, 15)
+FAILURE_THRESHOLD = 5
+RESET_SECONDS = 30
+# Recent latencies kept per (host, endpoint), and how many before hedging
+LATENCY_WINDOW = 200
+MIN_HEDGE_SAMPLES = 20
+
+CIRCUIT_OPEN = metrics.gauge(
+    'http_circuit_open', '1 while the circuit breaker of a host is open',
+    ('host', ))
+CIRCUIT_REJECTIONS = metrics.counter(
+    'http_circuit_rejections_total', 'Calls failed fast by an open circuit',
+    ('host', ))
+HEDGED_REQUESTS = metrics.counter(
+    'http_hedged_requests_total', 'Duplicate requests sent to beat the p95',
+    ('endpoint', ))
+
+_breakers = {}
+_latencies = {}
+_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    "A call was refused because its host's circuit breaker is open."
+
+
+class CircuitBreaker(object):
+    """Tracks consecutive failures of calls to one host.
+
+    Closed, it lets every call through; open, none until `reset_seconds`
+    have passed; half-open, one trial call whose outcome closes or reopens
+    it."""
+
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD,
+                 reset_seconds=RESET_SECONDS):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        "True if a call may be made now."
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and \
+                    time.time() - self.opened_at >= self.reset_seconds:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+        CIRCUIT_OPEN.set(0, host=self.host)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or \
+                    self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.time()
+            opened = self.state == 'open'
+        if opened:
+            CIRCUIT_OPEN.set(1, host=self.host)
+
+
+class LatencyWindow(object):
+    "The last `size` latencies of one kind of call."
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction, min_samples=MIN_HEDGE_SAMPLES):
+        "The `fraction` quantile, or None with under `min_samples` samples."
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def breaker_for(host):
+    with _lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def latencies_for(host, endpoint):
+    with _lock:
+        if (host, endpoint) not in _latencies:
+            _latencies[(host, endpoint)] = LatencyWindow()
+        return _latencies[(host, endpoint)]
+
+
+def reset():
+    "Forgets every breaker and latency window."
+    with _lock:
+        _breakers.clear()
+        _latencies.clear()
+
+
+def _start(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+
+def _hedged(send, delay, endpoint):
+    """Calls `send`, and again if the first call takes over `delay` seconds;
+    returns the first response, or raises if both calls fail."""
+    outcomes = queue.Queue()
+
+    def attempt():
+        try:
+            outcomes.put((send(), None))
+        except Exception as e:
+            outcomes.put((None, e))
+
+    _start(attempt)
+    try:
+        (response, error) = outcomes.get(timeout=delay)
+    except queue.Empty:
+        HEDGED_REQUESTS.inc(endpoint=endpoint)
+        _start(attempt)
+        (response, error) = outcomes.get()
+        if error is not None:
+            (response, error) = outcomes.get()
+    if error is not None:
+        raise error
+    return response
+
+
+def request(method, url, endpoint='default', hedge=False, **kwargs):
+    """`requests.request`, with the endpoint's timeouts, the host's circuit
+    breaker and, if `hedge`, a hedged duplicate.  Raises CircuitOpenError
+    without calling if the host's circuit is open."""
+    kwargs.setdefault('timeout', TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+    host = urlparse(url).netloc
+    breaker = breaker_for(host)
+    latencies = latencies_for(host, endpoint)
+
+    def send():
+        if not breaker.allow():
+            CIRCUIT_REJECTIONS.inc(host=host)
+            raise CircuitOpenError('Circuit to {0} is open'.format(host))
+        start = time.time()
+        try:
+            response = requests.request(method, url, **kwargs)
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+            latencies.add(time.time() - start)
+        return response
+
+    delay = hedge and latencies.percentile(0.95)
+    if not delay:
+        return send()
+    return _hedged(send, delay, endpoint)
+
+
+def get(url, endpoint='default', hedge=False, **kwargs):
+    "`request('GET', ...)`."
+    return request('GET', url, endpoint, hedge=hedge, **kwargs)
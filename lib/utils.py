@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 from datetime import datetime
 
 
@@ -6,3 +8,19 @@ def to_py_date(timestamp_string):
         return datetime.strptime(timestamp_string, '%Y-%m-%dT%H:%M:%SZ').date()
     else:
         return None
+
+
+def valid_signature(secret, body, signature):
+    """True if `signature` is GitHub's HMAC of the bytes `body` under `secret`.
+
+    `signature` is an X-Hub-Signature-256 ("sha256=...") or X-Hub-Signature
+    ("sha1=...") header value."""
+    if not (secret and signature and '=' in signature):
+        return False
+    (algorithm, digest) = signature.split('=', 1)
+    if algorithm not in ('sha1', 'sha256'):
+        return False
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    expected = hmac.new(secret, body, getattr(hashlib, algorithm)).hexdigest()
+    return hmac.compare_digest(expected, str(digest))
@@ -1,13 +1,12 @@
 import os
 from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
-from app.app import app
-from lib.git_parse import GitHub
+from app.app import app, sync_in_background
 from datetime import date, timedelta
 from os import path, stat, environ
-from waitress import serve
 from config import config
-from app import db, models
+from app import db, export as exports, models, partitions as partitioning
+from app import snapshot as snapshots
 
 config_name = os.getenv('FLASK_CONFIG') or 'default'
 app.logger.info('Using FLASK_CONFIG {0} from environment'.format(config_name))
@@ -27,18 +26,53 @@ else:
 
 
 @manager.command
-def updatedata(days=0):
+def updatedata(days=0, concurrent=False, queue=False):
     """Refresh stored data from upstream sources.
 
     Args:
         days: Pull from each data source only if the last pull was at least
             this many days ago (default 0)
+        concurrent: Overlap all requests on an asyncio event loop
+            (Python 3.6+ and aiohttp)
+        queue: Enqueue the refresh as jobs for `worker` processes to run
     """
-    models.update_db_from_github(timedelta(days=days))
+    if queue:
+        from app import jobs
+        jobs.enqueue('sync', refresh_seconds=int(days) * 24 * 60 * 60)
+        db.session.commit()
+    elif concurrent:
+        from app import async_sync
+        async_sync.update_db_from_github(timedelta(days=days))
+    else:
+        models.update_db_from_github(timedelta(days=days))
 
 
 @manager.command
-def deploy():
+def worker(burst=False, poll=5):
+    """Run queued ingestion jobs (see `updatedata --queue`).
+
+    Any number of workers may run at once, on any node.
+
+    Args:
+        burst: Exit once no job is ready instead of waiting for more
+        poll: Seconds between checks of an empty queue (default 5)
+    """
+    from app import jobs
+    ran = jobs.work(burst=burst, poll_seconds=int(poll))
+    print('Ran {0} jobs'.format(ran))
+
+
+@manager.command
+def deploy(background=False):
+    """Serve the app.
+
+    Args:
+        background: Start serving immediately and sync upstream data in a
+            background thread instead of on page views
+    """
+    from waitress import serve
+    if background:
+        sync_in_background()
     port = int(environ["VCAP_APP_PORT"])
     serve(app, port=port)
 
@@ -46,8 +80,71 @@ def deploy():
 @manager.command
 def cleandata():
     "Deletes *all* stored data"
-    for tbl in reversed(db.metadata.sorted_tables):
-        db.engine.execute(tbl.delete())
+    snapshots.truncate_all()
+
+
+@manager.command
+def snapshot(archive='site-data-snapshot.tar.gz'):
+    """Dump all stored data to a compressed archive with COPY.
+
+    Args:
+        archive: Archive to write (default site-data-snapshot.tar.gz)
+    """
+    counts = snapshots.dump(archive)
+    print('Wrote {0} rows in {1} tables to {2}'.format(
+        sum(counts.values()), len(counts), archive))
+
+
+@manager.command
+def restore(archive='site-data-snapshot.tar.gz'):
+    """Replace *all* stored data with an archive written by `snapshot`.
+
+    Args:
+        archive: Archive to load (default site-data-snapshot.tar.gz)
+    """
+    counts = snapshots.load(archive)
+    print('Restored {0} rows in {1} tables from {2}'.format(
+        sum(counts.values()), len(counts), archive))
+
+
+@manager.command
+def export(directory='export', incremental=False, batch=10000):
+    """Export issues, events, milestones and author-months to Parquet.
+
+    Reads from the read replica when one is configured.
+
+    Args:
+        directory: Where to write a directory of files per table (default
+            export)
+        incremental: Export only rows written since the last export
+        batch: Rows per read and per Parquet row group
+    """
+    counts = exports.export_all(directory, incremental,
+                                batch_rows=int(batch))
+    print('Exported {0} rows in {1} tables to {2}'.format(
+        sum(counts.values()), len(counts), directory))
+
+
+@manager.command
+def partitions(retain=None, archive=None):
+    """Add upcoming monthly partitions of events and retire old ones.
+
+    Syncs do this too, with EVENT_RETENTION_MONTHS and PARTITION_ARCHIVE_DIR.
+
+    Args:
+        retain: Months of events to keep besides the current one (default
+            EVENT_RETENTION_MONTHS; unset keeps everything)
+        archive: Where to write partitions before dropping them (default
+            PARTITION_ARCHIVE_DIR, or instance/archive)
+    """
+    created = partitioning.maintain()
+    retain = retain or app.config.get('EVENT_RETENTION_MONTHS')
+    dropped = {}
+    if retain:
+        dropped = partitioning.apply_retention(
+            int(retain), archive or partitioning.archive_dir())
+    print('Created {0} partitions; dropped {1} ({2} rows)'.format(
+        len(created), len(dropped), sum(dropped.values())))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+"""Add a maintained full-text search vector to issue
+
+Revision ID: 1c8e5a4f3b20
+Revises: 2b1f6c0d9e7a
+Create Date: 2026-10-19 10:03:27.902115
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c8e5a4f3b20'
+down_revision = '2b1f6c0d9e7a'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column('issue', sa.Column('search_vector', postgresql.TSVECTOR(),
+                                     nullable=True))
+    op.execute("""
+        CREATE FUNCTION issue_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('english', COALESCE(NEW.title, '')), 'A') ||
+                setweight(to_tsvector('english', COALESCE(NEW.body, '')), 'B');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql""")
+    op.execute("""
+        CREATE TRIGGER issue_search_vector_update
+        BEFORE INSERT OR UPDATE OF title, body ON issue
+        FOR EACH ROW EXECUTE PROCEDURE issue_search_vector_update()""")
+    op.execute("UPDATE issue SET title = title")  # fills existing rows
+    op.create_index('ix_issue_search_vector', 'issue', ['search_vector'],
+                    postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_issue_search_vector', table_name='issue')
+    op.execute("DROP TRIGGER issue_search_vector_update ON issue")
+    op.execute("DROP FUNCTION issue_search_vector_update()")
+    op.drop_column('issue', 'search_vector')
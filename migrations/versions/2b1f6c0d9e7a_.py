@@ -0,0 +1,46 @@
+"""Add issue.user and the review_timeline table
+
+Revision ID: 2b1f6c0d9e7a
+Revises: 4ae15f91f93
+Create Date: 2026-10-19 09:12:44.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b1f6c0d9e7a'
+down_revision = '4ae15f91f93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('issue', sa.Column('user', sa.String(), nullable=True))
+    op.create_table('review_timeline',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('issue_id', sa.Integer(), nullable=True),
+    sa.Column('sequence', sa.Integer(), nullable=False),
+    sa.Column('stage', sa.String(), nullable=False),
+    sa.Column('entered_at', sa.Date(), nullable=False),
+    sa.Column('left_at', sa.Date(), nullable=True),
+    sa.ForeignKeyConstraint(['issue_id'], ['issue.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_review_timeline_issue_id'), 'review_timeline',
+                    ['issue_id'], unique=False)
+    # Backfill from milestones already stored
+    op.execute("""
+        INSERT INTO review_timeline
+            (issue_id, sequence, stage, entered_at, left_at)
+        SELECT issue_id, row_number() OVER w, title, created_at,
+               lead(created_at) OVER w
+        FROM milestone
+        WHERE issue_id IS NOT NULL AND created_at IS NOT NULL
+        WINDOW w AS (PARTITION BY issue_id ORDER BY created_at, id)""")
+
+
+def downgrade():
+    op.drop_index(op.f('ix_review_timeline_issue_id'),
+                  table_name='review_timeline')
+    op.drop_table('review_timeline')
+    op.drop_column('issue', 'user')
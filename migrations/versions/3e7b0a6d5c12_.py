@@ -0,0 +1,26 @@
+"""Add team file blob SHAs to author
+
+Revision ID: 3e7b0a6d5c12
+Revises: 5d2a9e7c41f8
+Create Date: 2026-10-19 12:02:51.660713
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e7b0a6d5c12'
+down_revision = '5d2a9e7c41f8'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('author', sa.Column('hub_blob_sha', sa.String(),
+                                      nullable=True))
+    op.add_column('author', sa.Column('site_blob_sha', sa.String(),
+                                      nullable=True))
+
+
+def downgrade():
+    op.drop_column('author', 'site_blob_sha')
+    op.drop_column('author', 'hub_blob_sha')
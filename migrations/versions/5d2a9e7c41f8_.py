@@ -0,0 +1,23 @@
+"""Add github_query_log.cursor
+
+Revision ID: 5d2a9e7c41f8
+Revises: 1c8e5a4f3b20
+Create Date: 2026-10-19 11:20:05.118420
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2a9e7c41f8'
+down_revision = '1c8e5a4f3b20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('github_query_log', sa.Column('cursor', sa.String(),
+                                                nullable=True))
+
+
+def downgrade():
+    op.drop_column('github_query_log', 'cursor')
@@ -0,0 +1,38 @@
+"""Key issues by (repo, number), with a sync watermark per repo
+
+Revision ID: 6a4c2e8b9d17
+Revises: 3e7b0a6d5c12
+Create Date: 2026-10-19 12:48:37.204511
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a4c2e8b9d17'
+down_revision = '3e7b0a6d5c12'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Every issue stored so far came from the blog drafts repo
+DRAFTS_REPO = '18F/blog-drafts'
+
+
+def upgrade():
+    op.add_column('issue', sa.Column('repo', sa.String(), nullable=True))
+    op.execute(sa.text('UPDATE issue SET repo = :repo')
+               .bindparams(repo=DRAFTS_REPO))
+    op.alter_column('issue', 'repo', nullable=False)
+    op.create_unique_constraint('issue_repo_number_key', 'issue',
+                                ['repo', 'number'])
+    op.execute(sa.text("UPDATE github_query_log SET query_type = :repo_type "
+                       "WHERE query_type = 'issues'")
+               .bindparams(repo_type='issues:' + DRAFTS_REPO))
+
+
+def downgrade():
+    op.execute(sa.text("UPDATE github_query_log SET query_type = 'issues' "
+                       "WHERE query_type = :repo_type")
+               .bindparams(repo_type='issues:' + DRAFTS_REPO))
+    op.execute("DELETE FROM github_query_log WHERE query_type LIKE 'issues:%'")
+    op.drop_constraint('issue_repo_number_key', 'issue', type_='unique')
+    op.drop_column('issue', 'repo')
@@ -0,0 +1,45 @@
+"""Add the job table
+
+Revision ID: 7f3b1d5e2a60
+Revises: 6a4c2e8b9d17
+Create Date: 2026-10-19 13:15:02.871630
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7f3b1d5e2a60'
+down_revision = '6a4c2e8b9d17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('args', sa.Text(), nullable=False),
+    sa.Column('state', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('run_after', sa.DateTime(), server_default=sa.text('now()'),
+              nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'),
+              nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('worker', sa.String(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('job_pending_kind_args', 'job', ['kind', 'args'],
+                    unique=True, postgresql_where=sa.text("state = 'pending'"))
+    op.create_index('job_pending_run_after', 'job', ['run_after'],
+                    postgresql_where=sa.text("state = 'pending'"))
+    op.create_index('job_finished_at', 'job', ['finished_at'])
+
+
+def downgrade():
+    op.drop_index('job_finished_at', table_name='job')
+    op.drop_index('job_pending_run_after', table_name='job')
+    op.drop_index('job_pending_kind_args', table_name='job')
+    op.drop_table('job')
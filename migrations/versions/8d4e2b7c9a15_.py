@@ -0,0 +1,83 @@
+"""Partition event by month of created_at
+
+Revision ID: 8d4e2b7c9a15
+Revises: 7f3b1d5e2a60
+Create Date: 2026-10-19 15:02:44.318207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4e2b7c9a15'
+down_revision = '7f3b1d5e2a60'
+
+from datetime import date
+from alembic import op
+import sqlalchemy as sa
+
+COLUMNS = 'id, commit_id, url, actor, event, created_at, issue_id'
+# Months past the current one given partitions up front
+AHEAD_MONTHS = 3
+
+
+def _next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def upgrade():
+    # Needs PostgreSQL 11+ (default partitions, indexes on partitioned
+    # tables).  A partitioned table's primary key must include created_at,
+    # which may be NULL, so ids are indexed rather than constrained.
+    op.execute('ALTER TABLE event RENAME TO event_unpartitioned')
+    op.execute('ALTER TABLE event_unpartitioned '
+               'RENAME CONSTRAINT event_pkey TO event_unpartitioned_pkey')
+    op.execute("""
+        CREATE TABLE event (
+            id integer NOT NULL,
+            commit_id integer,
+            url varchar,
+            actor varchar,
+            event varchar,
+            created_at date,
+            issue_id integer REFERENCES issue (id)
+        ) PARTITION BY RANGE (created_at)""")
+    op.execute('CREATE INDEX event_id_idx ON event (id)')
+    op.execute('CREATE INDEX event_issue_id_idx ON event (issue_id)')
+    op.execute('CREATE TABLE event_default PARTITION OF event DEFAULT')
+    first = op.get_bind().execute(
+        'SELECT min(created_at) FROM event_unpartitioned').scalar()
+    month = (first or date.today()).replace(day=1)
+    last = date.today().replace(day=1)
+    for _ in range(AHEAD_MONTHS):
+        last = _next_month(last)
+    while month <= last:
+        op.execute(sa.text(
+            'CREATE TABLE event_y{0:04d}m{1:02d} PARTITION OF event '
+            'FOR VALUES FROM (:lower) TO (:upper)'.format(
+                month.year, month.month))
+            .bindparams(lower=month.isoformat(),
+                        upper=_next_month(month).isoformat()))
+        month = _next_month(month)
+    op.execute('INSERT INTO event ({0}) SELECT {0} FROM event_unpartitioned'
+               .format(COLUMNS))
+    op.execute('DROP TABLE event_unpartitioned')
+
+
+def downgrade():
+    op.create_table('event_unpartitioned',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('commit_id', sa.Integer(), nullable=True),
+    sa.Column('url', sa.String(), nullable=True),
+    sa.Column('actor', sa.String(), nullable=True),
+    sa.Column('event', sa.String(), nullable=True),
+    sa.Column('created_at', sa.Date(), nullable=True),
+    sa.Column('issue_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['issue_id'], ['issue.id'], ),
+    sa.PrimaryKeyConstraint('id', name='event_unpartitioned_pkey')
+    )
+    op.execute('INSERT INTO event_unpartitioned ({0}) SELECT {0} FROM event'
+               .format(COLUMNS))
+    # Drops every partition with it
+    op.execute('DROP TABLE event')
+    op.execute('ALTER TABLE event_unpartitioned RENAME TO event')
+    op.execute('ALTER TABLE event '
+               'RENAME CONSTRAINT event_unpartitioned_pkey TO event_pkey')
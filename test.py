@@ -1,8 +1,23 @@
-from lib.git_parse import GitHub, drafts_api, GH_DATE_FORMAT
-import os, nose, json, requests, requests_mock, datetime
+from lib.git_parse import GitHub, drafts_api, hub_api, site_api, GH_DATE_FORMAT
+from lib.git_parse import endpoint_name, REQUEST_SECONDS, RESPONSES
+from lib.git_parse import RATELIMIT_REMAINING
+from lib.git_parse import GitHubError, IssueRecord, iter_json_array, github_for
+from lib import metrics, profiler, resilience
+from lib.utils import valid_signature
+import base64, gzip, hashlib, hmac
+import io, os, nose, json, requests, requests_mock, datetime, tempfile, zlib
 from nose.tools import with_setup
 from nose.plugins.skip import Skip, SkipTest
 from app.app import app
+from app import db, export, jobs, partitions, profiling, replica, streaming
+from app import webhooks
+from benchmarks.github_standin import Dataset, GitHubStandIn
+from benchmarks import load_test
+try:
+    import asyncio
+    from lib import async_git_parse
+except (ImportError, SyntaxError):  # Python < 3.6, or no aiohttp
+    async_git_parse = None
 
 ### GitHub Module tests ###
 
@@ -161,3 +176,1339 @@ def test_GitHub_fetch_assembles_multiple_pages(m):
     actual = drafts_api.fetch_issues(since=expected[0]['updated_at'],
                                      per_page=10)
     assert expected == list(actual)
+
+
+### Metrics tests ###
+
+
+def test_metrics_histogram_renders_cumulative_buckets():
+    h = metrics.histogram('test_latency_seconds', 'Test latency', ('route', ),
+                          buckets=(0.1, 1))
+    h.observe(0.05, route='a')
+    h.observe(0.5, route='a')
+    rendered = h.render()
+    assert 'test_latency_seconds_bucket{route="a",le="0.1"} 1.0' in rendered
+    assert 'test_latency_seconds_bucket{route="a",le="+Inf"} 2.0' in rendered
+    assert 'test_latency_seconds_count{route="a"} 2.0' in rendered
+
+
+def test_metrics_rejects_wrong_labels():
+    c = metrics.counter('test_events_total', 'Test events', ('kind', ))
+    nose.tools.assert_raises(ValueError, c.inc, color='red')
+
+
+def test_endpoint_name():
+    assert endpoint_name('issues') == 'issues'
+    assert endpoint_name('issues/12/events?per_page=100') == 'events'
+    assert endpoint_name('commits') == 'commits'
+
+
+@requests_mock.mock()
+def test_GitHub_fetch_endpoint_records_metrics(m):
+    g = GitHub('metrics-repo', '18F')
+    m.get(g.git_url('commits'), text='[]', status_code=200,
+          headers={'X-RateLimit-Remaining': '4321'})
+    g.fetch_endpoint('commits')
+    labels = {'endpoint': 'commits', 'repo': '18F/metrics-repo'}
+    assert REQUEST_SECONDS.value(**labels)[0] == 1
+    assert RESPONSES.value(status=200, **labels) == 1
+    assert RATELIMIT_REMAINING.value(repo='18F/metrics-repo') == 4321
+
+
+@with_setup(resilience.reset, resilience.reset)
+@requests_mock.mock()
+def test_GitHub_fetch_endpoint_records_failed_requests(m):
+    g = GitHub('metrics-error-repo', '18F')
+    m.get(g.git_url('commits'), exc=requests.exceptions.ConnectTimeout)
+    with nose.tools.assert_raises(requests.exceptions.ConnectTimeout):
+        g.fetch_endpoint('commits')
+    labels = {'endpoint': 'commits', 'repo': '18F/metrics-error-repo'}
+    assert REQUEST_SECONDS.value(**labels)[0] == 1
+    assert RESPONSES.value(status='error', **labels) == 1
+
+
+### Utility tests ###
+
+
+def test_valid_signature():
+    body = b'{"zen": "Keep it logically awesome."}'
+    signature = 'sha256=' + hmac.new(b'secret', body,
+                                     hashlib.sha256).hexdigest()
+    assert valid_signature('secret', body, signature)
+    assert not valid_signature('other secret', body, signature)
+    assert not valid_signature('secret', body + b' ', signature)
+    assert not valid_signature('secret', body, None)
+    assert not valid_signature(None, body, signature)
+
+
+def test_github_webhook_rejects_malformed_json():
+    body = b'{"action": "opened", '
+    signature = 'sha256=' + hmac.new(b'secret', body,
+                                     hashlib.sha256).hexdigest()
+    app.config['GITHUB_WEBHOOK_SECRET'] = 'secret'
+    try:
+        response = app.test_client().post(
+            '/webhooks/github', data=body,
+            headers={'X-GitHub-Event': 'issues',
+                     'X-Hub-Signature-256': signature})
+    finally:
+        del app.config['GITHUB_WEBHOOK_SECRET']
+    assert response.status_code == 400
+
+
+def _configured_app():
+    "`app` set up with the testing config, as manage.py would set it up."
+    from config import config
+    app.config.from_object(config['testing'])
+    db.init_app(app)
+    return app
+
+
+def _auth_headers():
+    "Basic auth headers for routes behind `requires_auth`."
+    if not (os.environ.get('HTUSER') and os.environ.get('HTAUTH')):
+        raise SkipTest('HTUSER and HTAUTH are not set')
+    credentials = '{0}:{1}'.format(os.environ['HTUSER'], os.environ['HTAUTH'])
+    return {'Authorization': 'Basic ' + base64.b64encode(
+        credentials.encode('utf-8')).decode('ascii')}
+
+
+def test_healthz():
+    response = _configured_app().test_client().get('/healthz')
+    assert response.status_code == 200
+    assert response.data == b'ok\n'
+
+
+def test_readyz_is_503_until_every_source_has_synced():
+    from app import models
+    saved = dict((source, dict(status))
+                 for (source, status) in models.sync_state.items())
+    client = _configured_app().test_client()
+
+    def readyz():
+        response = client.get('/readyz')
+        return (response.status_code,
+                json.loads(response.data.decode('utf-8')))
+
+    try:
+        for status in models.sync_state.values():
+            status.update(state='pending', ready_at=None)
+        (status_code, body) = readyz()
+        assert status_code == 503 and body['ready'] is False
+        with models._sync_phase('duty_stations'):
+            pass
+        models._mark_fresh('authors')
+        with nose.tools.assert_raises(GitHubError):
+            with models._sync_phase('issues'):
+                raise GitHubError('Syncing issues failed')
+        (status_code, body) = readyz()
+        assert status_code == 503
+        assert body['sources']['issues']['state'] == 'failed'
+        assert body['sources']['authors']['state'] == 'ready'
+        with models._sync_phase('issues'):
+            pass
+        (status_code, body) = readyz()
+        assert status_code == 200 and body['ready'] is True
+    finally:
+        for (source, status) in saved.items():
+            models.sync_state[source].clear()
+            models.sync_state[source].update(status)
+
+
+@requests_mock.mock()
+def test_GitHub_blob_sha(m):
+    g = GitHub('hub', '18F')
+    m.get(g.git_url('contents/_data/locations.yml'),
+          json={'sha': 'abc123', 'path': '_data/locations.yml'},
+          status_code=200)
+    assert g.blob_sha('_data/locations.yml') == 'abc123'
+    assert m.last_request.qs['ref'] == ['master']
+
+
+@requests_mock.mock()
+def test_GitHub_blob_sha_when_request_not_ok(m):
+    g = GitHub('hub', '18F')
+    m.get(g.git_url('contents/missing.yml'), status_code=404)
+    assert g.blob_sha('missing.yml') is False
+
+
+@requests_mock.mock()
+def test_GitHub_tree_shas(m):
+    g = GitHub('hub', '18F')
+    m.get(g.git_url('git/trees/master:_data/team'), json={
+        'truncated': False, 'tree': [
+            {'path': 'old', 'type': 'tree', 'sha': 't1'},
+            {'path': 'alice.yml', 'type': 'blob', 'sha': 'b1'},
+        ]}, status_code=200)
+    assert g.tree_shas('_data/team/') == {'_data/team/alice.yml': 'b1'}
+
+
+@requests_mock.mock()
+def test_GitHub_tree_shas_when_truncated(m):
+    g = GitHub('hub', '18F')
+    m.get(g.git_url('git/trees/master:_data/team'),
+          json={'truncated': True, 'tree': []}, status_code=200)
+    assert g.tree_shas('_data/team/') is None
+    m.get(g.git_url('git/trees/master:_data/team'), status_code=502)
+    assert g.tree_shas('_data/team/') is False
+
+
+@requests_mock.mock()
+def test_GitHub_yaml_tells_failure_from_empty_file(m):
+    g = GitHub('hub', '18F')
+    url = 'https://raw.githubusercontent.com/18F/hub/master/_data/team/'
+    m.get(url + 'alice.yml', text='---\nlocation: DCA\n', status_code=200)
+    m.get(url + 'bob.yml', text='---\n', status_code=200)
+    m.get(url + 'carol.yml', status_code=502)
+    assert g.yaml('_data/team/alice.yml', 1, None) == {'location': 'DCA'}
+    assert g.yaml('_data/team/bob.yml', 1, None) == {}
+    assert g.yaml('_data/team/carol.yml', 1, None) is None
+    assert g.yaml('_data/team/carol.yml', 1) == {}
+
+
+def test_iter_json_array_across_chunk_boundaries():
+    expected = [{'number': i, 'body': u'é "]}[, ' * i} for i in range(20)]
+    content = json.dumps(expected, ensure_ascii=False).encode('utf-8')
+    for size in (1, 7, 4096):
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        assert list(iter_json_array(chunks)) == expected
+
+
+def test_iter_json_array_truncated():
+    nose.tools.assert_raises(ValueError, list,
+                             iter_json_array([b'[{"number": 1}, {"numb']))
+
+
+def test_IssueRecord_keeps_only_used_fields():
+    record = IssueRecord({'number': 7, 'title': 'Draft', 'reactions': {},
+                          'user': {'login': 'alice', 'id': 1},
+                          'labels': [{'name': 'idea', 'id': 3}]})
+    assert record['number'] == 7
+    assert record.get('closed_at') is None
+    assert record.get('reactions') is None
+    assert record.user == {'login': 'alice'}
+    assert record.labels == [{'name': 'idea', 'url': None, 'color': None}]
+
+
+@requests_mock.mock()
+def test_GitHub_iter_issue_pages(m):
+    def _register_get(since, content):
+        url = '{0}?sort=updated&per_page=10&direction=asc&since={1}'.format(
+            drafts_api.git_url('issues'), since)
+        m.get(url, json=content, complete_qs=False, status_code=200)
+
+    last_since = datetime.datetime(2015, 1, 1).strftime(GH_DATE_FORMAT)
+    for offset in (0, 10):
+        issue_group = _issues(n_issues=10, offset=offset)
+        _register_get(last_since, issue_group)
+        last_since = issue_group[-1]['updated_at']
+    _register_get(last_since, [issue_group[-1]])
+
+    pages = list(drafts_api.iter_issue_pages(since=_issues()[0]['updated_at'],
+                                             per_page=10))
+    assert [[i.number for i in page] for page in pages] == \
+        [list(range(10)), list(range(10, 20))]
+
+
+@requests_mock.mock()
+def test_GitHub_iter_issue_pages_resumes_after_seen(m):
+    issue_group = _issues(n_issues=10)
+    since = issue_group[4]['updated_at']
+    m.get(drafts_api.git_url('issues'), json=issue_group[4:],
+          complete_qs=False, status_code=200)
+    m.get('{0}?since={1}'.format(drafts_api.git_url('issues'),
+                                 issue_group[-1]['updated_at']),
+          json=[issue_group[-1]], complete_qs=False, status_code=200)
+
+    pages = list(drafts_api.iter_issue_pages(since=since, seen=[4],
+                                             per_page=10))
+    assert [[i.number for i in page] for page in pages] == [list(range(5, 10))]
+
+
+@requests_mock.mock()
+def test_GitHub_iter_issue_pages_request_not_ok(m):
+    m.get(drafts_api.git_url('issues'), text="I'm a teapot", status_code=418)
+    nose.tools.assert_raises(GitHubError, list, drafts_api.iter_issue_pages())
+
+
+@requests_mock.mock()
+def test_GitHub_iter_repo_events_stops_at_stored_event(m):
+    url = drafts_api.git_url('issues/events')
+    m.get(url, json=[{'id': 9}, {'id': 8}], status_code=200,
+          headers={'Link': '<{0}?page=2>; rel="next"'.format(url)})
+    m.get(url + '?page=2', json=[{'id': 7}, {'id': 6}, {'id': 5}],
+          status_code=200, complete_qs=True,
+          headers={'Link': '<{0}?page=3>; rel="next"'.format(url)})
+    pages = list(drafts_api.iter_repo_events(after_id=6))
+    assert [[e['id'] for e in page] for page in pages] == [[9, 8], [7]]
+    # The page holding the stored event is the last one fetched
+    assert m.call_count == 2
+
+
+def test_github_for():
+    assert github_for('18F/blog-drafts') is drafts_api
+    assert github_for(' 18F/blog-drafts@staging ') is drafts_api
+    api = github_for('18F/other-drafts@main')
+    assert (api.owner, api.repo, api.branch) == ('18F', 'other-drafts', 'main')
+    assert api.full_name == '18F/other-drafts'
+    assert github_for('18F/other-drafts') is api
+
+
+@requests_mock.mock()
+def test_GitHub_issue_page(m):
+    issues = _issues(n_issues=3)
+    m.get(drafts_api.git_url('issues'), json=issues, status_code=200)
+    (page, next_since) = drafts_api.issue_page(issues[0]['updated_at'],
+                                               seen={0})
+    assert [i.number for i in page] == [1, 2]
+    assert next_since == issues[-1]['updated_at']
+    (page, next_since) = drafts_api.issue_page(next_since, seen={0, 1, 2})
+    assert (page, next_since) == ([], None)
+
+
+def test_jobs_args_are_canonical():
+    assert jobs._args({'since': 'x', 'repo': 'a/b'}) == \
+        jobs._args({'repo': 'a/b', 'since': 'x'})
+
+
+def test_jobs_enqueue_unknown_kind():
+    nose.tools.assert_raises(ValueError, jobs.enqueue, 'no-such-kind')
+
+
+@requests_mock.mock()
+def test_jobs_rebuild_posts_to_build_hook(m):
+    m.post('https://builds.example.com/staging', text='Queued')
+    hooks = app.config.get('REBUILD_HOOKS')
+    app.config['REBUILD_HOOKS'] = {
+        'staging': 'https://builds.example.com/staging'}
+    try:
+        with app.app_context():
+            jobs.HANDLERS['rebuild'](server='staging')
+            nose.tools.assert_raises(ValueError, jobs.HANDLERS['rebuild'],
+                                     server='production')
+    finally:
+        app.config['REBUILD_HOOKS'] = hooks
+    assert m.call_count == 1
+    assert m.last_request.json() == {'ref': 'refs/heads/staging'}
+
+
+def test_replica_lag_sql_by_server_version():
+    assert 'pg_last_xlog_replay_location()' in replica.lag_sql(90500)
+    assert 'pg_last_wal_replay_lsn()' in replica.lag_sql(100000)
+
+
+def test_reads_go_to_replica_until_session_writes():
+    "Needs two databases: TEST_DATABASE_URL and TEST_REPLICA_DATABASE_URL."
+    if not os.environ.get('TEST_REPLICA_DATABASE_URL'):
+        raise SkipTest('TEST_REPLICA_DATABASE_URL is not set')
+    from config import config
+    from sqlalchemy.engine.url import make_url
+    app.config.from_object(config['testing'])
+    db.init_app(app)
+    primary = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database
+    standby = make_url(app.config['SQLALCHEMY_BINDS']['replica']).database
+
+    def current_database():
+        return db.session.execute('SELECT current_database()').scalar()
+
+    with app.test_request_context('/'):
+        assert current_database() == primary
+        db.read_from_replica()
+        assert current_database() == standby
+        with db.primary():
+            assert current_database() == primary
+        db.session.execute('CREATE TEMPORARY TABLE replica_test (id int)')
+        assert current_database() == primary
+        db.session.rollback()
+
+
+def test_partitions_planned_by_month():
+    D = datetime.date
+    assert partitions.add_months(D(2016, 11, 20), 3) == D(2017, 2, 1)
+    assert partitions.add_months(D(2016, 1, 5), -1) == D(2015, 12, 1)
+    assert partitions.partition_name('event', D(2016, 3, 1)) == \
+        'event_y2016m03'
+    existing = [D(2016, 1, 1), D(2016, 2, 1), D(2016, 3, 1)]
+    assert partitions.months_to_create(existing, [D(2014, 5, 1)],
+                                       D(2016, 2, 14), ahead=2) == \
+        [D(2014, 5, 1), D(2016, 4, 1)]
+    assert partitions.expired(existing, 1, D(2016, 3, 31)) == [D(2016, 1, 1)]
+    assert partitions.expired(existing, 24, D(2016, 3, 31)) == []
+
+
+def test_partition_archives_never_overwrite():
+    directory = os.path.join(tempfile.mkdtemp(), 'archive')
+    (first, first_path) = partitions._new_archive('event_y2014m03', directory)
+    with first:
+        first.write(b'first')
+    (second, second_path) = partitions._new_archive('event_y2014m03',
+                                                    directory)
+    second.close()
+    assert os.path.basename(first_path) == 'event_y2014m03.csv.gz'
+    assert os.path.basename(second_path) == 'event_y2014m03.2.csv.gz'
+    with open(first_path, 'rb') as archive:
+        assert archive.read() == b'first'
+
+
+def test_load_test_summary_and_comparison():
+    samples = [('/', n / 100.0, n != 100) for n in range(1, 101)] + \
+        [('/issues/', 0.5, True)] * 10
+    summary = load_test.summarize(samples, seconds=10)
+    assert summary['/'] == {'requests': 100, 'requests_per_second': 10.0,
+                            'error_rate': 0.01, 'p50_ms': 500.0,
+                            'p95_ms': 950.0, 'p99_ms': 990.0}
+    assert summary['all']['requests'] == 110
+    old = {'routes': summary, 'server': {'peak_rss_mb': 100,
+                                         'final_rss_mb': 90}}
+    new = {'routes': load_test.summarize(samples[50:], seconds=10),
+           'server': {'peak_rss_mb': 120, 'final_rss_mb': None}}
+    rows = dict(((route, metric), (before, after, change))
+                for (route, metric, before, after, change)
+                in load_test.compare(old, new))
+    assert rows[('/', 'requests_per_second')] == (10.0, 5.0, -50.0)
+    assert rows[('server', 'peak_rss_mb')] == (100, 120, 20.0)
+    assert rows[('server', 'final_rss_mb')] == (90, None, None)
+
+
+def test_streaming_coalesce_flushes_early_where_marked():
+    chunks = [u'<head>', u'<nav>' + streaming.flush(), u'a' * 10, u'b' * 10,
+              u'\u2026']
+    assert list(streaming.coalesce(chunks, flush_bytes=15)) == \
+        [b'<head><nav>', b'a' * 10 + b'b' * 10, u'\u2026'.encode('utf-8')]
+
+
+def test_streaming_gzipped_pieces_decompress_as_they_arrive():
+    pieces = list(streaming.gzipped([b'<head>', b'<body>' * 100]))
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(pieces[0]) == b'<head>'
+    assert decompressor.decompress(b''.join(pieces[1:])) == b'<body>' * 100
+
+
+def test_streaming_first_piece_is_padded_past_server_buffering():
+    pieces = list(streaming.gzipped([b'<head>', b'<body>' * 100],
+                                    first_piece_bytes=18000))
+    assert 18000 <= len(pieces[0]) < 18100
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(pieces[0]) == b'<head>'
+    whole = gzip.GzipFile(fileobj=io.BytesIO(b''.join(pieces))).read()
+    assert whole == b'<head>' + b'<body>' * 100
+    assert gzip.GzipFile(fileobj=io.BytesIO(
+        b''.join(streaming.gzipped([])))).read() == b''
+    plain = list(streaming.padded([b'<head>', b'<body>'], 100))
+    assert len(plain[0]) == 100
+    assert plain[0].startswith(b'<head><!--') and plain[0].endswith(b'-->')
+    assert plain[1] == b'<body>'
+
+
+def test_profiler_samples_the_calling_thread():
+    def spin(seconds):
+        end = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        while datetime.datetime.now() < end:
+            pass
+
+    profile = profiler.Profile(interval=0.001).start()
+    spin(0.1)
+    profile.stop()
+    assert profile.samples > 0
+    assert any('spin (' in stack[-1] for stack in profile.stacks)
+    assert profile.summary()['split'] == {'python': 1.0}
+    assert profile.folded().endswith('\n')
+    assert profile.svg().startswith('<svg')
+
+
+def test_profiled_stream_closed_unsent_saves_its_profile():
+    from flask import Response as FlaskResponse
+    app = _configured_app()
+    directory = tempfile.mkdtemp()
+    saved = dict((key, app.config.get(key)) for key in
+                 ('PROFILE_DIR', 'PROFILE_MIN_INTERVAL_SECONDS'))
+    app.config.update(PROFILE_DIR=directory, PROFILE_MIN_INTERVAL_SECONDS=0)
+    closed = []
+
+    def pieces():
+        try:
+            yield 'never sent'
+        finally:
+            closed.append(True)
+
+    def view():
+        body = pieces()
+        next(body)
+        return FlaskResponse(body)
+
+    try:
+        with app.test_request_context('/issues/?profile=1'):
+            response = profiling.profiled(view)
+            assert response.headers['X-Profile'].endswith('.svg')
+            response.close()
+            response.close()
+        assert closed == [True]
+        assert not profiling._state['active']
+        assert any(f.endswith('.svg') for f in os.listdir(directory))
+    finally:
+        app.config.update(saved)
+
+
+def test_profiler_category_is_the_innermost_match():
+    assert profiler._category(['app/app.py', 'jinja2/environment.py',
+                               'sqlalchemy/engine/base.py']) == 'sql'
+    assert profiler._category(['app/app.py', 'lib/git_parse.py',
+                               'site-packages/requests/api.py']) == 'http'
+    assert profiler._category(['app/app.py', 'app/models.py']) == 'python'
+
+
+def test_export_writes_a_row_group_per_batch():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SkipTest('pyarrow is not installed')
+    columns = [c.name for c in export.columns('event')]
+    rows = [tuple({'id': n, 'commit_id': None, 'url': None, 'actor': 'actor',
+                   'event': 'labeled', 'created_at': datetime.date(2015, 1, 1),
+                   'issue_id': n}[c] for c in columns) for n in range(25)]
+
+    class Cursor(object):
+        def execute(self, sql, params):
+            assert 'xmin' in sql and params == {'since': 5}
+
+        def fetchmany(self, size):
+            (batch, rows[:size]) = (rows[:size], [])
+            return batch
+
+        def close(self):
+            pass
+
+    class Connection(object):
+        def cursor(self, name=None):
+            return Cursor()
+
+    sink = export._Pieces()
+    counts = list(export.write_table(Connection(), 'event', sink,
+                                     since=2 ** 32 + 5, batch_rows=10))
+    assert counts == [10, 20, 25, 25]
+    parquet = pq.ParquetFile(io.BytesIO(sink.take()))
+    assert parquet.num_row_groups == 3
+    assert parquet.read().column('actor').to_pylist() == ['actor'] * 25
+
+
+def test_stream_table_connects_only_while_streaming():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SkipTest('pyarrow is not installed')
+    opened = []
+
+    class Cursor(object):
+        def execute(self, sql, params=None):
+            self.rows = [(42, )] if 'txid' in sql else []
+
+        def fetchone(self):
+            return self.rows.pop()
+
+        def fetchmany(self, size):
+            return []
+
+        def close(self):
+            pass
+
+    class Connection(object):
+        closed = False
+
+        def cursor(self, name=None):
+            return Cursor()
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    class Engine(object):
+        def raw_connection(self):
+            opened.append(Connection())
+            return opened[-1]
+
+    (watermark, pieces) = export.stream_table('event', engine=Engine())
+    assert watermark == 42
+    assert [c.closed for c in opened] == [True]
+    parquet = pq.ParquetFile(io.BytesIO(b''.join(pieces)))
+    assert parquet.read().num_rows == 0
+    assert [c.closed for c in opened] == [True, True]
+    (_, unsent) = export.stream_table('event', engine=Engine())
+    unsent.close()
+    assert len(opened) == 3
+
+
+### Resilience tests, against the fault-injecting GitHub stand-in ###
+
+
+def _raw_url(standin):
+    return standin.url + '/raw/18F/hub/master/_data/locations.yml'
+
+
+@with_setup(resilience.reset, resilience.reset)
+def test_resilience_read_timeout():
+    standin = GitHubStandIn(Dataset(n_issues=0, n_months=1)).start()
+    try:
+        standin.inject('raw', delay=0.5)
+        with nose.tools.assert_raises(requests.Timeout):
+            resilience.get(_raw_url(standin), 'raw', timeout=(1, 0.1))
+    finally:
+        standin.stop()
+
+
+@with_setup(resilience.reset, resilience.reset)
+def test_resilience_circuit_opens_after_repeated_failures():
+    standin = GitHubStandIn(Dataset(n_issues=0, n_months=1)).start()
+    try:
+        standin.inject('raw', status=503)
+        for _ in range(resilience.FAILURE_THRESHOLD):
+            assert resilience.get(_raw_url(standin), 'raw').status_code == 503
+        with nose.tools.assert_raises(resilience.CircuitOpenError):
+            resilience.get(_raw_url(standin), 'raw')
+        assert standin.request_counts['raw'] == resilience.FAILURE_THRESHOLD
+    finally:
+        standin.stop()
+
+
+@with_setup(resilience.reset, resilience.reset)
+def test_resilience_hedges_slow_raw_fetch():
+    standin = GitHubStandIn(Dataset(n_issues=0, n_months=1)).start()
+    try:
+        latencies = resilience.latencies_for(
+            standin.url.split('//')[1], 'raw')
+        for _ in range(resilience.MIN_HEDGE_SAMPLES):
+            latencies.add(0.05)
+        standin.inject('raw', delay=1, times=1)
+        start = datetime.datetime.now()
+        response = resilience.get(_raw_url(standin), 'raw', hedge=True)
+        assert response.ok
+        assert (datetime.datetime.now() - start).total_seconds() < 0.9
+        assert standin.request_counts['raw'] == 2
+    finally:
+        standin.stop()
+
+
+### Async client tests, against the GitHub stand-in ###
+
+
+def _run_async(standin, work):
+    """Runs the coroutine `work(client)` to completion on a new event loop,
+    `client` being an AsyncGitHub for the drafts repo served by `standin`."""
+    if async_git_parse is None:
+        raise SkipTest('Needs Python 3.6+ and aiohttp')
+    client = async_git_parse.AsyncGitHub.like(drafts_api)
+    (client.api, client.raw) = (standin.url, standin.url + '/raw')
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(work(client))
+    finally:
+        loop.run_until_complete(client.pool.close())
+        loop.close()
+
+
+def test_AsyncGitHub_iter_issue_pages_skips_seen():
+    dataset = Dataset(n_issues=25, n_months=1)
+    standin = GitHubStandIn(dataset).start()
+    try:
+        pages = _run_async(standin, lambda client: async_git_parse.collect(
+            client.iter_issue_pages(seen=[dataset.issues[0]['number']],
+                                    per_page=10)))
+    finally:
+        standin.stop()
+    numbers = [i.number for page in pages for i in page]
+    assert numbers == [i['number'] for i in dataset.issues[1:]]
+    assert all(isinstance(i, IssueRecord) for page in pages for i in page)
+
+
+def test_AsyncGitHub_iter_repo_events_stops_at_stored_event():
+    dataset = Dataset(n_issues=40, n_months=1, events_per_issue=(5, 5))
+    feed = dataset.repo_events()
+    standin = GitHubStandIn(dataset).start()
+    try:
+        pages = _run_async(standin, lambda client: async_git_parse.collect(
+            client.iter_repo_events(after_id=feed[150]['id'])))
+        assert [e['id'] for page in pages for e in page] == \
+            [e['id'] for e in feed[:150]]
+        assert standin.request_counts['repo_events'] == 2
+    finally:
+        standin.stop()
+
+
+@with_setup(resilience.reset, resilience.reset)
+def test_AsyncGitHub_fails_fast_once_circuit_opens():
+    standin = GitHubStandIn(Dataset(n_issues=5, n_months=1)).start()
+
+    def async_pages(client):
+        return async_git_parse.collect(client.iter_issue_pages())
+
+    try:
+        standin.inject('issues', status=503)
+        for _ in range(resilience.FAILURE_THRESHOLD):
+            nose.tools.assert_raises(GitHubError, _run_async, standin,
+                                     async_pages)
+        nose.tools.assert_raises(resilience.CircuitOpenError, _run_async,
+                                 standin, async_pages)
+        assert standin.request_counts['issues'] == \
+            resilience.FAILURE_THRESHOLD
+    finally:
+        standin.stop()
+
+
+@with_setup(resilience.reset, resilience.reset)
+def test_AsyncGitHub_times_out_a_hung_host():
+    standin = GitHubStandIn(Dataset(n_issues=5, n_months=1)).start()
+    timeouts = resilience.TIMEOUTS['issues']
+    resilience.TIMEOUTS['issues'] = (1, 0.2)
+    try:
+        standin.inject('issues', delay=1, times=1)
+        nose.tools.assert_raises(asyncio.TimeoutError, _run_async, standin,
+                                 lambda client: async_git_parse.collect(
+                                     client.iter_issue_pages()))
+    finally:
+        resilience.TIMEOUTS['issues'] = timeouts
+        standin.stop()
+
+
+def _database():
+    """An app context on the test database; raises SkipTest unless
+    FLASK_CONFIG is 'testing', as on Travis."""
+    if os.environ.get('FLASK_CONFIG') != 'testing':
+        raise SkipTest('Needs the test database (FLASK_CONFIG=testing)')
+    return _configured_app().app_context()
+
+
+@with_setup(resilience.reset, resilience.reset)
+def test_async_sync_isolates_a_failing_repo():
+    if async_git_parse is None:
+        raise SkipTest('Needs Python 3.6+ and aiohttp')
+    from app import async_sync, models
+    from app.models import GithubQueryLog, Issue
+    (healthy, failing) = (GitHubStandIn(Dataset(n_issues=15, n_months=1)),
+                          GitHubStandIn(Dataset(n_issues=15, n_months=1)))
+    (ok, bad) = (GitHub('async-ok', 'test'), GitHub('async-bad', 'test'))
+    healthy.start().point(ok)
+    failing.start().point(bad)
+    failing.inject('issues', status=502)
+    since = datetime.datetime(2015, 1, 1)
+    with _database():
+        try:
+            loop = asyncio.new_event_loop()
+            pool = async_git_parse.ConnectionPool()
+            try:
+                loop.run_until_complete(async_sync.sync_issue_repos(
+                    pool, [(ok, since), (bad, since)]))
+            finally:
+                loop.run_until_complete(pool.close())
+                loop.close()
+            assert list(models.sync_state['issues']['failed_repos']) == \
+                ['test/async-bad']
+            assert Issue.query.filter_by(repo='test/async-ok').count() == 15
+            assert Issue.last_event_id('test/async-ok') > 0
+            assert Issue.query.filter_by(repo='test/async-bad').count() == 0
+            assert Issue.last_event_id('test/async-bad') == 0
+        finally:
+            db.session.rollback()
+            for issue in Issue.query.filter(Issue.repo.like('test/async-%')):
+                Issue.remove(issue.repo, issue.number)
+            GithubQueryLog.query.filter(GithubQueryLog.query_type.like(
+                '%test/async-%')).delete(synchronize_session=False)
+            db.session.commit()
+            healthy.stop()
+            failing.stop()
+
+
+### Database tests, on the test database ###
+
+
+def test_snapshot_dump_and_load_round_trip():
+    from app import snapshot
+    from app.models import Issue, Label
+    (handle, path) = tempfile.mkstemp(suffix='.tar.gz')
+    os.close(handle)
+    with _database():
+        try:
+            db.session.remove()
+            snapshot.truncate_all()
+            db.session.add(Issue(repo='test/snapshot', number=1,
+                                 title='Draft', labels=[Label(name='idea')]))
+            db.session.commit()
+            db.session.remove()
+            counts = snapshot.dump(path)
+            assert counts['issue'] == 1 and counts['labels_issues'] == 1
+            snapshot.truncate_all()
+            assert snapshot.load(path) == counts
+            restored = Issue.query.one()
+            assert restored.title == 'Draft'
+            assert [l.name for l in restored.labels] == ['idea']
+            # Sequences were moved past the restored ids
+            added = Issue(repo='test/snapshot', number=2)
+            db.session.add(added)
+            db.session.commit()
+            assert added.id > restored.id
+        finally:
+            db.session.remove()
+            snapshot.truncate_all()
+            os.remove(path)
+
+
+def test_review_stages_and_medians_from_milestones():
+    from app.models import Issue, Label, Milestone, ReviewStage
+    D = datetime.date
+    with _database():
+        try:
+            issue = Issue(repo='test/review', number=1, title='Draft',
+                          state='closed', closed_at=D(2016, 1, 20),
+                          labels=[Label(name='test-review-label')])
+            db.session.add(issue)
+            db.session.flush()
+            for (n, (title, day)) in enumerate([
+                    ('draft', D(2016, 1, 1)),
+                    ('ready to approve', D(2016, 1, 5)),
+                    ('approved', D(2016, 1, 12))]):
+                db.session.add(Milestone(id=10 ** 9 + n, title=title,
+                                         created_at=day, issue_id=issue.id))
+            db.session.flush()
+            ReviewStage.refresh([issue.id])
+            stages = ReviewStage.query.filter_by(issue_id=issue.id).order_by(
+                ReviewStage.sequence)
+            assert [(r.sequence, r.stage, r.entered_at, r.left_at)
+                    for r in stages] == [
+                (1, 'draft', D(2016, 1, 1), D(2016, 1, 5)),
+                (2, 'ready to approve', D(2016, 1, 5), D(2016, 1, 12)),
+                (3, 'approved', D(2016, 1, 12), None)]
+            medians = dict((row['label'], row) for row
+                           in ReviewStage.median_days_by_label())
+            assert medians['test-review-label']['issues'] == 1
+            assert medians['test-review-label']['median_days'] == 7
+            # The last stage of a closed issue ends when the issue closed
+            medians = dict((row['label'], row) for row
+                           in ReviewStage.median_days_by_label('approved'))
+            assert medians['test-review-label']['median_days'] == 8
+        finally:
+            db.session.rollback()
+
+
+def test_search_api_ignores_a_malformed_limit():
+    response = _configured_app().test_client().get(
+        '/api/search/?q=&limit=abc', headers=_auth_headers())
+    assert response.status_code == 200
+    assert json.loads(response.data.decode('utf-8')) == {'issues': []}
+
+
+def test_issue_search_ranks_and_filters():
+    from app.models import Issue, Label
+    with _database():
+        try:
+            db.session.add_all([
+                Issue(repo='test/search', number=1, state='open',
+                      title='Partition pruning in Postgres',
+                      body='Pruning skips partitions a query cannot match.',
+                      labels=[Label(name='test-search-label')]),
+                Issue(repo='test/search', number=2, state='closed',
+                      title='Gardening notes', body='On pruning roses.'),
+                Issue(repo='test/search', number=3, state='open',
+                      title='Unrelated', body='Nothing to see here.'),
+            ])
+            db.session.flush()
+
+            def numbers(**kwargs):
+                return [r['number'] for r in Issue.search('pruning', **kwargs)
+                        if r['repo'] == 'test/search']
+
+            assert numbers() == [1, 2]
+            assert numbers(state='closed') == [2]
+            assert numbers(labels=['test-search-label']) == [1]
+            best = [r for r in Issue.search('pruning')
+                    if r['repo'] == 'test/search'][0]
+            assert '<mark>' in best['snippet']
+            assert Issue.search('   ') == []
+        finally:
+            db.session.rollback()
+
+
+def test_author_months_rejects_a_malformed_month():
+    client = _configured_app().test_client()
+    for value in ('foo', '2016', '2016-13', '2016-01-01'):
+        response = client.get('/api/author-months/?start=' + value,
+                              headers=_auth_headers())
+        assert response.status_code == 400, value
+
+
+def test_author_matrix_from_author_months():
+    from app.models import Author, Month, _author_matrix_cache
+    with _database():
+        try:
+            alice = Author(username='test-alice')
+            bob = Author(username='test-bob')
+            for (begin, authors) in ((datetime.date(2014, 3, 1), [alice]),
+                                     (datetime.date(2014, 4, 1), [alice, bob]),
+                                     (datetime.date(2014, 5, 1), [bob]),
+                                     (datetime.date(2015, 1, 1), [bob])):
+                month = Month.get_or_create(begin)
+                month.authors.update(authors)
+                db.session.add(month)
+            db.session.flush()
+            _author_matrix_cache.clear()
+
+            matrix = Month.author_matrix(start=datetime.date(2014, 3, 1),
+                                         end=datetime.date(2014, 5, 1))
+            assert matrix['months'] == ['2014-03-01', '2014-04-01',
+                                        '2014-05-01']
+            (a, b) = (matrix['authors'].index('test-alice'),
+                      matrix['authors'].index('test-bob'))
+            assert matrix['membership'][a] == [0, 1]
+            assert matrix['membership'][b] == [1, 2]
+            assert matrix['first_month'][b] == '2014-04-01'
+            assert matrix['last_month'][a] == '2014-04-01'
+            assert matrix['last_month'][b] == '2015-01-01'
+        finally:
+            _author_matrix_cache.clear()
+            db.session.rollback()
+
+
+def test_failed_statement_leaves_no_statement_timer():
+    from sqlalchemy.exc import ProgrammingError
+    with _database():
+        connection = db.session.connection()
+        try:
+            with nose.tools.assert_raises(ProgrammingError):
+                connection.execute('SELECT * FROM no_such_table')
+            assert not connection.info.get('statement_started')
+            connection.execute('SELECT 1')
+            assert not connection.info.get('statement_started')
+        finally:
+            db.session.rollback()
+
+
+def _clear_jobs():
+    "Empties the job queue; the queue's functions commit as they go."
+    db.session.rollback()
+    db.session.execute('DELETE FROM job')
+    db.session.commit()
+
+
+def _job_rows(kind):
+    return [dict(row) for row in db.session.execute("""
+        SELECT id, args, state, attempts,
+               extract(epoch FROM run_after - now())::float AS wait
+        FROM job WHERE kind = :kind ORDER BY id""", {'kind': kind})]
+
+
+@jobs.handler('test-job')
+def _test_job(fail=False, **args):
+    if fail:
+        raise RuntimeError('test job failed')
+
+
+def test_jobs_identical_pending_jobs_are_deduplicated():
+    with _database():
+        _clear_jobs()
+        try:
+            assert jobs.enqueue('test-job', n=1)
+            assert not jobs.enqueue('test-job', n=1)
+            assert jobs.enqueue('test-job', n=2)
+            (job_id, added) = jobs.submit('test-job', n=1)
+            assert not added
+            assert job_id == _job_rows('test-job')[0]['id']
+            assert len(_job_rows('test-job')) == 2
+            # Once the first is claimed, an identical job may pend again
+            db.session.commit()
+            assert jobs.claim('test-worker').args == jobs._args({'n': 1})
+            assert jobs.enqueue('test-job', n=1)
+        finally:
+            _clear_jobs()
+
+
+def test_jobs_claim_skips_locked_and_delayed_jobs():
+    with _database():
+        _clear_jobs()
+        try:
+            jobs.enqueue('test-job', n=1)
+            jobs.enqueue('test-job', n=2)
+            jobs.enqueue('test-job', 3600, n=3)
+            db.session.commit()
+            (first, second, _) = [r['id'] for r in _job_rows('test-job')]
+            other = db.engine.connect()
+            transaction = other.begin()
+            try:
+                # Another worker holds the first job's row
+                other.execute(db.text('SELECT id FROM job WHERE id = :id '
+                                      'FOR UPDATE'), id=first)
+                job = jobs.claim('test-worker')
+                assert (job.id, job.attempts) == (second, 1)
+                assert jobs.claim('test-worker') is None
+            finally:
+                transaction.rollback()
+                other.close()
+            assert jobs.claim('test-worker').id == first
+            assert jobs.claim('test-worker') is None
+        finally:
+            _clear_jobs()
+
+
+def test_jobs_retry_with_backoff_then_fail():
+    with _database():
+        _clear_jobs()
+        try:
+            jobs.enqueue('test-job', fail=True)
+            db.session.commit()
+            for (attempts, wait) in ((1, 10), (2, 20)):
+                assert jobs.run_one('test-worker', max_attempts=3,
+                                    retry_seconds=10) == 'retried'
+                [row] = _job_rows('test-job')
+                assert (row['state'], row['attempts']) == ('pending',
+                                                           attempts)
+                assert wait - 5 < row['wait'] <= wait
+                assert jobs.run_one('test-worker') is None
+                db.session.execute(
+                    "UPDATE job SET run_after = now() WHERE kind = 'test-job'")
+                db.session.commit()
+            assert jobs.run_one('test-worker', max_attempts=3,
+                                retry_seconds=10) == 'failed'
+            [row] = _job_rows('test-job')
+            assert (row['state'], row['attempts']) == ('failed', 3)
+            assert jobs.run_one('test-worker') is None
+        finally:
+            _clear_jobs()
+
+
+def test_jobs_requeue_stalled():
+    with _database():
+        _clear_jobs()
+        try:
+            for (args, state, started) in (
+                    ('{"n":1}', 'running', '2 hours'),
+                    ('{"n":1}', 'running', '1 hour'),
+                    ('{"n":2}', 'running', '1 hour'),
+                    ('{"n":2}', 'pending', None),
+                    ('{"n":3}', 'running', '1 second')):
+                db.session.execute("""
+                    INSERT INTO job (kind, args, state, attempts, started_at,
+                                     worker)
+                    VALUES ('test-job', :args, :state, 1,
+                            now() - CAST(:started AS interval), 'dead')""",
+                                   {'args': args, 'state': state,
+                                    'started': started})
+            db.session.commit()
+            jobs.requeue_stalled(60)
+            assert [(r['args'], r['state']) for r in _job_rows('test-job')] \
+                == [('{"n":1}', 'failed'), ('{"n":1}', 'pending'),
+                    ('{"n":2}', 'failed'), ('{"n":2}', 'pending'),
+                    ('{"n":3}', 'running')]
+        finally:
+            _clear_jobs()
+
+
+def _insert_events(first_id, *days):
+    "Adds events, one on each of `days`; returns their ids."
+    ids = list(range(first_id, first_id + len(days)))
+    for (event_id, day) in zip(ids, days):
+        db.session.execute("""
+            INSERT INTO event (id, actor, event, created_at)
+            VALUES (:id, 'test-actor', 'labeled', :day)""",
+                           {'id': event_id, 'day': day})
+    return ids
+
+
+def _event_partitions():
+    "Skips the test unless `event` is partitioned, as migrations make it."
+    if not partitions.is_partitioned('event'):
+        raise SkipTest('event is not partitioned')
+    return partitions.partitions('event')
+
+
+def _drop_partitions(*names):
+    db.session.rollback()
+    for name in names:
+        db.session.execute('DROP TABLE IF EXISTS {0}'.format(name))
+    db.session.commit()
+
+
+def test_partitions_create_partition_moves_default_rows():
+    D = datetime.date
+    with _database():
+        try:
+            assert D(1990, 2, 1) not in _event_partitions()
+            _insert_events(10 ** 9, D(1990, 2, 3), D(1990, 2, 28),
+                           D(1990, 3, 1))
+            assert partitions.create_partition('event', D(1990, 2, 1)) == 2
+            assert partitions.partitions('event')[D(1990, 2, 1)] == \
+                'event_y1990m02'
+
+            def count(table):
+                return db.session.execute(
+                    "SELECT count(*) FROM {0} WHERE actor = 'test-actor'"
+                    .format(table)).scalar()
+            assert count('event_y1990m02') == 2
+            assert count('event_default') == 1
+            assert count('event') == 3
+        finally:
+            db.session.rollback()
+
+
+def test_partitions_maintain_empties_the_default_partition():
+    D = datetime.date
+    with _database():
+        try:
+            _event_partitions()
+            _insert_events(10 ** 9, D(1990, 3, 3), D(1990, 5, 9))
+            db.session.commit()
+            created = partitions.maintain(today=D(1990, 3, 20), ahead=1)
+            assert set(['event_y1990m03', 'event_y1990m04',
+                        'event_y1990m05']) <= set(created)
+            assert db.session.execute(
+                "SELECT count(*) FROM event_default "
+                "WHERE actor = 'test-actor'").scalar() == 0
+            assert db.session.execute(
+                "SELECT count(*) FROM event_y1990m05").scalar() == 1
+            assert partitions.maintain(today=D(1990, 3, 20), ahead=1) == []
+        finally:
+            _drop_partitions('event_y1990m03', 'event_y1990m04',
+                             'event_y1990m05')
+            db.session.execute("DELETE FROM event WHERE actor = 'test-actor'")
+            db.session.commit()
+
+
+def test_partitions_retention_archives_then_drops():
+    D = datetime.date
+    directory = tempfile.mkdtemp()
+    with _database():
+        try:
+            _event_partitions()
+            _insert_events(10 ** 9, D(1990, 6, 1), D(1990, 6, 30))
+            partitions.create_partition('event', D(1990, 6, 1))
+            db.session.commit()
+            dropped = partitions.apply_retention(1, directory,
+                                                 today=D(1990, 8, 15))
+            assert dropped == {'event_y1990m06': 2}
+            assert D(1990, 6, 1) not in partitions.partitions('event')
+            assert db.session.execute(
+                "SELECT to_regclass('event_y1990m06')").scalar() is None
+            path = os.path.join(directory, 'event_y1990m06.csv.gz')
+            with gzip.open(path, 'rb') as archive:
+                lines = archive.read().decode('utf-8').splitlines()
+            assert lines[0].startswith('id,')
+            assert sorted(line.split(',')[0] for line in lines[1:]) == \
+                [str(10 ** 9), str(10 ** 9 + 1)]
+        finally:
+            _drop_partitions('event_y1990m06')
+            db.session.execute("DELETE FROM event WHERE actor = 'test-actor'")
+            db.session.commit()
+
+
+def _issue_delivery(action, number, **fields):
+    "An `issues` webhook payload for issue `number` of the first issue repo."
+    from app.models import issue_repos
+    issue = dict({'id': 10 ** 9 + number, 'number': number,
+                  'title': 'Test issue', 'state': 'open', 'labels': [],
+                  'comments': 0, 'created_at': '2016-01-01T00:00:00Z',
+                  'updated_at': '2016-01-02T00:00:00Z', 'closed_at': None},
+                 **fields)
+    return {'action': action, 'issue': issue,
+            'repository': {'full_name': issue_repos()[0].full_name}}
+
+
+def _remove_webhook_rows(*numbers):
+    from app.models import Issue, Label, issue_repos
+    db.session.rollback()
+    for number in numbers:
+        Issue.remove(issue_repos()[0].full_name, number)
+    for label in Label.query.filter(Label.name.like('test-hook-%')):
+        label.issues = []
+        db.session.delete(label)
+    db.session.commit()
+    _clear_jobs()
+
+
+def test_webhook_issues_upsert_and_remove():
+    from app.models import Issue
+    with _database():
+        _clear_jobs()
+        try:
+            repo = _issue_delivery('opened', 1)['repository']['full_name']
+
+            def stored():
+                return Issue.query.filter_by(repo=repo, number=1).first()
+
+            assert webhooks.apply('issues', _issue_delivery(
+                'opened', 1, comments=2,
+                labels=[{'name': 'test-hook-idea'}]))
+            issue = stored()
+            assert (issue.title, issue.state, issue.comments) == \
+                ('Test issue', 'open', '2')
+            assert [l.name for l in issue.labels] == ['test-hook-idea']
+            assert _job_rows('repo_events') == []
+            webhooks.apply('issues', _issue_delivery(
+                'closed', 1, state='closed',
+                closed_at='2016-01-03T00:00:00Z'))
+            assert (stored().state, stored().closed_at) == \
+                ('closed', datetime.date(2016, 1, 3))
+            assert stored().labels == []
+            assert [r['args'] for r in _job_rows('repo_events')] == \
+                [jobs._args({'repo': repo})]
+            for action in ('transferred', 'deleted'):
+                webhooks.apply('issues', _issue_delivery('reopened', 1))
+                assert stored() is not None
+                webhooks.apply('issues', _issue_delivery(action, 1))
+                assert stored() is None
+        finally:
+            _remove_webhook_rows(1)
+
+
+def test_webhook_label_rename_and_delete():
+    from app.models import Issue, Label
+    with _database():
+        _clear_jobs()
+        try:
+            delivery = _issue_delivery('opened', 1,
+                                       labels=[{'name': 'test-hook-old'}])
+            webhooks.apply('issues', delivery)
+            repository = delivery['repository']
+            webhooks.apply('label', {
+                'action': 'edited', 'repository': repository,
+                'label': {'name': 'test-hook-new', 'color': 'ff0000'},
+                'changes': {'name': {'from': 'test-hook-old'}}})
+            assert Label.query.filter_by(name='test-hook-old').first() is None
+            issue = Issue.query.filter_by(repo=repository['full_name'],
+                                          number=1).one()
+            assert [(l.name, l.color) for l in issue.labels] == \
+                [('test-hook-new', 'ff0000')]
+            webhooks.apply('label', {'action': 'deleted',
+                                     'repository': repository,
+                                     'label': {'name': 'test-hook-new'}})
+            assert Label.query.filter_by(name='test-hook-new').first() is None
+            assert issue.labels == []
+        finally:
+            _remove_webhook_rows(1)
+
+
+def test_webhook_milestone_rename():
+    from app.models import Issue, Milestone, ReviewStage
+    with _database():
+        _clear_jobs()
+        try:
+            delivery = _issue_delivery('opened', 1)
+            webhooks.apply('issues', delivery)
+            repo = delivery['repository']['full_name']
+            issue = Issue.query.filter_by(repo=repo, number=1).one()
+            other = Issue(id=10 ** 9 + 2, repo='test/other-repo', number=2)
+            db.session.add(other)
+            db.session.flush()
+            for (n, owner) in enumerate((issue, other)):
+                db.session.add(Milestone(
+                    id=10 ** 9 + n, title='test-hook-draft',
+                    created_at=datetime.date(2016, 1, 1), issue_id=owner.id))
+            db.session.flush()
+            ReviewStage.refresh([issue.id, other.id])
+            db.session.commit()
+            webhooks.apply('milestone', {
+                'action': 'edited', 'repository': delivery['repository'],
+                'milestone': {'title': 'test-hook-review'},
+                'changes': {'title': {'from': 'test-hook-draft'}}})
+
+            def titles(issue_id):
+                return ([m.title for m in Milestone.query.filter_by(
+                            issue_id=issue_id)],
+                        [r.stage for r in ReviewStage.query.filter_by(
+                            issue_id=issue_id)])
+
+            assert titles(issue.id) == (['test-hook-review'],
+                                        ['test-hook-review'])
+            assert titles(other.id) == (['test-hook-draft'],
+                                        ['test-hook-draft'])
+        finally:
+            db.session.rollback()
+            Issue.remove('test/other-repo', 2)
+            db.session.commit()
+            _remove_webhook_rows(1)
+
+
+def test_webhook_push_queues_reads_by_path():
+    with _database():
+        _clear_jobs()
+        try:
+            site = {'ref': 'refs/heads/{0}'.format(site_api.branch),
+                    'repository': {'full_name': site_api.full_name},
+                    'commits': [
+                        {'added': ['_team/test-alice.md'],
+                         'modified': ['_data/authors.yml'],
+                         'removed': ['_team/test-bob.md']},
+                        {'added': ['_team/test-bob.md'],
+                         'removed': ['_team/test-carol.md', 'README.md']}]}
+            hub = {'ref': 'refs/heads/{0}'.format(hub_api.branch),
+                   'repository': {'full_name': hub_api.full_name},
+                   'commits': [{'modified': ['_data/locations.yml',
+                                             '_data/team/test-dave.yml',
+                                             '_team/test-erin.md']}]}
+            for payload in (site, hub):
+                assert webhooks.apply('push', payload)
+            # Pushes to other branches are ignored
+            webhooks.apply('push', dict(site, ref='refs/heads/feature'))
+            assert len(_job_rows('authors')) == 1
+            assert len(_job_rows('duty_stations')) == 1
+            by_username = lambda args: args['username']
+            assert sorted((json.loads(r['args'])
+                           for r in _job_rows('author_file')),
+                          key=by_username) == sorted([
+                {'repo': site_api.full_name, 'username': 'test-alice',
+                 'sha': ''},
+                {'repo': site_api.full_name, 'username': 'test-bob',
+                 'sha': ''},
+                {'repo': site_api.full_name, 'username': 'test-carol',
+                 'sha': None},
+                {'repo': hub_api.full_name, 'username': 'test-dave',
+                 'sha': ''}], key=by_username)
+        finally:
+            _clear_jobs()
+
+
+def _locations_yml(*stations):
+    return '---\n' + ''.join(
+        '- code: {0}\n  label: {1}\n  latitude: 1.5\n  longitude: -2.5\n'
+        '  timezone: America/New_York\n'.format(code, label)
+        for (code, label) in stations)
+
+
+@requests_mock.mock()
+def test_duty_stations_fill_skips_unchanged_and_prunes_removed(m):
+    from app.models import Author, DutyStation, GithubQueryLog
+    contents_url = hub_api.git_url('contents/' + DutyStation.LOCATIONS_PATH)
+    raw_url = 'https://raw.githubusercontent.com/18F/hub/{0}/{1}'.format(
+        hub_api.branch, DutyStation.LOCATIONS_PATH)
+
+    def fill(sha, *stations):
+        m.get(contents_url, json={'sha': sha}, status_code=200)
+        m.get(raw_url, text=_locations_yml(*stations), status_code=200)
+        DutyStation.fill()
+        return dict((s.airport_code, s.name) for s in DutyStation.query
+                    if s.airport_code.startswith('ZZ'))
+
+    def raw_reads():
+        return len([r for r in m.request_history if r.url == raw_url])
+
+    with _database():
+        try:
+            assert fill('sha-1', ('ZZA', 'Alpha'), ('ZZB', 'Bravo')) == \
+                {'ZZA': 'Alpha', 'ZZB': 'Bravo'}
+            reads = raw_reads()
+            assert reads > 0
+            db.session.add(Author(username='test-zz', airport_code='ZZB'))
+            db.session.commit()
+            # Same blob SHA: the file isn't read again
+            assert fill('sha-1', ('ZZA', 'Renamed')) == \
+                {'ZZA': 'Alpha', 'ZZB': 'Bravo'}
+            assert raw_reads() == reads
+            assert fill('sha-2', ('ZZA', 'Renamed')) == {'ZZA': 'Renamed'}
+            assert raw_reads() > reads
+            assert GithubQueryLog.last_cursor('locations') == 'sha-2'
+            author = Author.query.filter_by(username='test-zz').one()
+            assert author.airport_code is None
+        finally:
+            db.session.rollback()
+            Author.query.filter_by(username='test-zz').delete()
+            DutyStation.query.filter(
+                DutyStation.airport_code.like('ZZ%')).delete(
+                synchronize_session=False)
+            GithubQueryLog.query.filter_by(query_type='locations').delete()
+            db.session.commit()